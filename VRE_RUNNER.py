@@ -16,6 +16,7 @@
 # limitations under the License.
 
 import argparse
+import os
 import sys
 
 from utils import logger
@@ -50,14 +51,43 @@ def main_wrapper(config_path, in_metadata_path, out_metadata_path):
         raise Exception(errstr)
 
 
+def validate_wrapper(config_path, in_metadata_path):
+    """
+    Validation-only entry point.
+
+    Parses the configuration, the input metadata and the tool arguments, checks that the inputs exist and exits
+    without importing WORC.
+
+    :param config_path: Path to a valid VRE JSON file containing information on how the tool should be executed.
+    :type config_path: str
+    :param in_metadata_path: Path to a valid VRE JSON file containing information on tool inputs.
+    :type in_metadata_path: str
+    :return: True if the configuration is valid.
+    :rtype: bool
+    """
+    try:
+        result = JSONApp().validate(MLToolboxRunner, config_path, in_metadata_path)
+        logger.progress("<myTool> configuration is valid")
+        return result
+
+    except Exception as error:
+        errstr = "<myTool> configuration is not valid. ERROR: {}.".format(error)
+        logger.error(errstr)
+        raise Exception(errstr)
+
+
 if __name__ == "__main__":
     PARSER = argparse.ArgumentParser(description="VRE <myTool> Tool")
     PARSER.add_argument("--config", help="Location of configuration file", required=True)
     PARSER.add_argument("--in_metadata", help="Location of input metadata file", required=True)
-    PARSER.add_argument("--out_metadata", help="Location of output metadata file", required=True)
+    PARSER.add_argument("--out_metadata", help="Location of output metadata file", required=False)
     PARSER.add_argument("--log_file", help="Location of the log file", required=False)
+    PARSER.add_argument("--validate-only", action="store_true",
+                        help="Only parse and check the configuration, metadata and arguments, then exit")
 
     ARGS = PARSER.parse_args()
+    if not ARGS.validate_only and not ARGS.out_metadata:
+        PARSER.error("the following arguments are required: --out_metadata")
 
     CONFIG = ARGS.config
     IN_METADATA = ARGS.in_metadata
@@ -65,5 +95,10 @@ if __name__ == "__main__":
 
     if ARGS.log_file:
         sys.stderr = sys.stdout = open(ARGS.log_file, "w")
+        # Timing spans and progress events as JSON lines next to the log
+        logger.set_events_file(os.path.splitext(ARGS.log_file)[0] + ".events.jsonl")
 
-    RESULTS = main_wrapper(CONFIG, IN_METADATA, OUT_METADATA)
+    if ARGS.validate_only:
+        RESULTS = validate_wrapper(CONFIG, IN_METADATA)
+    else:
+        RESULTS = main_wrapper(CONFIG, IN_METADATA, OUT_METADATA)
@@ -78,12 +78,53 @@ class JSONApp(WorkflowApp):  # pylint: disable=too-few-public-methods
         >>> # writes /path/to/results.json
         """
 
+        input_files, input_metadata, arguments, output_files = self._unpack(
+            config_path, input_metadata_path)
+
+        # Run launch from the superclass
+        output_files, output_metadata = super(JSONApp, self).launch(
+            tool_class, input_files, input_metadata,
+            output_files, arguments)
+
+        logger.info("4) Pack information to JSON")
+
+        return self._write_results(
+            input_files, input_metadata,
+            output_files, output_metadata,
+            output_metadata_path)
+
+    def validate(self, tool_class, config_path, input_metadata_path):
+        """
+        Parse and check the configuration and the input metadata without
+        running the Tool (e.g. for quick validation jobs launched by the VRE).
+
+        Runs tool_class.validate(input_files, input_metadata, arguments) when
+        the Tool defines it. Raises on the first problem found.
+
+        Returns
+        -------
+        bool
+        """
+        input_files, input_metadata, arguments, _ = self._unpack(
+            config_path, input_metadata_path)
+        if hasattr(tool_class, 'validate'):
+            tool_class.validate(input_files, input_metadata, arguments)
+        return True
+
+    def _unpack(self, config_path, input_metadata_path):
+        """
+        Read config.json and input_metadata.json, and arrange the input
+        files and their metadata by role.
+
+        Returns input_files, input_metadata, arguments and output_files.
+        """
         logger.info("0) Unpack information from JSON")
-        input_ids, arguments, output_files = self._read_config(
-            config_path)
+        with logger.span('json_parse'):
+            input_ids, arguments, output_files = self._read_config(
+                config_path)
 
-        input_metadata_ids = self._read_metadata(
-            input_metadata_path)
+            input_metadata_ids = self._read_metadata(
+                input_metadata_path)
 
         # arrange by role
         input_metadata = {}
@@ -111,17 +152,7 @@ class JSONApp(WorkflowApp):  # pylint: disable=too-few-public-methods
             else:
                 input_files[role] = metadata.file_path
 
-        # Run launch from the superclass
-        output_files, output_metadata = super(JSONApp, self).launch(
-            tool_class, input_files, input_metadata,
-            output_files, arguments)
-
-        logger.info("4) Pack information to JSON")
-
-        return self._write_results(
-            input_files, input_metadata,
-            output_files, output_metadata,
-            output_metadata_path)
+        return input_files, input_metadata, arguments, output_files
 
     def _read_config(self, json_path):  # pylint: disable=no-self-use
         """
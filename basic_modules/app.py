@@ -56,6 +56,7 @@ class App(object):  # pylint: disable=too-few-public-methods
     see PyCOMPSsApp).
     """
 
+    @logger.span('launch')
     def launch(self, tool_class,  # pylint: disable=too-many-arguments
                input_files, input_metadata,
                output_files, configuration):
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Feature file regression check.
+
+WORC writes one feature file per feature calculator and patient (e.g.
+features_predict_CT_0_<patient>.hdf5 and features_pyradiomics_CT_0_<patient>.hdf5).
+This check writes the sinks of two calculators for one patient and fails
+unless both are kept by every consumer: find_feature_files, the feature store
+and its layout for WORC, the feature bundle and the resume state.
+
+Example
+-------
+    python benchmarks/check_feature_files.py
+"""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.check_resume import CALCULATORS, hdf5_stub  # noqa: E402 pylint: disable=wrong-import-position
+from tool.feature_store import FeatureStore, feature_file_names, features_directory, find_feature_files, \
+    read_feature_bundle, write_feature_bundle  # noqa: E402 pylint: disable=wrong-import-position
+from tool.load_vre_configs import build_config  # noqa: E402 pylint: disable=wrong-import-position
+from tool.resume import RunState  # noqa: E402 pylint: disable=wrong-import-position
+from utils import logger  # noqa: E402 pylint: disable=wrong-import-position
+
+PATIENT = 'P001'
+EXPECTED_NAMES = ['features_{}.hdf5'.format(calculator) for calculator in CALCULATORS]
+
+
+def write_sinks(worc_output_dir):
+    """
+    Feature sinks of a WORC experiment: both calculators for PATIENT
+    """
+    features = os.path.join(worc_output_dir, 'Features')
+    os.makedirs(features)
+    for calculator in CALCULATORS:
+        with open(os.path.join(features, 'features_{}_{}.hdf5'.format(calculator, PATIENT)), 'wb') as f:
+            f.write(hdf5_stub('{} {}'.format(calculator, PATIENT).encode()))
+
+
+def layout_names(directory):
+    """
+    Feature files of PATIENT in a folder laid out for WORC
+    """
+    return sorted(os.listdir(os.path.join(directory, PATIENT)))
+
+
+def check():
+    """
+    :return: The list of failures found
+    """
+    work_dir = tempfile.mkdtemp(prefix='check_feature_files_')
+    worc_output_dir = os.path.join(work_dir, 'outputs', 'run000')
+    write_sinks(worc_output_dir)
+    config = build_config({'General:General:Imagetype': 'CT'})
+    failures = []
+
+    found = find_feature_files(worc_output_dir, [PATIENT])
+    if sorted(found.get(PATIENT, {})) != sorted(CALCULATORS):
+        failures.append('find_feature_files: {}'.format(found))
+
+    store = FeatureStore(os.path.join(work_dir, 'store'))
+    store.put('key', found[PATIENT], patient=PATIENT)
+    if sorted(store.get('key') or {}) != sorted(CALCULATORS):
+        failures.append('feature store entry: {}'.format(store.get('key')))
+    directory = features_directory(store, {PATIENT: 'key'}, os.path.join(work_dir, 'from_store'))
+    if layout_names(directory) != EXPECTED_NAMES or feature_file_names(directory) != EXPECTED_NAMES:
+        failures.append('feature store layout: {}'.format(layout_names(directory)))
+
+    bundle = write_feature_bundle(os.path.join(work_dir, 'features.zip'), found, config)
+    directory, manifest = read_feature_bundle(bundle, os.path.join(work_dir, 'from_bundle'))
+    if layout_names(directory) != EXPECTED_NAMES or manifest['calculators'] != sorted(CALCULATORS):
+        failures.append('feature bundle: {}, manifest {}'.format(layout_names(directory), manifest))
+
+    state = RunState(os.path.join(work_dir, 'resume_run'))
+    state.add({PATIENT: 'key'}, found)
+    if sorted(state.verify({PATIENT: 'key'}).get(PATIENT, {})) != sorted(CALCULATORS):
+        failures.append('resume state: {}'.format(state.features))
+    directory = state.features_directory([PATIENT])
+    if layout_names(directory) != EXPECTED_NAMES:
+        failures.append('resume layout: {}'.format(layout_names(directory)))
+    return failures
+
+
+if __name__ == '__main__':
+    FAILURES = check()
+    logger.flush()
+    if FAILURES:
+        print('\n'.join(['Feature files dropped:'] + FAILURES))
+        sys.exit(1)
+    print('The {} calculators of patient {} are kept everywhere'.format(len(CALCULATORS), PATIENT))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Import-time regression check for the VRE entry points.
+
+Validation jobs launched by the VRE portal only parse the configuration, so
+importing VRE_RUNNER and the modules it reaches must stay cheap. Each module is
+imported in a fresh interpreter with ``python -X importtime``; the check fails
+when a module pulls in one of the heavy packages below at import time, or when
+its import takes longer than the budget.
+
+Example
+-------
+    python benchmarks/check_import_time.py
+    python benchmarks/check_import_time.py --budget 0.5 --repeat 5
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules imported on the validation path, and by the toolbox before WORC runs
+MODULES = [
+    'VRE_RUNNER',
+    'apps.jsonapp',
+    'tool.VRE_Tool',
+    'tool.load_vre_configs',
+    'tool.ml_toolbox',
+    'utils.image_utils',
+    'utils.logger',
+]
+
+# Packages that must only be imported on first use
+HEAVY_PACKAGES = ['WORC', 'fastr', 'pandas', 'matplotlib', 'cv2', 'skimage', 'scipy', 'nibabel', 'tensorflow',
+                  'torch']
+
+
+def import_profile(module):
+    """
+    Import a module in a fresh interpreter
+
+    :return: (total import time in seconds, set of top-level packages imported)
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                            cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=False)
+    if result.returncode != 0:
+        raise RuntimeError('import {} failed:\n{}'.format(module, result.stderr))
+
+    total_us = 0
+    packages = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Only top-level entries (no indentation) add up to the total
+        if not name[1:].startswith(' '):
+            total_us += int(cumulative)
+        packages.add(name.strip().split('.')[0])
+    return total_us / 1e6, packages
+
+
+def check(modules, budget, repeat):
+    """
+    :return: The list of failures found
+    """
+    failures = []
+    for module in modules:
+        profiles = [import_profile(module) for _ in range(repeat)]
+        seconds = min(profile[0] for profile in profiles)
+        heavy = sorted(set(HEAVY_PACKAGES) & profiles[0][1])
+        status = 'ok'
+        if heavy:
+            status = 'FAIL'
+            failures.append('{}: imports {} at import time'.format(module, ', '.join(heavy)))
+        if seconds > budget:
+            status = 'FAIL'
+            failures.append('{}: import takes {:.3f} s (budget {:.3f} s)'.format(module, seconds, budget))
+        print('{:<28} {:7.3f} s  {}'.format(module, seconds, status))
+    return failures
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Check the import time of the VRE entry points')
+    PARSER.add_argument('--budget', type=float, default=1.0, help='Maximum import time per module in seconds')
+    PARSER.add_argument('--repeat', type=int, default=3, help='Imports per module, the fastest is kept')
+    PARSER.add_argument('--modules', nargs='*', default=MODULES, help='Modules to check')
+
+    ARGS = PARSER.parse_args()
+
+    FAILURES = check(ARGS.modules, ARGS.budget, ARGS.repeat)
+    if FAILURES:
+        print('\n'.join(['Import-time regressions:'] + FAILURES))
+        sys.exit(1)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Resume regression check (Toolbox:Resume).
+
+Runs the toolbox twice in the same execution folder, on the same inputs and
+with the toolbox preprocessing on (CropToROI and resampling), and fails unless
+the second run extracts no patient. WORC is replaced by a minimal stand-in
+that writes the feature files of two calculators per patient and records the
+patients it was given, so the check runs without WORC or fastr installed.
+
+Example
+-------
+    python benchmarks/check_resume.py
+    python benchmarks/check_resume.py --patients 8
+"""
+
+import argparse
+import os
+import struct
+import sys
+import tempfile
+import types
+
+import nibabel as nib
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils import logger  # noqa: E402 pylint: disable=wrong-import-position
+
+# Feature calculators of the stand-in, as WORC names them (features_<calculator>_<patient>.hdf5)
+CALCULATORS = ('predict_CT_0', 'pyradiomics_CT_0')
+
+ARGUMENTS = {
+    'General:General:Imagetype': 'CT',
+    'General:Toolbox:Resume': 'on',
+    'General:Toolbox:CropToROI': 'on',
+    'General:Toolbox:ExecutionBackend': 'serial',
+    'General:Preprocessing:Resampling': 'on',
+    'General:Preprocessing:Resampling_spacing': '1, 1, 2',
+}
+
+
+def hdf5_stub(payload):
+    """
+    Bytes with a complete HDF5 version 2 superblock (see tool.resume.hdf5_complete)
+    """
+    size = 48 + len(payload)
+    return b'\x89HDF\r\n\x1a\n' + bytes([2, 8, 8, 0]) + \
+        struct.pack('<4Q', 0, 0xFFFFFFFFFFFFFFFF, size, 48) + b'\0' * 4 + payload
+
+
+class StandInWORC(object):
+    """
+    The parts of WORC.BasicWORC used by the toolbox; execute() writes the feature sinks
+    """
+    extracted = []
+
+    def __init__(self, name):
+        self.name = name
+        self._worc = types.SimpleNamespace()
+        self.images_train = None
+        self.tmpdir = None
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+    def set_tmpdir(self, tmpdir):
+        self.tmpdir = tmpdir
+
+    def execute(self):
+        out = os.path.join(os.path.dirname(self.tmpdir), 'outputs', self.name, 'Features')
+        os.makedirs(out, exist_ok=True)
+        for pid in self.images_train[0] if self.images_train else ():
+            StandInWORC.extracted.append(pid)
+            for calculator in CALCULATORS:
+                with open(os.path.join(out, 'features_{}_{}.hdf5'.format(calculator, pid)), 'wb') as f:
+                    f.write(hdf5_stub('{} {}'.format(calculator, pid).encode()))
+
+
+def make_inputs(data_dir, n_patients):
+    """
+    :return: (images, segmentations, label file)
+    """
+    rng = np.random.RandomState(0)
+    images, segmentations = [], []
+    affine = np.diag([0.8, 0.8, 2.5, 1])
+    for index in range(n_patients):
+        pid = 'P{:03d}'.format(index)
+        mask = np.zeros((24, 24, 8), dtype=np.uint8)
+        mask[6:16, 8:18, 2:6] = 1
+        images.append(os.path.join(data_dir, pid + '_image.nii.gz'))
+        segmentations.append(os.path.join(data_dir, pid + '_mask.nii.gz'))
+        nib.save(nib.Nifti1Image(rng.rand(24, 24, 8).astype(np.float32), affine), images[-1])
+        nib.save(nib.Nifti1Image(mask, affine), segmentations[-1])
+    label_file = os.path.join(data_dir, 'labels.txt')
+    with open(label_file, 'w') as f:
+        f.write('Patient,imaginary_label_1\n')
+        f.writelines('P{:03d},{}\n'.format(index, index % 2) for index in range(n_patients))
+    return images, segmentations, label_file
+
+
+def check(n_patients):
+    """
+    :return: (patients extracted by the first run, by the second run)
+    """
+    sys.modules['WORC'] = types.SimpleNamespace(BasicWORC=StandInWORC)
+    from tool.ml_toolbox import run_ml_toolbox  # pylint: disable=import-outside-toplevel
+
+    work_dir = tempfile.mkdtemp(prefix='check_resume_')
+    data_dir, out_dir = os.path.join(work_dir, 'data'), os.path.join(work_dir, 'run')
+    os.makedirs(data_dir)
+    os.makedirs(out_dir)
+    images, segmentations, label_file = make_inputs(data_dir, n_patients)
+
+    extracted = []
+    for _ in range(2):
+        StandInWORC.extracted = []
+        run_ml_toolbox({}, images, segmentations, label_file, out_dir, dict(ARGUMENTS))
+        extracted.append(sorted(StandInWORC.extracted))
+    return extracted
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Check that a resumed run does not extract the features again')
+    PARSER.add_argument('--patients', type=int, default=4, help='Patients of the synthetic cohort')
+
+    ARGS = PARSER.parse_args()
+
+    FIRST, SECOND = check(ARGS.patients)
+    logger.flush()
+    print('First run extracted {} patients, second run {}'.format(len(FIRST), len(SECOND)))
+    if len(FIRST) != ARGS.patients or SECOND:
+        print('Resume regression: the second run extracted {}'.format(', '.join(SECOND) or 'nothing'))
+        sys.exit(1)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the image_utils, utils_nii and archive hot paths.
+
+Synthetic CT-like volumes and masks of configurable size are generated, each
+helper is timed over several repeats and its peak traced memory is measured
+with tracemalloc (numpy reports its allocations to it) in a separate, untimed
+run. Results are written as JSON; --compare flags regressions against a
+stored baseline.
+
+Example
+-------
+    python benchmarks/run_benchmarks.py --shape 256 256 96 --output baseline.json
+    python benchmarks/run_benchmarks.py --shape 256 256 96 --compare baseline.json
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import archive  # noqa: E402  pylint: disable=wrong-import-position
+from utils import image_utils  # noqa: E402  pylint: disable=wrong-import-position
+from utils import logger  # noqa: E402  pylint: disable=wrong-import-position
+from utils import utils_nii  # noqa: E402  pylint: disable=wrong-import-position
+
+
+def synthetic_ct(shape, seed=0):
+    """
+    CT-like volume in HU: air around an elliptic body of soft tissue with a
+    bony ring and noise, stored as int16 like most CT exports.
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    radius = sum(((g - n / 2.0) / (0.4 * n)) ** 2 for g, n in zip(grid[:2], shape[:2]))
+    volume = np.full(shape, -1000.0, dtype=np.float32)
+    volume[np.broadcast_to(radius < 1.0, shape)] = 40.0
+    volume[np.broadcast_to((radius > 0.8) & (radius < 0.9), shape)] = 700.0
+    volume += rng.normal(0.0, 20.0, shape).astype(np.float32)
+    return volume.astype(np.int16)
+
+
+def synthetic_mask(shape, seed=0):
+    """
+    Mask with three labelled ellipsoids plus small spurious blobs per label,
+    so the connected component filter has work to do.
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    mask = np.zeros(shape, dtype=np.uint8)
+    for label in (1, 2, 3):
+        centre = [n * f for n, f in zip(shape, rng.uniform(0.3, 0.7, len(shape)))]
+        radius = sum(((g - c) / (0.08 * n)) ** 2 for g, c, n in zip(grid, centre, shape))
+        mask[radius < 1.0] = label
+        for _ in range(5):
+            spot = tuple(int(rng.integers(0, n - 2)) for n in shape)
+            mask[tuple(slice(s, s + 2) for s in spot)] = label
+    return mask
+
+
+def measure_case(func, repeat):
+    """
+    Run func `repeat` times after one warm-up call; return timing statistics
+    and the peak traced memory. The peak comes from one more, untimed call:
+    tracing every allocation would slow down the timed ones
+    """
+    func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'time_min_s': min(times),
+        'time_median_s': statistics.median(times),
+        'peak_bytes': peak,
+    }
+
+
+def build_cases(shape, batch, workdir):
+    """
+    Benchmark cases: name -> zero-argument callable
+    """
+    volume = synthetic_ct(shape)
+    mask = synthetic_mask(shape)
+    batch_volumes = np.stack([synthetic_ct(shape, seed) for seed in range(batch)])
+    image2d = volume[:, :, shape[2] // 2].astype(np.float32)
+    affine = np.eye(4)
+
+    nii_path = os.path.join(workdir, 'volume.nii.gz')
+    utils_nii.save_nii(nii_path, volume, affine, None)
+
+    # Results-like folder: an already compressed image and a compressible table
+    archive_dir = os.path.join(workdir, 'outputs')
+    os.makedirs(archive_dir)
+    utils_nii.save_nii(os.path.join(archive_dir, 'volume.nii.gz'), volume, affine, None)
+    np.savetxt(os.path.join(archive_dir, 'volume.csv'), volume[:, :, shape[2] // 2], fmt='%d', delimiter=',')
+
+    cases = {
+        'normalise_images': lambda: image_utils.normalise_images(batch_volumes),
+        'normalise_image': lambda: image_utils.normalise_image(volume),
+        'keep_largest_connected_components': lambda: image_utils.keep_largest_connected_components(mask),
+        'convert_to_uint8': lambda: image_utils.convert_to_uint8(volume),
+        'save_nii': lambda: utils_nii.save_nii(os.path.join(workdir, 'out.nii.gz'), volume, affine, None),
+        'load_nii': lambda: utils_nii.load_nii(nii_path),
+        'iter_slices_axial': lambda: sum(1 for _ in utils_nii.iter_slices(nii_path, 'axial')),
+        'iter_slices_sagittal': lambda: sum(1 for _ in utils_nii.iter_slices(nii_path, 'sagittal')),
+        'archive_folder': lambda: archive.archive_folder(os.path.join(workdir, 'outputs.zip'), archive_dir),
+    }
+    if importlib.util.find_spec('cv2') is not None:  # The augmentation functions need OpenCV
+        cases.update({
+            'rotate_image': lambda: image_utils.rotate_image(image2d, 15),
+            'resize_image': lambda: image_utils.resize_image(image2d, (shape[0] // 2, shape[1] // 2)),
+            'shear_image': lambda: image_utils.shear_image(image2d, rng=np.random.default_rng(0)),
+            'rotate_shear_resize_chain': lambda: image_utils.resize_image(
+                image_utils.shear_image(image_utils.rotate_image(image2d, 15), rng=np.random.default_rng(0)),
+                (shape[0] // 2, shape[1] // 2)),
+            'affine_augmentation_volume': lambda: image_utils.AffineAugmentation(
+                max_angle=15, max_shear=0.2, size=(shape[0] // 2, shape[1] // 2)).augment_volume(
+                    volume.astype(np.float32), np.random.default_rng(0)),
+        })
+    return cases
+
+
+def run(shape, batch, repeat, only=None):
+    """
+    Run every benchmark case and return the JSON-serialisable report
+    """
+    report = {
+        'meta': {
+            'shape': list(shape),
+            'batch': batch,
+            'repeat': repeat,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, func in build_cases(shape, batch, workdir).items():
+            if only and name not in only:
+                continue
+            try:
+                result = measure_case(func, repeat)
+            except Exception as error:  # pylint: disable=broad-except
+                result = {'error': '{}: {}'.format(type(error).__name__, str(error).splitlines()[0])}
+            report['results'][name] = result
+            logger.flush()  # Messages logged by the case (e.g. archive_folder) come first
+            print('{:<36} {}'.format(name, _format_result(result)))
+    return report
+
+
+def _format_result(result):
+    if 'error' in result:
+        return 'ERROR ' + result['error']
+    return '{:9.4f} s (min {:.4f} s)  peak {:8.1f} MiB'.format(
+        result['time_median_s'], result['time_min_s'], result['peak_bytes'] / 1024 ** 2)
+
+
+def compare(report, baseline, tolerance):
+    """
+    Compare a report with a baseline; return the list of regressions found.
+    A case regresses when its median time or peak memory exceeds the baseline
+    by more than `tolerance` (relative), or when it fails where it used to work.
+    """
+    if report['meta']['shape'] != baseline['meta']['shape']:
+        print('WARNING: comparing shape {} against baseline shape {}'.format(
+            report['meta']['shape'], baseline['meta']['shape']))
+
+    regressions = []
+    for name, base in baseline['results'].items():
+        current = report['results'].get(name)
+        if current is None or 'error' in base:
+            continue
+        if 'error' in current:
+            regressions.append('{}: now fails ({})'.format(name, current['error']))
+            continue
+        for key in ('time_median_s', 'peak_bytes'):
+            ratio = current[key] / base[key] if base[key] else 1.0
+            status = 'REGRESSION' if ratio > 1.0 + tolerance else 'ok'
+            print('{:<36} {:<14} x{:6.2f}  {}'.format(name, key, ratio, status))
+            if status != 'ok':
+                regressions.append('{}: {} x{:.2f} of baseline'.format(name, key, ratio))
+    return regressions
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Benchmark the image_utils and utils_nii hot paths')
+    PARSER.add_argument('--shape', type=int, nargs=3, default=[256, 256, 64], help='Volume shape')
+    PARSER.add_argument('--batch', type=int, default=4, help='Batch size for normalise_images')
+    PARSER.add_argument('--repeat', type=int, default=3, help='Repeats per case')
+    PARSER.add_argument('--only', nargs='*', help='Only run these cases')
+    PARSER.add_argument('--output', help='Write the JSON report to this file')
+    PARSER.add_argument('--compare', help='Baseline JSON report to compare against')
+    PARSER.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative slowdown / memory growth before flagging a regression')
+
+    ARGS = PARSER.parse_args()
+
+    REPORT = run(tuple(ARGS.shape), ARGS.batch, ARGS.repeat, ARGS.only)
+
+    if ARGS.output:
+        with open(ARGS.output, 'w') as f:
+            json.dump(REPORT, f, indent=4)
+
+    if ARGS.compare:
+        with open(ARGS.compare) as f:
+            BASELINE = json.load(f)
+        REGRESSIONS = compare(REPORT, BASELINE, ARGS.tolerance)
+        if REGRESSIONS:
+            print('\n'.join(['Regressions:'] + REGRESSIONS))
+            sys.exit(1)
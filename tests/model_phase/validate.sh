@@ -0,0 +1,13 @@
+#!/bin/bash
+
+###
+### Validation only (VRE_RUNNER --validate-only) of a model phase run:
+### a feature bundle of an extract phase run and the label file, no images
+###
+
+CWD="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
+
+# The input paths of in_metadata.json are relative to the repository root
+cd $CWD/../..
+
+./VRE_RUNNER --config tests/model_phase/config.json --in_metadata tests/model_phase/in_metadata.json --validate-only
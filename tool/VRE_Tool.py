@@ -24,6 +24,8 @@ from pathlib import Path
 from basic_modules.metadata import Metadata
 from basic_modules.tool import Tool
 # from tool.ml_toolbox import run_ml_toolbox
+from tool.execution import FASTR_CONFIG_FILE, get_execution_backend
+from tool.load_vre_configs import build_config
 from utils import logger
 
 class MLToolboxRunner(Tool):
@@ -55,6 +57,62 @@ class MLToolboxRunner(Tool):
 
         self.populable_outputs = []
     
+    REQUIRED_INPUTS = ('images', 'segmentations', 'label_file')
+    # The model phase (Toolbox:Phase) starts from the feature bundle of an extract phase
+    MODEL_PHASE_INPUTS = ('features', 'label_file')
+
+    # VRE data type of each output role
+    OUTPUT_DATA_TYPES = {
+        'results': 'sample_information_file',
+        'features': 'feature_bundle',
+    }
+
+    @staticmethod
+    def validate(input_files, input_metadata, arguments):
+        """
+        Check the inputs and the arguments without running WORC (VRE_RUNNER --validate-only).
+
+        The input files must exist and the arguments must parse into WORC overrides.
+
+        :param input_files: Input files by role, as given to run
+        :param input_metadata: Matching metadata for each of the files
+        :param arguments: Tool arguments from config.json
+        :return: The parsed overrides
+        :rtype: FrozenConfig
+        """
+        try:
+            config = build_config(arguments)
+        except ValueError as error:
+            raise ValueError("Invalid tool arguments: {}".format(error))
+        from tool.ml_toolbox import get_archive_profile, get_phase  # pylint: disable=import-outside-toplevel
+        phase = get_phase(config)
+        get_archive_profile(config)
+        get_execution_backend(config).check()
+        required = MLToolboxRunner.MODEL_PHASE_INPUTS if phase == 'model' else MLToolboxRunner.REQUIRED_INPUTS
+
+        missing_roles = [role for role in required if role not in input_files]
+        if missing_roles:
+            raise ValueError("Missing input roles: {}".format(', '.join(missing_roles)))
+        if 'output_folder' not in input_metadata:
+            raise ValueError("No execution folder in the arguments")
+
+        missing_files = []
+        for role in required:
+            paths = input_files[role]
+            for path in paths if isinstance(paths, (list, tuple)) else [paths]:
+                if not os.path.isfile(path):
+                    missing_files.append("{}: {}".format(role, path))
+        if missing_files:
+            raise ValueError("Input files not found: {}".format('; '.join(missing_files)))
+
+        if phase == 'model':
+            logger.info("Validated the feature bundle and the tool arguments (phase: model)")
+        else:
+            logger.info("Validated {} images, {} segmentations and the tool arguments (phase: {})".format(
+                len(input_files['images']), len(input_files['segmentations']), phase))
+        return config
+
+    @logger.span('run')
     def run(self, input_files, input_metadata, output_files):
         """
         The main function to run the compute_metrics tool.
@@ -87,6 +145,7 @@ class MLToolboxRunner(Tool):
 
             logger.debug("Init execution of the Segmentation")
             # Prepare file paths
+            images = segmentations = label_file = features_bundle = None
             for key in input_files.keys():
                 if key == 'images':
                     images = input_files[key]
@@ -94,6 +153,8 @@ class MLToolboxRunner(Tool):
                     label_file = input_files[key]
                 elif key == 'segmentations':
                     segmentations = input_files[key]
+                elif key == 'features':
+                    features_bundle = input_files[key]
                 else:
                     logger.debug('Unrecognized key {}'.format(key))
                     continue
@@ -112,31 +173,42 @@ class MLToolboxRunner(Tool):
             worc_tmpdir.mkdir(parents=True, exist_ok=True)
             template = get_config_template(worc_outputs, worc_tmpdir)
             config_file_path = Path(output_folder) / 'config.d' / 'WORC_config.py'
-            print(f'VRE_Tool.py -- DEBUG: Loading config file from {config_file_path}')
+            logger.debug("Loading config file from {}", config_file_path)
             config_file_path.parent.mkdir(parents=True, exist_ok=True)
             with open(config_file_path, 'w') as f:
                 f.write(template)
             logger.debug("Output metadata file: {}".format(config_file_path))
+            config = build_config(input_metadata['arguments'])
+            from tool.resume import RESUME_DIR, STATE_FILE  # pylint: disable=import-outside-toplevel
+            if config['Toolbox'].get('Resume') and os.path.isfile(os.path.join(output_folder, RESUME_DIR, STATE_FILE)):
+                logger.info("Resuming the previous run in {}".format(output_folder))
+            # fastr settings of the execution backend (e.g. the size of the process pool)
+            backend = get_execution_backend(config)
+            backend.check()
+            with open(config_file_path.parent / FASTR_CONFIG_FILE, 'w') as f:
+                f.write(backend.fastr_config())
             
             # Make fastr to look for config file here
             os.environ["FASTRHOME"] = str(config_file_path.parent.parent)
             from tool.ml_toolbox import run_ml_toolbox
             # Run the MLToolbox
-            outputs = run_ml_toolbox(self.configuration, images, segmentations, label_file, input_metadata['output_folder'], input_metadata['arguments'])
+            outputs = run_ml_toolbox(self.configuration, images, segmentations, label_file, input_metadata['output_folder'], input_metadata['arguments'],
+                                     features_bundle=features_bundle)
 
             output_files = []
             out_meta = []
             # TODO parse outputs from run_ml_toolbox
             for _file, _meta in outputs:
                 if os.path.isfile(_file):
+                    role = _meta.get('role', 'results')
                     meta = Metadata()
                     meta.file_path = _file  # Set file_path for output files
-                    meta.data_type = 'sample_information_file'
+                    meta.data_type = self.OUTPUT_DATA_TYPES[role]
                     meta.file_type = 'zip'
                     meta.meta_data = _meta
                     out_meta.append(meta)
                     output_files.append({
-                        'name': 'results', 'file_path': _file
+                        'name': role, 'file_path': _file
                     })
                 else:
                     logger.warning("Output not found. Path \"{}\" does not exist".format(_file))
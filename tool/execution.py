@@ -0,0 +1,138 @@
+"""
+Execution backends of the WORC experiment.
+
+A backend picks the fastr execution plugin that runs the WORC network and the
+fastr settings that size it. It is selected with Toolbox:ExecutionBackend:
+
+    local   ProcessPoolExecution on this node, Toolbox:Cores workers (default:
+            the CPUs available to the process, from the affinity mask and the
+            cgroup quota, not every CPU of the node)
+    serial  LinearExecution, one job at a time; for debugging
+    slurm   SlurmExecution, every job submitted with sbatch (Toolbox:SlurmPartition).
+            sbatch / squeue / scancel are looked up on PATH, so a fake sbatch
+            on PATH is enough to exercise it without a cluster
+"""
+
+import shutil
+
+from utils import logger
+from utils.utils_gen import available_cpus
+
+# Name of the fastr configuration file written by the backend (in the config.d folder of FASTRHOME)
+FASTR_CONFIG_FILE = 'execution.py'
+
+
+class ExecutionBackend(object):
+    """
+    Base backend: the fastr plugin and settings, and the threads the toolbox may use on this node
+    """
+    name = None
+    fastr_plugin = None
+
+    def __init__(self, cores=None):
+        """
+        :param cores: Workers / threads used on this node, None for the CPUs available to the process
+        """
+        self.cores = cores or available_cpus()
+
+    def check(self):
+        """
+        Raise ValueError if the backend cannot run here
+        """
+
+    def fastr_settings(self):
+        """
+        fastr configuration values of the backend
+        """
+        return {}
+
+    def fastr_config(self):
+        """
+        fastr configuration file setting fastr_settings()
+        """
+        lines = ['# THIS IS AN AUTOMATICALLY GENERATED FILE. ALL CHANGES WILL BE OVERWRITTEN.',
+                 '# Execution backend: {}'.format(self.name)]
+        lines += ['{} = {!r}'.format(key, value) for key, value in sorted(self.fastr_settings().items())]
+        return '\n'.join(lines) + '\n'
+
+    def apply(self, experiment):
+        """
+        Select the fastr plugin of a BasicWORC experiment
+        """
+        # SimpleWORC only exposes set_multicore_execution; the plugin lives on the WORC object
+        experiment._worc.fastr_plugin = self.fastr_plugin  # pylint: disable=protected-access
+        logger.info("Execution backend: {} ({}, {} cores)", self.name, self.fastr_plugin, self.cores)
+
+
+class SerialBackend(ExecutionBackend):
+    """
+    One fastr job at a time, in this process
+    """
+    name = 'serial'
+    fastr_plugin = 'LinearExecution'
+
+    def __init__(self, cores=None):
+        super(SerialBackend, self).__init__(cores=1)
+
+
+class LocalBackend(ExecutionBackend):
+    """
+    Pool of cores worker processes on this node
+    """
+    name = 'local'
+    fastr_plugin = 'ProcessPoolExecution'
+
+    def fastr_settings(self):
+        return {'process_pool_worker_number': self.cores}
+
+    def apply(self, experiment):
+        experiment.set_multicore_execution()
+        logger.info("Execution backend: {} ({}, {} cores)", self.name, self.fastr_plugin, self.cores)
+
+
+class SlurmBackend(ExecutionBackend):
+    """
+    Every fastr job submitted to SLURM with sbatch
+    """
+    name = 'slurm'
+    fastr_plugin = 'SlurmExecution'
+    COMMANDS = ('sbatch', 'squeue', 'scancel')
+
+    def __init__(self, cores=None, partition=None):
+        """
+        :param cores: Threads of the toolbox itself (e.g. archiving) on the submitting node
+        :param partition: SLURM partition of the jobs, None for the cluster default
+        """
+        super(SlurmBackend, self).__init__(cores)
+        self.partition = partition
+
+    def check(self):
+        missing = [command for command in self.COMMANDS if shutil.which(command) is None]
+        if missing:
+            raise ValueError('Execution backend slurm: {} not found on PATH'.format(', '.join(missing)))
+
+    def fastr_settings(self):
+        return {'slurm_partition': self.partition} if self.partition else {}
+
+
+EXECUTION_BACKENDS = {backend.name: backend for backend in (LocalBackend, SerialBackend, SlurmBackend)}
+
+
+def get_execution_backend(config):
+    """
+    Backend selected by the Toolbox:ExecutionBackend, Toolbox:Cores and Toolbox:SlurmPartition
+    arguments (Cores 0 uses the available CPUs)
+
+    :param config: FrozenConfig of the experiment
+    """
+    toolbox = config['Toolbox']
+    name = toolbox['ExecutionBackend']
+    if name not in EXECUTION_BACKENDS:
+        raise ValueError('Unknown Toolbox:ExecutionBackend {!r}, expected one of {}'.format(
+            name, ', '.join(sorted(EXECUTION_BACKENDS))))
+    cores = toolbox['Cores'] or None
+    if cores is not None and cores < 0:
+        raise ValueError('Toolbox:Cores must be positive, got {}'.format(cores))
+    if name == 'slurm':
+        return SlurmBackend(cores, partition=toolbox['SlurmPartition'] or None)
+    return EXECUTION_BACKENDS[name](cores)
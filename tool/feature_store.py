@@ -0,0 +1,401 @@
+"""
+Persistent per-patient store of the radiomics features extracted by WORC.
+
+Features are keyed by the content of the image and the mask given to WORC
+and by the settings that change them (image type, Preprocessing,
+ImageFeatures and PyRadiomics), so an experiment that only changes e.g. the
+classifiers or the cross-validation reuses the features of earlier runs.
+WORC writes one feature file per feature calculator (e.g. PREDICT and
+PyRadiomics) and patient; an entry holds all of them. Entries are evicted once unused for longer than max_age, then least
+recently used first while the store is over max_bytes.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import zipfile
+from glob import escape, glob
+
+from tool.load_vre_configs import FrozenConfig
+from tool.preprocessing import patient_id
+from utils import logger
+from utils.nii_cache import ContentHasher
+
+# Environment variables configuring the default store
+STORE_DIR_ENV = 'MLTOOLBOX_FEATURE_STORE'
+STORE_BYTES_ENV = 'MLTOOLBOX_FEATURE_STORE_BYTES'
+STORE_MAX_AGE_ENV = 'MLTOOLBOX_FEATURE_STORE_MAX_AGE_DAYS'
+DEFAULT_STORE_BYTES = 50 * 1024 ** 3
+DEFAULT_MAX_AGE_DAYS = 90
+
+# Settings the extracted features depend on
+FEATURE_SETTINGS = ('image_types', 'Preprocessing', 'ImageFeatures', 'PyRadiomics')
+
+# General settings the extracted features depend on, as they change the masks
+# (Segmentix) or how the masks are laid onto the images
+FEATURE_GENERAL_SETTINGS = ('Segmentix', 'AssumeSameImageAndMaskMetadata')
+
+# Name of the feature file of each calculator of a patient in the folders given to WORC
+FEATURE_FILE_TEMPLATE = 'features_{}.hdf5'
+
+# Metadata file of a store entry
+ENTRY_METADATA = 'entry.json'
+
+BUNDLE_VERSION = 2
+BUNDLE_MANIFEST = 'manifest.json'
+
+_default_store = None
+
+
+def feature_settings(config):
+    """
+    FrozenConfig of the FEATURE_SETTINGS sections and the FEATURE_GENERAL_SETTINGS of a config
+    """
+    settings = config.section(*FEATURE_SETTINGS).to_dict()
+    settings['General'] = config['General'].section(*FEATURE_GENERAL_SETTINGS).to_dict()
+    return FrozenConfig(settings)
+
+
+def feature_key(hasher, image, mask, config):
+    """
+    Key of the features of an image/mask pair extracted with a config
+
+    :param hasher: ContentHasher of the image and mask files
+    :param config: FrozenConfig of the experiment, only its feature_settings are used
+    """
+    content = json.dumps({
+        'image': hasher(image),
+        'mask': hasher(mask),
+        'config': feature_settings(config).digest(),
+    }, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def feature_calculator(path, pid):
+    """
+    Name of the calculator of a feature file written by WORC: its file name without
+    the features_ prefix and the patient part, e.g. predict_CT_0 for
+    features_predict_CT_0_<patient>.hdf5
+    """
+    parts = os.path.basename(path)[:-len('.hdf5')].split('_')[1:]
+    return '_'.join(part for part in parts if part != pid) or 'features'
+
+
+def link_feature_files(feature_files, dest_dir):
+    """
+    Hard link (or copy, across file systems) the feature files of a patient into dest_dir,
+    named FEATURE_FILE_TEMPLATE after their calculator
+
+    :param feature_files: dict calculator -> feature file
+    :return: dict calculator -> file in dest_dir
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    linked = {}
+    for calculator, path in sorted(feature_files.items()):
+        dest = os.path.join(dest_dir, FEATURE_FILE_TEMPLATE.format(calculator))
+        if os.path.exists(dest):
+            os.unlink(dest)
+        try:
+            os.link(path, dest)
+        except OSError:
+            shutil.copyfile(path, dest)
+        linked[calculator] = dest
+    return linked
+
+
+def feature_file_names(directory):
+    """
+    Names of the feature files in a folder laid out for WORC (<patient>/features_<calculator>.hdf5),
+    one per calculator: each is given to features_from_this_directory
+    """
+    names = set()
+    for entry in os.scandir(directory):
+        if entry.is_dir():
+            names.update(name for name in os.listdir(entry.path) if name.endswith('.hdf5'))
+    return sorted(names)
+
+
+def _remove_tree(path):
+    """
+    Remove a folder as a whole: it is renamed first, so it is never seen half removed
+    """
+    trash = '{}.{}.removed'.format(path, os.getpid())
+    try:
+        os.rename(path, trash)
+    except FileNotFoundError:
+        return
+    shutil.rmtree(trash, ignore_errors=True)
+
+
+class FeatureStore(object):
+    """
+    Content-addressed store of per-patient feature files: <store_dir>/features/<key>/
+    holds one <calculator>.hdf5 per feature calculator and the entry metadata.
+
+    Entries are published with an atomic rename and their files handed out as hard
+    links, so an entry evicted by another process stays readable by a running experiment.
+    """
+
+    def __init__(self, store_dir, max_bytes=DEFAULT_STORE_BYTES, max_age=DEFAULT_MAX_AGE_DAYS * 86400):
+        """
+        :param store_dir: Folder of the store, may be shared by several runs
+        :param max_bytes: Disk budget of the feature files
+        :param max_age: Seconds after which an unused entry is evicted
+        """
+        self.store_dir = os.path.abspath(store_dir)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.feature_dir = os.path.join(self.store_dir, 'features')
+        os.makedirs(self.feature_dir, exist_ok=True)
+        self.hasher = ContentHasher(os.path.join(self.store_dir, 'stat'))
+
+    def key(self, image, mask, config):
+        """
+        Key of the features of an image/mask pair extracted with a config
+
+        :param config: FrozenConfig of the experiment, only its feature_settings are used
+        """
+        return feature_key(self.hasher, image, mask, config)
+
+    def _path(self, key):
+        return os.path.join(self.feature_dir, key)
+
+    def _entries(self):
+        # Temporary and removed entries start with '.' or end with '.removed'
+        return [entry for entry in os.scandir(self.feature_dir)
+                if not entry.name.startswith('.') and not entry.name.endswith('.removed') and entry.is_dir()]
+
+    @staticmethod
+    def _entry_size(path):
+        try:
+            return sum(entry.stat().st_size for entry in os.scandir(path))
+        except FileNotFoundError:  # Evicted by another process
+            return 0
+
+    def get(self, key):
+        """
+        :return: dict calculator -> stored feature file, None if the key is not in the store
+        """
+        path = self._path(key)
+        try:
+            os.utime(path)  # Mark as recently used
+            names = os.listdir(path)
+        except FileNotFoundError:
+            return None
+        return {name[:-len('.hdf5')]: os.path.join(path, name) for name in sorted(names) if name.endswith('.hdf5')}
+
+    def put(self, key, feature_files, **metadata):
+        """
+        Store the feature files of a patient under a key; metadata (e.g. the patient) is kept with them
+
+        :param feature_files: dict calculator -> feature file
+        :return: dict calculator -> stored feature file
+        """
+        path = self._path(key)
+        tmp_dir = tempfile.mkdtemp(prefix='.{}.'.format(key), dir=self.feature_dir)
+        try:
+            for calculator, feature_file in feature_files.items():
+                shutil.copyfile(feature_file, os.path.join(tmp_dir, calculator + '.hdf5'))
+            metadata.update(key=key, stored=time.time(),
+                            sources={calculator: os.path.abspath(feature_file)
+                                     for calculator, feature_file in feature_files.items()})
+            with open(os.path.join(tmp_dir, ENTRY_METADATA), 'w') as f:
+                json.dump(metadata, f)
+            _remove_tree(path)  # Stored again: the new files replace the previous entry
+            try:
+                os.rename(tmp_dir, path)
+            except OSError:  # Stored meanwhile by another process, with the same key
+                pass
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict(keep=path)
+        return self.get(key)
+
+    def link(self, key, dest_dir):
+        """
+        Hard link (or copy) the stored feature files of a key into dest_dir (see link_feature_files)
+
+        :return: dict calculator -> file in dest_dir
+        """
+        feature_files = self.get(key)
+        if feature_files is None:
+            raise FileNotFoundError('No entry {} in the feature store {}'.format(key, self.store_dir))
+        return link_feature_files(feature_files, dest_dir)
+
+    def size(self):
+        """
+        Bytes used by the stored entries
+        """
+        return sum(self._entry_size(entry.path) for entry in self._entries())
+
+    def evict(self, keep=None):
+        """
+        Remove the entries unused for longer than max_age, then the least recently
+        used ones until the store fits in max_bytes
+
+        :param keep: Path that must not be evicted (the entry just stored)
+        """
+        entries = []
+        for entry in self._entries():
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:  # Evicted by another process
+                continue
+            entries.append((mtime, self._entry_size(entry.path), entry.path))
+
+        now = time.time()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if path == keep:
+                continue
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                break
+            _remove_tree(path)
+            total -= size
+
+
+def get_default_store():
+    """
+    Store configured through the MLTOOLBOX_FEATURE_STORE, MLTOOLBOX_FEATURE_STORE_BYTES and
+    MLTOOLBOX_FEATURE_STORE_MAX_AGE_DAYS environment variables, or None if no folder is set
+    """
+    global _default_store  # pylint: disable=global-statement
+    store_dir = os.environ.get(STORE_DIR_ENV)
+    if not store_dir:
+        return None
+    if _default_store is None or _default_store.store_dir != os.path.abspath(store_dir):
+        max_bytes = int(os.environ.get(STORE_BYTES_ENV, DEFAULT_STORE_BYTES))
+        max_age = float(os.environ.get(STORE_MAX_AGE_ENV, DEFAULT_MAX_AGE_DAYS)) * 86400
+        _default_store = FeatureStore(store_dir, max_bytes, max_age)
+    return _default_store
+
+
+def plan_features(store, config, images, segmentations):
+    """
+    Look up the features of every patient in the store
+
+    :return: (keys, cached): dicts patient -> key and patient -> {calculator: stored feature file}
+    """
+    masks = {patient_id(path): path for path in segmentations}
+    keys, cached = {}, {}
+    for image in images:
+        pid = patient_id(image)
+        keys[pid] = store.key(image, masks[pid], config)
+        feature_files = store.get(keys[pid])
+        if feature_files:
+            cached[pid] = feature_files
+    logger.info("Feature store: {} of {} patients cached", len(cached), len(keys))
+    return keys, cached
+
+
+def features_directory(store, keys, out_dir):
+    """
+    Lay the stored features out as WORC's features_from_this_directory expects:
+    <out_dir>/features/<patient>/features_<calculator>.hdf5
+
+    :return: The folder to give to features_from_this_directory (see feature_file_names)
+    """
+    directory = os.path.join(out_dir, 'features')
+    shutil.rmtree(directory, ignore_errors=True)
+    for pid, key in keys.items():
+        store.link(key, os.path.join(directory, pid))
+    return directory
+
+
+def find_feature_files(worc_output_dir, patients):
+    """
+    Feature files written by a WORC experiment
+
+    WORC writes one features_*.hdf5 per feature calculator and patient under
+    <output>/<experiment>/Features, with the patient ID as one of the '_' separated
+    parts of the file name.
+    :return: dict patient -> {calculator: feature file}, for the patients found
+    """
+    pattern = os.path.join(escape(worc_output_dir), 'Features', '**', 'features_*.hdf5')
+    files = sorted(glob(pattern, recursive=True))
+    found = {}
+    for pid in patients:
+        matches = [path for path in files if pid in re.split(r'[_.]', os.path.basename(path))]
+        if not matches:
+            logger.warning("No features found for patient {}", pid)
+            continue
+        found[pid] = {}
+        for path in matches:
+            calculator = feature_calculator(path, pid)
+            if calculator in found[pid]:
+                logger.warning("Two {} feature files for patient {}, using {}", calculator, pid,
+                               found[pid][calculator])
+                continue
+            found[pid][calculator] = path
+    return found
+
+
+def harvest_features(store, keys, worc_output_dir):
+    """
+    Store the feature files written by a WORC experiment
+
+    :return: Number of patients stored
+    """
+    found = find_feature_files(worc_output_dir, keys)
+    for pid, feature_files in found.items():
+        store.put(keys[pid], feature_files, patient=pid)
+    logger.info("Feature store: stored the features of {} patients", len(found))
+    return len(found)
+
+
+def write_feature_bundle(bundle_path, feature_files, config):
+    """
+    Write a feature bundle: a zip with <patient>/features_<calculator>.hdf5 per patient
+    and calculator, and a manifest recording the feature settings they were extracted with
+
+    :param feature_files: dict patient -> {calculator: feature file}
+    :param config: FrozenConfig of the experiment
+    :return: bundle_path
+    """
+    manifest = {
+        'version': BUNDLE_VERSION,
+        'patients': sorted(feature_files),
+        'calculators': sorted({calculator for files in feature_files.values() for calculator in files}),
+        'settings': feature_settings(config).to_dict(),
+        'settings_digest': feature_settings(config).digest(),
+    }
+    tmp_path = '{}.{}.tmp'.format(bundle_path, os.getpid())
+    try:
+        # hdf5 feature files are small and compress well
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as bundle:
+            bundle.writestr(BUNDLE_MANIFEST, json.dumps(manifest, indent=1))
+            for pid, files in sorted(feature_files.items()):
+                for calculator, path in sorted(files.items()):
+                    bundle.write(path, '{}/{}'.format(pid, FEATURE_FILE_TEMPLATE.format(calculator)))
+        os.replace(tmp_path, bundle_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return bundle_path
+
+
+def read_feature_bundle(bundle_path, out_dir):
+    """
+    Unpack a feature bundle as WORC's features_from_this_directory expects
+
+    :return: (folder to give to features_from_this_directory, manifest)
+    :raise ValueError: Not a feature bundle
+    """
+    directory = os.path.join(out_dir, 'features')
+    with zipfile.ZipFile(bundle_path) as bundle:
+        try:
+            manifest = json.loads(bundle.read(BUNDLE_MANIFEST))
+        except KeyError:
+            raise ValueError('{} is not a feature bundle (no {})'.format(bundle_path, BUNDLE_MANIFEST))
+        if manifest.get('version') != BUNDLE_VERSION:
+            raise ValueError('Unsupported feature bundle version {}'.format(manifest.get('version')))
+        patients = set(manifest['patients'])
+        members = [name for name in bundle.namelist() if name.split('/')[0] in patients and name.endswith('.hdf5')]
+        shutil.rmtree(directory, ignore_errors=True)
+        bundle.extractall(directory, members)
+    return directory, manifest
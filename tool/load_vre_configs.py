@@ -1,156 +1,281 @@
+import hashlib
+import json
+import os
+from collections.abc import Mapping
 from configparser import ConfigParser
-from ast import literal_eval
 import pprint
 
-from matplotlib.pyplot import isinteractive
+from utils import logger
 
-def get_default_configs():
-    defaults_file = './configs_default.ini'
-    config = ConfigParser()
-    config.read(defaults_file)
-    confdict = {section: dict(config.items(section)) for section in config.sections()}
-    return confdict
+# Defaults shipped next to this module
+DEFAULT_CONFIGS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'configs_default.ini')
+
+# Arguments of config.json that are not tool settings
+MASKED_ARGUMENTS = ('execution', 'project', 'description')
+
+# Every setting of the toolbox: (section, key, type, default). A value in the
+# defaults file replaces the default given here. User arguments are converted
+# to the type of their setting.
+CONFIG_SCHEMA = (
+    ('General', 'Segmentix', bool, True),
+    ('General', 'tempsave', bool, False),
+    ('General', 'AssumeSameImageAndMaskMetadata', bool, False),
+    ('General', 'ComBat', bool, False),
+    ('Preprocessing', 'Normalize', bool, True),
+    ('Preprocessing', 'Clipping', bool, False),
+    ('Preprocessing', 'Clipping_Range', str, '-1000.0, 3000.0'),
+    ('Preprocessing', 'Method', str, 'z_score'),
+    ('Preprocessing', 'Resampling', bool, False),
+    ('Preprocessing', 'Resampling_spacing', str, '1, 1, 1'),
+    ('Preprocessing', 'BiasCorrection', bool, False),
+    ('Toolbox', 'CropToROI', bool, False),
+    ('Toolbox', 'CropMargin', int, 10),
+    ('Toolbox', 'Phase', str, 'full'),
+    ('Toolbox', 'ArchiveProfile', str, 'full'),
+    ('Toolbox', 'ExecutionBackend', str, 'local'),
+    ('Toolbox', 'Cores', int, 0),
+    ('Toolbox', 'SlurmPartition', str, ''),
+    ('Toolbox', 'Resume', bool, False),
+    ('ImageFeatures', 'histogram', bool, True),
+    ('ImageFeatures', 'orientation', bool, True),
+    ('ImageFeatures', 'texture_Gabor', bool, False),
+    ('ImageFeatures', 'texture_LBP', bool, True),
+    ('ImageFeatures', 'texture_GLCM', bool, True),
+    ('ImageFeatures', 'texture_GLCMMS', bool, True),
+    ('ImageFeatures', 'vessel', bool, False),
+    ('ImageFeatures', 'log', bool, False),
+    ('ImageFeatures', 'phase', bool, False),
+    ('PyRadiomics', 'extract_shape', bool, True),
+    ('PyRadiomics', 'texture_GLRLM', bool, True),
+    ('PyRadiomics', 'texture_GLSZM', bool, True),
+    ('PyRadiomics', 'texture_GLDM', bool, True),
+    ('PyRadiomics', 'texture_NGTDM', bool, True),
+    ('ComBat', 'batch', str, 'Hospital'),
+    ('Featsel', 'Variance', float, 1.0),
+    ('Featsel', 'SelectFromModel', float, 0.275),
+    ('Featsel', 'UsePCA', float, 0.275),
+    ('Featsel', 'StatisticalTestUse', float, 0.275),
+    ('Featsel', 'ReliefUse', float, 0.275),
+    ('Labels', 'label_names', str, 'imaginary_label_1'),
+    ('Resampling', 'Use', float, 0.2),
+    ('Classification', 'classifiers', str, 'SVM, RF, LR, LDA, QDA, GaussianNB, AdaBoostClassifier, XGBClassifier'),
+    ('CrossValidation', 'Type', str, 'random_split'),
+    ('CrossValidation', 'N_iterations', int, 10),
+    ('CrossValidation', 'test_size', float, 0.2),
+    ('CrossValidation', 'fixed_seed', bool, False),
+    ('HyperOptimization', 'test_size', float, 0.2),
+    ('HyperOptimization', 'n_splits', int, 5),
+    ('HyperOptimization', 'N_iterations', int, 1000),
+    ('HyperOptimization', 'n_jobspercore', int, 500),
+)
+
+# Settings outside the sections, with their defaults before and after the user arguments
+TOP_LEVEL_DEFAULTS = {'modus': 'binary_classification', 'coarse': True, 'experiment_name': 'run000', 'image_types': 'CT'}
+TOP_LEVEL_USER_DEFAULTS = {'modus': '', 'coarse': False, 'experiment_name': 'run000', 'image_types': 'CT'}
+
+_compiled_schemas = {}
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    try:
+        return ConfigParser.BOOLEAN_STATES[str(value).strip().lower()]
+    except KeyError:
+        raise ValueError('not a boolean: {!r}'.format(value))
+
+
+_CONVERTERS = {bool: _to_bool, int: int, float: float, str: str}
+
+
+class CompiledSchema(object):
+    '''
+    CONFIG_SCHEMA with the defaults of a defaults file, resolved once into
+    a converter per setting
+    '''
+
+    def __init__(self, defaults_file):
+        self.defaults_file = defaults_file
+        self.sections = tuple(dict.fromkeys(section for section, _, _, _ in CONFIG_SCHEMA))
+        self.converters = {(section, key): (value_type, _CONVERTERS[value_type])
+                           for section, key, value_type, _ in CONFIG_SCHEMA}
+        self.defaults = {section: {} for section in self.sections}
+        for section, key, _, default in CONFIG_SCHEMA:
+            self.defaults[section][key] = default
+
+        parser = ConfigParser()
+        parser.optionxform = str  # Keys are case sensitive (e.g. N_iterations)
+        if not parser.read(defaults_file):
+            raise ValueError('Cannot read the defaults file {}'.format(defaults_file))
+        # Empty values of the defaults file keep the CONFIG_SCHEMA default
+        for section in parser.sections():
+            for key, value in parser.items(section):
+                self.defaults[section][key] = self.convert(section, key, value)
+
+    def convert(self, section, key, value):
+        '''
+        Converts a raw (string) value to the type of its setting. An empty value
+        (None or '', e.g. an optional VRE field left blank) is unset: it converts
+        to the default of the setting
+        :raise ValueError: Unknown setting or value of the wrong type
+        '''
+        try:
+            value_type, converter = self.converters[(section, key)]
+        except KeyError:
+            raise ValueError('Unknown setting {}:{}'.format(section, key))
+        if isinstance(value, str):
+            value = value.strip()
+        if value is None or value == '':
+            return self.defaults[section][key]
+        try:
+            return converter(value)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid value {!r} for {}:{} (expected {})'.format(
+                value, section, key, value_type.__name__))
+
+
+def compile_schema(file_path=DEFAULT_CONFIGS_FILE):
+    '''
+    CompiledSchema of a defaults file, cached until the file changes (mtime and size)
+    '''
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    cache_key = (file_path, stat.st_mtime_ns, stat.st_size)
+    schema = _compiled_schemas.get(file_path)
+    if schema is None or schema[0] != cache_key:
+        schema = (cache_key, CompiledSchema(file_path))
+        _compiled_schemas[file_path] = schema
+    return schema[1]
+
+
+def _freeze(value):
+    if isinstance(value, Mapping):
+        return FrozenConfig(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class FrozenConfig(Mapping):
+    '''
+    Immutable, hashable config (sections are FrozenConfig as well). Two configs
+    with the same settings compare and hash equal whatever their key order,
+    and digest() is stable across runs, e.g. as a key to reuse results.
+    '''
+
+    def __init__(self, values):
+        self._values = {key: _freeze(value) for key, value in values.items()}
+        self._hash = None
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(sorted(self._values))
+
+    def __len__(self):
+        return len(self._values)
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(tuple((key, self._values[key]) for key in self))
+        return self._hash
+
+    def __repr__(self):
+        return 'FrozenConfig({!r})'.format(self.to_dict())
+
+    def to_dict(self):
+        '''
+        Mutable deep copy, e.g. as WORC overrides
+        '''
+        return {key: value.to_dict() if isinstance(value, FrozenConfig) else
+                list(value) if isinstance(value, tuple) else value
+                for key, value in self._values.items()}
+
+    def section(self, *names):
+        '''
+        FrozenConfig restricted to some sections or keys
+        '''
+        return FrozenConfig({name: self._values[name] for name in names})
+
+    def digest(self):
+        '''
+        sha256 of the canonical JSON form of the config
+        '''
+        canonical = json.dumps(self.to_dict(), sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode()).hexdigest()
 
-def load_default_configs(file_path):
-    configs = {
-        'modus': 'binary_classification',
-        'coarse': True,
-        'experiment_name': 'run000',
-        'image_types': 'CT',
-        'General': dict(),
-        'Preprocessing': dict(),
-        'ImageFeatures': dict(),
-        'PyRadiomics': dict(),
-        'ComBat': dict(),
-        'Featsel': dict(),
-        'Labels': dict(),
-        'Resampling': dict(),
-        'Classification': dict(),
-        'CrossValidation': dict(),
-        'HyperOptimization': dict(),
-    }
-    parser = ConfigParser()
-    parser.read(file_path)
-    configs['General']['Segmentix'] = parser.getboolean('General', 'Segmentix')
-    configs['General']['tempsave'] = parser.getboolean('General', 'tempsave')
-    configs['General']['AssumeSameImageAndMaskMetadata'] = parser.getboolean('General', 'AssumeSameImageAndMaskMetadata')
-    configs['General']['ComBat'] = parser.getboolean('General', 'ComBat')
-    configs['Preprocessing']['Normalize'] = parser.getboolean('Preprocessing', 'Normalize')
-    configs['Preprocessing']['Clipping'] = parser.getboolean('Preprocessing', 'Clipping')
-    configs['Preprocessing']['Clipping_Range'] = parser.get('Preprocessing', 'Clipping_Range')
-    configs['Preprocessing']['Method'] = parser.get('Preprocessing', 'Method')
-    configs['Preprocessing']['Resampling'] = parser.getboolean('Preprocessing', 'Resampling')
-    configs['Preprocessing']['Resampling_spacing'] = parser.get('Preprocessing', 'Resampling_spacing')
-    configs['Preprocessing']['BiasCorrection'] = parser.getboolean('Preprocessing', 'BiasCorrection')
-    configs['ImageFeatures']['histogram'] = parser.getboolean('ImageFeatures', 'histogram')
-    configs['ImageFeatures']['orientation'] = parser.getboolean('ImageFeatures', 'orientation')
-    configs['ImageFeatures']['texture_Gabor'] = parser.getboolean('ImageFeatures', 'texture_Gabor')
-    configs['ImageFeatures']['texture_LBP'] = parser.getboolean('ImageFeatures', 'texture_LBP')
-    configs['ImageFeatures']['texture_GLCM'] = parser.getboolean('ImageFeatures', 'texture_GLCM')
-    configs['ImageFeatures']['texture_GLCMMS'] = parser.getboolean('ImageFeatures', 'texture_GLCMMS')
-    configs['ImageFeatures']['vessel'] = parser.getboolean('ImageFeatures', 'vessel')
-    configs['ImageFeatures']['log'] = parser.getboolean('ImageFeatures', 'log')
-    configs['ImageFeatures']['phase'] = parser.getboolean('ImageFeatures', 'phase')
-    configs['PyRadiomics']['extract_shape'] = parser.getboolean('PyRadiomics', 'extract_shape')
-    configs['PyRadiomics']['texture_GLRLM'] = parser.getboolean('PyRadiomics', 'texture_GLRLM')
-    configs['PyRadiomics']['texture_GLSZM'] = parser.getboolean('PyRadiomics', 'texture_GLSZM')
-    configs['PyRadiomics']['texture_GLDM'] = parser.getboolean('PyRadiomics', 'texture_GLDM')
-    configs['PyRadiomics']['texture_NGTDM'] = parser.getboolean('PyRadiomics', 'texture_NGTDM')
-    configs['ComBat']['batch'] = parser.get('ComBat', 'batch')
-    configs['Featsel']['Variance'] = parser.getfloat('Featsel', 'Variance')
-    configs['Featsel']['SelectFromModel'] = parser.getfloat('Featsel', 'SelectFromModel')
-    configs['Featsel']['UsePCA'] = parser.getfloat('Featsel', 'UsePCA')
-    configs['Featsel']['StatisticalTestUse'] = parser.getfloat('Featsel', 'StatisticalTestUse')
-    configs['Featsel']['ReliefUse'] = parser.getfloat('Featsel', 'ReliefUse')
-    configs['Labels']['label_names'] = parser.get('Labels', 'label_names')
-    configs['Resampling']['Use'] = parser.getfloat('Resampling', 'Use')
-    configs['Classification']['classifiers'] = parser.get('Classification', 'classifiers')
-    configs['CrossValidation']['Type'] = parser.get('CrossValidation', 'Type')
-    configs['CrossValidation']['N_iterations'] = parser.getint('CrossValidation', 'N_iterations')
-    configs['CrossValidation']['test_size'] = parser.getfloat('CrossValidation', 'test_size')
-    configs['CrossValidation']['fixed_seed'] = parser.getboolean('CrossValidation', 'fixed_seed')
-    configs['HyperOptimization']['test_size'] = parser.getfloat('HyperOptimization', 'test_size')
-    configs['HyperOptimization']['n_splits'] = parser.getint('HyperOptimization', 'n_splits')
-    configs['HyperOptimization']['N_iterations'] = parser.getint('HyperOptimization', 'N_iterations')
-    configs['HyperOptimization']['n_jobspercore'] = parser.getint('HyperOptimization', 'n_jobspercore')
 
+def load_default_configs(file_path):
+    '''
+    Default settings (CONFIG_SCHEMA completed by the defaults file), as a new dict
+    '''
+    schema = compile_schema(file_path)
+    configs = dict(TOP_LEVEL_DEFAULTS)
+    configs.update({section: dict(items) for section, items in schema.defaults.items()})
     return configs
 
-def get_typed_val(val):
-    # vall is always a string, assign it to bool, tuple, or number
-    try: # this takes care of single numbers
-        return literal_eval(val)
-    except:
-        if val == 'on': return True
-        else:
-            return val
-
-def parse_user_arguments(arguments):
-    # remove unwanted fields
-    arguments.pop('execution')
-    arguments.pop('project')
-    arguments.pop('description')
-    # iterate over the rest and parse
-    configs = {
-        'modus': '',
-        'coarse': False,
-        'experiment_name': 'run000',
-        'image_types': 'CT',
-        'General': dict(),
-        'Preprocessing': dict(),
-        'ImageFeatures': dict(),
-        'PyRadiomics': dict(),
-        'ComBat': dict(),
-        'Featsel': dict(),
-        'Labels': dict(),
-        'Resampling': dict(),
-        'Classification': dict(),
-        'CrossValidation': dict(),
-        'HyperOptimization': dict(),
-    }
-    classifiers = ''
-    comma = ''
+def parse_user_arguments(arguments, file_path=DEFAULT_CONFIGS_FILE):
+    '''
+    Converts the VRE arguments ('<group>:<section>:<key>': value) to typed settings.
+    Empty values take the default of their setting (see CompiledSchema.convert).
+    The arguments are not modified. Unknown settings are ignored with a warning.
+    :raise ValueError: Malformed argument name, value of the wrong type or missing General:Imagetype
+    '''
+    schema = compile_schema(file_path)
+    configs = dict(TOP_LEVEL_USER_DEFAULTS)
+    configs.update({section: dict() for section in schema.sections})
+    classifiers = []
+    image_type = None
     for key, val in arguments.items():
+        if key in MASKED_ARGUMENTS:
+            continue
         levels = key.split(':')
+        if len(levels) != 3:
+            raise ValueError('Malformed argument name {!r}, expected <group>:<section>:<key>'.format(key))
         section, item = levels[1], levels[2]
         if section == 'classifiers':
-            classifiers = classifiers + comma + item
-            comma = ', '
+            classifiers.append(item)
         elif section == 'ML':
-            configs['modus'] = val
+            configs['modus'] = val.strip() if isinstance(val, str) else val
+        elif section == 'General' and item == 'Imagetype':
+            image_type = val
+        elif (section, item) in schema.converters:
+            configs[section][item] = schema.convert(section, item, val)
         else:
-            typed_val = get_typed_val(val)
-            if isinstance(typed_val, tuple):  # we don't want to change '1, 1, 1' to (1, 1, 1)
-                typed_val = val
-            configs[section][item] = typed_val
-    configs['Classification']['classifiers'] = classifiers
-    configs['image_types'] = configs['General']['Imagetype']
-    configs['General'].pop('Imagetype')
+            logger.warning("Ignoring unknown argument {}", key)
+    if image_type is None:
+        raise ValueError('Missing argument General:Imagetype')
+    if classifiers:
+        configs['Classification']['classifiers'] = ', '.join(classifiers)
+    configs['image_types'] = image_type
     return configs
 
 def update_overrides(configs, user_configs):
-    '''We can't use dict.update()
-    iterate over configs
-        if the field exists in user_configs
-            update it
-        else
-            set that field in config to false
     '''
-    new_configs = configs
+    Overrides for WORC: every setting of `configs` takes the user value when there is
+    one, otherwise False for booleans (an unticked VRE checkbox is not sent) and its
+    default in `configs` for the rest. Returns a new dict.
+    '''
+    new_configs = {}
     for section, items in configs.items():
         if isinstance(items, dict):
-            for field, val in items.items():
-                if field in user_configs[section]:
-                    new_configs[section][field] = user_configs[section][field]
-                else:
-                    if isinstance(val, bool):
-                        new_configs[section][field] = False
-                    else:
-                        new_configs[section][field] = ''
+            new_configs[section] = {
+                field: user_configs[section][field] if field in user_configs[section] else
+                (False if isinstance(val, bool) else val)
+                for field, val in items.items()}
         else:
-            new_configs[section] = user_configs[section]
+            new_configs[section] = items if user_configs[section] == '' else user_configs[section]
     return new_configs
 
+def build_config(arguments, file_path=DEFAULT_CONFIGS_FILE):
+    '''
+    Parses the VRE arguments into the normalised, hashable overrides
+    :return: FrozenConfig, use to_dict() for a mutable copy
+    '''
+    return FrozenConfig(update_overrides(load_default_configs(file_path),
+                                         parse_user_arguments(arguments, file_path)))
+
 # ARGUMENTS
 vre_args = {
     'execution': '/gpfs/eucanimage.eu/vre/userdata//ECIUSER6059f84f499c8/__PROJ62f62b15eb48c3.57139216/run029',
@@ -168,6 +293,13 @@ vre_args = {
     'image:Preprocessing:Resampling': 'on', 
     'image:Preprocessing:Resampling_spacing': '1, 1, 1', 
     'image:Preprocessing:BiasCorrection': 'on', 
+    'image:Toolbox:CropToROI': 'on', 
+    'image:Toolbox:CropMargin': '10', 
+    'General:Toolbox:Phase': 'full', 
+    'General:Toolbox:ArchiveProfile': 'full', 
+    'General:Toolbox:ExecutionBackend': 'local', 
+    'General:Toolbox:Cores': '4', 
+    'General:Toolbox:Resume': 'on', 
     'radiomics:ImageFeatures:histogram': 'on', 
     'radiomics:ImageFeatures:orientation': 'on', 
     'radiomics:ImageFeatures:texture_Gabor': 'on', 
@@ -211,9 +343,10 @@ vre_args = {
 
 if __name__ == '__main__':
     # configs = load_default_configs('./configs_default.ini')
-    configs = load_default_configs('/home/kaisar/EuCanImage/Coding/VRE/MLToolbox/tool/configs_default.ini')
+    configs = load_default_configs(DEFAULT_CONFIGS_FILE)
     new_configs = parse_user_arguments(vre_args)
     pp = pprint.PrettyPrinter(4)
+    logger.flush()
     print('Default configs')
     pp.pprint(configs)
     print('User configs')
@@ -221,7 +354,7 @@ if __name__ == '__main__':
     # configs.update(new_configs)
     overrides = update_overrides(configs, new_configs)
     print('Overrides')
-    pp.pprint(configs)
+    pp.pprint(overrides)
 
 
 # vre_args = {
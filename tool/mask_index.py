@@ -0,0 +1,175 @@
+"""
+Per-mask statistics index built once at ingest.
+
+Every segmentation is streamed once (in parallel) and its voxel count per
+label, bounding box, number of connected components, shape and dtype are
+stored in a JSON sidecar in the execution folder. Later stages (cropping,
+validation, scheduling) read the index instead of the masks, and a rerun only
+rescans files whose size or modification time changed.
+"""
+
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from utils import logger
+from utils.image_utils import bounding_box
+from utils.nii_cache import load_nii_cached
+from utils.utils_gen import available_cpus
+
+INDEX_FILE_NAME = 'mask_index.json'
+INDEX_VERSION = 1
+
+
+def _file_signature(path):
+    """
+    Cheap change detection: file size and modification time
+    """
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def mask_statistics(path):
+    """
+    Statistics of one segmentation file.
+
+    The connected components are labelled once over the bounding box of the
+    mask, for all labels at the same time (regions of different labels are
+    never merged).
+
+    :param path: Path to the segmentation
+    :return: dict with shape, dtype, bbox (None if empty), total voxels and,
+             per label, voxel count and number of connected components
+    """
+    mask, _, header = load_nii_cached(path, lazy=False)
+    stats = {
+        'shape': list(mask.shape),
+        'dtype': str(header.get_data_dtype()),
+        'bbox': None,
+        'voxels': 0,
+        'components': 0,
+        'labels': {},
+    }
+    bbox = bounding_box(mask)
+    if bbox is None:
+        return stats
+
+    roi = mask[tuple(slice(start, stop) for start, stop in bbox)]
+    if not np.issubdtype(roi.dtype, np.integer):
+        roi = np.rint(roi).astype(np.int64)
+    # Imported on first use: skimage is slow to import
+    from skimage import measure  # pylint: disable=import-outside-toplevel
+    blobs, n_blobs = measure.label(roi, background=0, connectivity=1, return_num=True)
+    owner = np.zeros(n_blobs + 1, dtype=roi.dtype)
+    owner[blobs] = roi
+
+    values, counts = np.unique(roi[roi != 0], return_counts=True)
+    for value, count in zip(values.tolist(), counts.tolist()):
+        stats['labels'][str(value)] = {
+            'voxels': count,
+            'components': int(np.count_nonzero(owner[1:] == value)),
+        }
+    stats['bbox'] = [list(axis) for axis in bbox]
+    stats['voxels'] = int(counts.sum())
+    stats['components'] = int(n_blobs)
+    return stats
+
+
+class MaskIndex(object):
+    """
+    JSON sidecar holding mask_statistics for every segmentation of a run.
+
+    Example
+    -------
+    >>> index = MaskIndex.for_execution(out_dir)
+    >>> index.update(segmentations)
+    >>> index.get(segmentations[0])['bbox']
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.entries = {}
+        if os.path.isfile(index_path):
+            try:
+                with open(index_path) as f:
+                    content = json.load(f)
+                if content.get('version') == INDEX_VERSION:
+                    self.entries = content.get('masks', {})
+            except (OSError, ValueError):
+                logger.warning("Ignoring unreadable mask index {}", index_path)
+
+    @classmethod
+    def for_execution(cls, execution_dir):
+        """
+        The index of an execution folder
+        """
+        return cls(os.path.join(execution_dir, INDEX_FILE_NAME))
+
+    def is_current(self, path):
+        """
+        True if the entry of path exists and the file did not change since it was scanned
+        """
+        entry = self.entries.get(os.path.abspath(path))
+        return entry is not None and entry['signature'] == _file_signature(path)
+
+    def update(self, segmentations, n_workers=None):
+        """
+        Scan the segmentations that are new or changed, in a process pool,
+        then save the index.
+
+        :param n_workers: Worker processes. Defaults to the CPUs available to the process
+        :return: List of segmentations that were (re)scanned
+        """
+        stale = [seg for seg in segmentations if not self.is_current(seg)]
+        if stale:
+            logger.info("Indexing {} of {} segmentations", len(stale), len(segmentations))
+            with ProcessPoolExecutor(max_workers=n_workers or available_cpus()) as executor:
+                for seg, stats in zip(stale, executor.map(mask_statistics, stale)):
+                    self.entries[os.path.abspath(seg)] = {
+                        'signature': _file_signature(seg),
+                        'stats': stats,
+                    }
+            self.save()
+
+        for seg in segmentations:
+            stats = self.get(seg)
+            if stats['voxels'] == 0:
+                logger.warning("Segmentation {} is empty", seg)
+        return stale
+
+    def get(self, path):
+        """
+        Statistics of a segmentation, or None if it is not indexed
+        """
+        entry = self.entries.get(os.path.abspath(path))
+        return None if entry is None else entry['stats']
+
+    def order_by_cost(self, paths, key=None):
+        """
+        Sort paths by decreasing mask size, so the most expensive work is scheduled first.
+        Unindexed paths go last.
+
+        :param key: Optional function mapping an item of paths to its segmentation path
+        """
+        def _cost(item):
+            stats = self.get(item if key is None else key(item))
+            return -1 if stats is None else stats['voxels']
+        return sorted(paths, key=_cost, reverse=True)
+
+    def save(self):
+        """
+        Atomically write the index (temporary file and rename)
+        """
+        folder = os.path.dirname(os.path.abspath(self.index_path))
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.mask_index.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': INDEX_VERSION, 'masks': self.entries}, f, indent=1)
+            os.replace(tmp_path, self.index_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
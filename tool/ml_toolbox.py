@@ -8,16 +8,18 @@
 # suitable for first time usage.
 
 # import neccesary packages
+# WORC (and fastr through it) is imported in run_ml_toolbox: it takes seconds to import
+# and configuration errors should be reported before paying that
 import os
 import shutil
-from WORC import BasicWORC
-from pathlib import Path
-from tool.load_vre_configs import load_default_configs, parse_user_arguments, update_overrides
-# These packages are only used in analysing the results
-import pandas as pd
-import json
-import fastr
-import glob
+from tool.execution import get_execution_backend
+from tool.feature_store import feature_file_names, features_directory, find_feature_files, get_default_store, \
+    harvest_features, plan_features, read_feature_bundle, write_feature_bundle
+from tool.load_vre_configs import build_config
+from tool.preprocessing import patient_id, run_preprocessing
+from tool.resume import RunState
+from utils import logger
+from utils.archive import ARCHIVE_PROFILES, archive_folder
 
 # TODO: remove these inputs, should be provided by the user
 # overridestest = {'modus': 'binary_classification', 'coarse': True, 'experiment_name': 'run000', 'image_types': 'CT', 'Labels': {'label_names': 'imaginary_label_1'}}
@@ -27,14 +29,211 @@ import glob
 # quantitative_modalities = ['CT', 'PET', 'Thermography', 'ADC', 'MG']
 # qualitative_modalities = ['MRI', 'MR', 'DWI', 'US']
 
-def run_ml_toolbox(overrides, images, segmentations, label_file, out_dir, arguments):
-    """Execute WORC Tutorial experiment."""
-    print(f"Running in folder: {out_dir}.")
-    print("ARGUMENTS\n", arguments)
-    user_arguments = parse_user_arguments(arguments)
-    overrides = load_default_configs('/home/user/MLToolbox/tool/configs_default.ini')
-    overrides = update_overrides(overrides, user_arguments)
-    print('Parsed arguments', overrides)
+# Toolbox:Phase values. 'extract' stops after the features, 'model' starts from them
+PHASES = ('full', 'extract', 'model')
+
+# WORC has no extraction-only workflow: the extract phase runs the cheapest modelling
+# settings, only to get the features out of the network
+EXTRACT_PHASE_OVERRIDES = {
+    'CrossValidation': {'N_iterations': 1},
+    'HyperOptimization': {'N_iterations': 10, 'n_splits': 2},
+}
+
+
+def get_phase(config):
+    """
+    Phase selected by the Toolbox:Phase argument
+    """
+    phase = config['Toolbox']['Phase']
+    if phase not in PHASES:
+        raise ValueError('Unknown Toolbox:Phase {!r}, expected one of {}'.format(phase, ', '.join(PHASES)))
+    return phase
+
+
+def get_archive_profile(config):
+    """
+    Archive profile of the results zip selected by the Toolbox:ArchiveProfile argument
+    """
+    profile = config['Toolbox']['ArchiveProfile']
+    if profile not in ARCHIVE_PROFILES:
+        raise ValueError('Unknown Toolbox:ArchiveProfile {!r}, expected one of {}'.format(
+            profile, ', '.join(sorted(ARCHIVE_PROFILES))))
+    return profile
+
+
+def _bundle_output(bundle, n_patients):
+    """
+    VRE output entry of a feature bundle
+    """
+    logger.info("Features of {} patients are stored in {}.", n_patients, bundle)
+    metadata = {
+        'file_format': 'zip',
+        'output_path': bundle,
+        'role': 'features',
+        'patients': n_patients,
+    }
+    return bundle, metadata
+
+
+def _run_experiment(experiment_name, overrides, settings, label_file, out_dir, backend, phase, n_patients,
+                    images=None, segmentations=None, features_dir=None):
+    """
+    Build and execute one WORC experiment, on images and segmentations or on the
+    precomputed features of features_dir.
+
+    :param overrides: WORC config overrides
+    :param settings: dict with the modus, coarse, image_types and label_names of the experiment
+    :param phase: 'extract' runs the cheapest modelling settings and no evaluation
+    """
+    # Create a Simple WORC object
+    from WORC import BasicWORC  # pylint: disable=import-outside-toplevel
+    experiment = BasicWORC(experiment_name)
+    if features_dir is not None:
+        # Precomputed features are used instead of images and masks, one feature file
+        # per calculator (e.g. PREDICT and PyRadiomics) and patient
+        for file_name in feature_file_names(features_dir):
+            experiment.features_from_this_directory(features_dir, feature_file_name=file_name)
+    else:
+        # Set the input data according to the variables we defined earlier
+        experiment.images_train = [{patient_id(im): im for im in images}]
+        experiment.segmentations_train = [{patient_id(seg): seg for seg in segmentations}]
+    experiment.labels_file_train = label_file
+    logger.info("LABEL NAMES {}", settings['label_names'])
+    experiment.predict_labels(settings['label_names'])
+
+    # Set the types of images WORC has to process. Used in fingerprinting
+    # Valid quantitative types are ['CT', 'PET', 'Thermography', 'ADC']
+    # Valid qualitative types are ['MRI', 'DWI', 'US']
+    experiment.set_image_types(settings['image_types'])
+
+    # Use the standard workflow for your specific modus
+    if settings['modus'] == 'binary_classification':
+        experiment.binary_classification(coarse=settings['coarse'])
+    # elif modus == 'regression':  # TODO remove it for this version because not all of the classifiers are regressors
+    #     experiment.regression(coarse=coarse)
+    elif settings['modus'] == 'multiclass_classification':
+        experiment.multiclass_classification(coarse=settings['coarse'])
+
+    overrides = {section: dict(items) if isinstance(items, dict) else items for section, items in overrides.items()}
+    if phase == 'extract':
+        for section, items in EXTRACT_PHASE_OVERRIDES.items():
+            overrides[section].update(items)
+    logger.info("ADDING CONFIG OVERRIDES\n{}", overrides)
+    experiment.add_config_overrides(overrides)
+
+    # Instead of the default tempdir, let's put the temporary output in a subfolder
+    # in the same folder as this script
+    experiment.set_tmpdir(os.path.join(out_dir, 'tmp'))
+
+    # TODO add an option in UI to run evaluations
+    if phase != 'extract':
+        logger.info("ADDING EVALUATIONS")
+        experiment.add_evaluation()
+
+    backend.apply(experiment)
+    # Run the experiment!
+    with logger.span('worc_execute', experiment=experiment_name, patients=n_patients, phase=phase):
+        experiment.execute()
+
+
+def _extract_resumable(state, config, sources, images, segmentations, label_file, experiment_name, overrides,
+                       settings, out_dir, backend, feature_store=None, store_keys=None, cached_features=None):
+    """
+    Extract the features of the patients of a resumable run that have no verified
+    features yet, in one WORC experiment. A patient failing its extraction fails the
+    whole fastr network, so the sinks of the other patients are collected anyway and
+    only the failed patients are left for the next run.
+
+    :param state: RunState of the execution folder
+    :param sources: (images, segmentations) given to the toolbox, before preprocessing. The
+                    preprocessed files are written again on every run, so the state is keyed
+                    on the inputs and the preprocessing settings instead
+    :param store_keys: dict patient -> key in the feature store
+    :param cached_features: dict patient -> feature file of the feature store
+    :return: dict patient -> {calculator: verified feature file} of the cohort
+    """
+    keys = state.feature_keys(config, *sources)
+    state.verify(keys)
+    outputs_dir = os.path.join(out_dir, 'outputs')
+    # Sinks of an extraction that was killed before they were collected
+    if state.pending(keys) and state.attempts:
+        state.collect(outputs_dir, keys, state.pending(keys))
+    if cached_features:
+        state.add(keys, {pid: path for pid, path in cached_features.items() if pid in state.pending(keys)})
+
+    pending = state.pending(keys)
+    if pending:
+        logger.info("Extracting the features of {} of {} patients", len(pending), len(keys))
+        name = state.start_attempt(experiment_name, keys, pending)
+        error = 'no features written'
+        try:
+            _run_experiment(name, overrides, settings, label_file, out_dir, backend, 'extract', len(pending),
+                            images=[im for im in images if patient_id(im) in pending],
+                            segmentations=[seg for seg in segmentations if patient_id(seg) in pending])
+        except Exception as exc:  # pylint: disable=broad-except
+            error = '{}: {}'.format(type(exc).__name__, exc)
+            logger.error("Feature extraction run {} failed: {}", name, error)
+        collected = state.collect(outputs_dir, keys, pending)
+        if feature_store is not None:
+            for pid, feature_files in collected.items():
+                feature_store.put(store_keys[pid], feature_files, patient=pid)
+        state.mark_failed(keys, [pid for pid in pending if pid not in collected], error)
+
+    cohort = {pid: state.feature_files(pid) for pid in sorted(keys) if pid in state.features}
+    missing = sorted(set(keys) - set(cohort))
+    if missing:
+        logger.warning("Continuing without the {} patients whose extraction failed: {}", len(missing),
+                       ', '.join(missing))
+    if not cohort:
+        raise RuntimeError('The feature extraction failed for every patient')
+    return cohort
+
+
+def _extract_uncached(feature_store, keys, cached_features, images, segmentations, label_file, experiment_name,
+                      overrides, settings, out_dir, backend):
+    """
+    Extract the features of the patients missing from the feature store, in one WORC
+    experiment on their images only, and store them
+
+    :param keys: dict patient -> key in the feature store, of the whole cohort
+    :param cached_features: dict patient -> {calculator: stored feature file}, of the patients in the store
+    :return: dict patient -> {calculator: stored feature file}, of the whole cohort
+    """
+    missing = sorted(set(keys) - set(cached_features))
+    logger.info("Extracting the features of {} of {} patients", len(missing), len(keys))
+    name = '{}_features'.format(experiment_name)
+    _run_experiment(name, overrides, settings, label_file, out_dir, backend, 'extract', len(missing),
+                    images=[im for im in images if patient_id(im) in missing],
+                    segmentations=[seg for seg in segmentations if patient_id(seg) in missing])
+    harvest_features(feature_store, {pid: keys[pid] for pid in missing}, os.path.join(out_dir, 'outputs', name))
+    stored = {pid: feature_store.get(key) for pid, key in keys.items()}
+    lost = sorted(pid for pid, feature_files in stored.items() if not feature_files)
+    if lost:
+        raise RuntimeError('No features were stored for the patients {}'.format(', '.join(lost)))
+    return stored
+
+
+def run_ml_toolbox(overrides, images, segmentations, label_file, out_dir, arguments, features_bundle=None):
+    """Execute WORC Tutorial experiment.
+
+    The Toolbox:Phase argument selects the part of the pipeline to run: 'full',
+    'extract' (images to a feature bundle output) or 'model' (a feature bundle,
+    given as features_bundle, to the results, without reading any image).
+    With Toolbox:Resume, a rerun in the same out_dir continues the previous one
+    (see tool.resume).
+    """
+    logger.info("Running in folder: {}.", out_dir)
+    logger.info("ARGUMENTS\n {}", arguments)
+    config = build_config(arguments)
+    overrides = config.to_dict()
+    logger.info("Parsed arguments {}", overrides)
+    phase = get_phase(config)
+    logger.info("Phase: {}.", phase)
+    archive_profile = get_archive_profile(config)
+    backend = get_execution_backend(config)
+    resume = bool(config['Toolbox'].get('Resume'))
+    if phase == 'model' and not features_bundle:
+        raise ValueError("The model phase needs a feature bundle input")
     # ---------------------------------------------------------------------------
     # Input
     # ---------------------------------------------------------------------------
@@ -77,81 +276,98 @@ def run_ml_toolbox(overrides, images, segmentations, label_file, out_dir, argume
     experiment_name = overrides['experiment_name']
     overrides.pop('experiment_name')
 
-    # Instead of the default tempdir, let's put the temporary output in a subfolder
-    # in the same folder as this script
-    tmpdir = os.path.join(out_dir, 'tmp')
-    print(f"Temporary folder: {tmpdir}.")
+    settings = {
+        'modus': modus,
+        'coarse': coarse,
+        'image_types': [overrides.pop('image_types')],  # list
+        'label_names': [label_name for label_name in overrides['Labels']['label_names'].split(', ')],
+    }
 
-    # ---------------------------------------------------------------------------
-    # The actual experiment
-    # ---------------------------------------------------------------------------
+    logger.info("Temporary folder: {}.", os.path.join(out_dir, 'tmp'))
 
-    # Create a Simple WORC object
-    experiment = BasicWORC(experiment_name)
-    # print([{Path(im).name.split("_")[0]: im for im in images}])
-    # print([{Path(seg).name.split("_")[0]: seg for seg in segmentations}])
-    # Set the input data according to the variables we defined earlier
-    experiment.images_train = [{Path(im).name.split("_")[0]: im for im in images}]
-    experiment.segmentations_train = [{Path(seg).name.split("_")[0]: seg for seg in segmentations}]
-    experiment.labels_file_train = label_file
-    # experiment.labels_name_train = overrides['label_names']  # list
-    # # Tried both, setting label_names of the experiment like this:
-    # experiment.label_names = overrides['label_names']
-    # # And also like this:
-    # experiment.predict_labels(['imaginary_label_1'])  # Also tried ['imaginary_label1'] and 'imaginary_label1'
-    label_names = [label_name for label_name in overrides['Labels']['label_names'].split(', ')]
-    print('LABEL NAMES', label_names)
-    experiment.predict_labels(label_names)  # Also tried ['imaginary_label1'] and 'imaginary_label1'
-    # overrides.pop('label_names')
-    # experiment.segmentations_from_this_directory(segmentations,
-                                                #  segmentation_file_name=segmentation_file_name)
-    # experiment.labels_from_this_file(label_file)
-    # experiment.predict_labels(label_name)
+    sources = (images, segmentations)
+    if phase == 'model':
+        # No image I/O: the features come from the bundle, the Toolbox stages do not apply
+        overrides.pop('Toolbox')
+    else:
+        # Validate image/segmentation pairing and headers before anything expensive runs
+        from tool.preflight import run_preflight  # pylint: disable=import-outside-toplevel
+        with logger.span('preflight'):
+            run_preflight(overrides, images, segmentations, n_threads=backend.cores)
 
-    # Set the types of images WORC has to process. Used in fingerprinting
-    # Valid quantitative types are ['CT', 'PET', 'Thermography', 'ADC']
-    # Valid qualitative types are ['MRI', 'DWI', 'US']
-    image_types = [overrides['image_types']]  # list
-    overrides.pop('image_types')
-    experiment.set_image_types(image_types)
+        # Run the preprocessing stages handled by the toolbox itself (e.g. resampling)
+        # once, and feed their outputs to WORC instead of the raw inputs
+        with logger.span('preprocessing'):
+            images, segmentations = run_preprocessing(overrides, images, segmentations, out_dir,
+                                                      n_workers=backend.cores)
 
-    # Use the standard workflow for your specific modus
-    if modus == 'binary_classification':
-        experiment.binary_classification(coarse=coarse)
-    # elif modus == 'regression':  # TODO remove it for this version because not all of the classifiers are regressors
-    #     experiment.regression(coarse=coarse)
-    elif modus == 'multiclass_classification':
-        experiment.multiclass_classification(coarse=coarse)
-
-    # overrides = {
-    #         'Labels': {
-    #             'modus': 'multilabel',
-    #         },
-    #         'Featsel': {
-    #             # Other estimators do not support multiclass
-    #             'SelectFromModel_estimator': 'RF'
-    #         }
-    #         'Classification': {
-                    # 'classifiers': 'SVM, RF, LR, LDA, QDA, GaussianNB, AdaBoostClassifier, XGBClassifier'
-    #           }
-    #     }
-    print('ADDING CONFIG OVERRIDES')
-    print(overrides)
-    experiment.add_config_overrides(overrides)
+    # ---------------------------------------------------------------------------
+    # The actual experiment
+    # ---------------------------------------------------------------------------
 
-    # Set the temporary directory
-    experiment.set_tmpdir(tmpdir)
+    # Reuse the features extracted by earlier experiments with the same images, masks and
+    # feature settings. WORC takes either features or images for all patients: when part of
+    # the cohort is in the store, only the other patients are extracted and stored, and the
+    # experiment runs on the stored features of everyone. When none is, the features are
+    # stored after a single run on the images
+    feature_store = get_default_store() if phase != 'model' else None
+    feature_keys, cached_features = {}, {}
+    if feature_store is not None:
+        feature_keys, cached_features = plan_features(feature_store, config, images, segmentations)
+        if cached_features and len(cached_features) < len(feature_keys) and not resume:
+            cached_features = _extract_uncached(feature_store, feature_keys, cached_features, images, segmentations,
+                                                label_file, experiment_name, overrides, settings, out_dir, backend)
+    all_cached = bool(feature_keys) and len(cached_features) == len(feature_keys)
+    if phase == 'extract' and all_cached:
+        # Every patient is in the store: the bundle is written without running WORC
+        bundle = write_feature_bundle(out_dir + '/features.zip', cached_features, config)
+        return [_bundle_output(bundle, len(cached_features))]
 
-    # TODO add an option in UI to run evaluations
-    print('ADDING EVALUATIONS')
-    experiment.add_evaluation()
+    state, cohort, features_dir = None, None, None
+    if phase == 'model':
+        features_dir, manifest = read_feature_bundle(features_bundle, out_dir)
+        n_patients = len(manifest['patients'])
+        logger.info("Using the features of {} patients from {}", n_patients, features_bundle)
+    elif all_cached:
+        n_patients = len(images)
+        logger.info("Using the stored features of all patients")
+        features_dir = features_directory(feature_store, feature_keys, out_dir)
+    elif resume:
+        # Extract the features in a resumable state, so a rerun only redoes what is missing
+        state = RunState.load(out_dir)
+        cohort = _extract_resumable(state, config, sources, images, segmentations, label_file, experiment_name,
+                                    overrides, settings, out_dir, backend, feature_store, feature_keys,
+                                    cached_features)
+        n_patients = len(cohort)
+        features_dir = state.features_directory(cohort)
+    else:
+        n_patients = len(images)
 
-    experiment.set_multicore_execution()
-    # Run the experiment!
-    experiment.execute()
+    # Locate output folder
+    outputfolder = out_dir + '/outputs/' + experiment_name
+    if phase == 'extract':
+        if cohort is None:
+            _run_experiment(experiment_name, overrides, settings, label_file, out_dir, backend, phase, n_patients,
+                            images=images, segmentations=segmentations)
+            if feature_keys:
+                harvest_features(feature_store, feature_keys, outputfolder)
+            cohort = find_feature_files(outputfolder, [patient_id(im) for im in images])
+        bundle = write_feature_bundle(out_dir + '/features.zip', cohort, config)
+        return [_bundle_output(bundle, len(cohort))]
 
-    # NOTE:  Precomputed features can be used instead of images and masks
-    # by instead using ``experiment.features_from_this_directory(featuresdatadir)`` in a similar fashion.
+    fingerprint = state.model_fingerprint(config, label_file, cohort) if state is not None else None
+    if state is not None and state.model_complete(fingerprint):
+        logger.info("Resume: the results of the previous run are complete and verified")
+    else:
+        if state is not None:
+            # Outputs of an interrupted modelling run would be mixed with the new ones
+            shutil.rmtree(outputfolder, ignore_errors=True)
+        _run_experiment(experiment_name, overrides, settings, label_file, out_dir, backend, phase, n_patients,
+                        images=images, segmentations=segmentations, features_dir=features_dir)
+        if state is not None:
+            state.complete_model(fingerprint, outputfolder)
+        if feature_keys and not all_cached and state is None:
+            harvest_features(feature_store, feature_keys, outputfolder)
 
     # ---------------------------------------------------------------------------
     # Analysis of results
@@ -161,20 +377,22 @@ def run_ml_toolbox(overrides, images, segmentations, label_file, out_dir, argume
     # performance. These are stored as .hdf5 and .json files, respectively. By
     # default, they are saved in the so-called "fastr output mount", in a subfolder
     # named after your experiment name.
-
-    # Locate output folder
-    outputfolder = out_dir + '/outputs/' + experiment_name
     zip_file = out_dir + '/results'
     # outputfolder = out_dir + '/outputs/results'
     # zip the folder in outputfloder
-    shutil.make_archive(zip_file, 'zip', os.path.split(outputfolder)[0])
     outfile = zip_file + '.zip'
-    print(f"Your output is stored in {outfile}.")
+    # Only the experiment: outputs/ also holds the feature extraction experiments (<experiment>_features*)
+    with logger.span('archive', profile=archive_profile):
+        archive_folder(outfile, outputfolder, archive_profile, n_threads=backend.cores, prefix=experiment_name)
+    logger.info("Your output is stored in {}.", outfile)
 
     metadata = {
         'file_format': 'zip',
         'output_path': outfile,
     }
+    if state is not None:
+        metadata['patients'] = n_patients
+        metadata['excluded_patients'] = sorted({patient_id(im) for im in images} - set(cohort))
     outputs = [(outfile, metadata)]
     return outputs
 
@@ -209,3 +427,4 @@ def run_ml_toolbox(overrides, images, segmentations, label_file, out_dir, argume
 
 if __name__ == '__main__':
     run_ml_toolbox()
+
@@ -0,0 +1,144 @@
+"""
+Header-only preflight validation of the toolbox inputs.
+
+Only the NIfTI headers are read (348 bytes, plus the start of the gzip
+stream for compressed files), across a thread pool, so a bad image/mask
+pair is reported within seconds instead of deep inside a WORC run.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+from nibabel.openers import ImageOpener
+
+from tool.preprocessing import patient_id
+from utils import logger
+from utils.utils_gen import available_cpus
+
+# Tolerances used to compare spacing (mm) and affines of an image/mask pair
+SPACING_TOLERANCE = 1e-3
+AFFINE_TOLERANCE = 1e-2
+
+
+class PreflightError(ValueError):
+    """
+    Raised when the inputs fail validation; the message holds the full report
+    """
+
+
+def read_header(path):
+    """
+    Read only the NIfTI header of a file
+
+    :return: dict with shape, spacing, affine and orientation codes
+    """
+    with ImageOpener(path) as f:
+        header = nib.Nifti1Header.from_fileobj(f)
+    affine = header.get_best_affine()
+    return {
+        'shape': tuple(int(n) for n in header.get_data_shape()[:3]),
+        'spacing': tuple(round(float(z), 4) for z in header.get_zooms()[:3]),
+        'affine': affine,
+        'orientation': ''.join(nib.aff2axcodes(affine)),
+    }
+
+
+def _read_header_safe(path):
+    try:
+        return read_header(path), None
+    except Exception as error:  # pylint: disable=broad-except
+        return None, '{}: {}'.format(type(error).__name__, error)
+
+
+def check_pair(image_header, mask_header, assume_same_metadata=False):
+    """
+    Compare the headers of an image and its mask
+
+    :param assume_same_metadata: WORC's AssumeSameImageAndMaskMetadata; when set,
+                                 spacing/orientation/origin differences are warnings
+                                 because WORC copies the image metadata onto the mask
+    :return: (errors, warnings) lists of messages
+    """
+    errors, warnings = [], []
+    if image_header['shape'] != mask_header['shape']:
+        errors.append('shape {} != mask shape {}'.format(image_header['shape'], mask_header['shape']))
+
+    metadata_issues = []
+    if not np.allclose(image_header['spacing'], mask_header['spacing'], atol=SPACING_TOLERANCE):
+        metadata_issues.append('spacing {} != mask spacing {}'.format(
+            image_header['spacing'], mask_header['spacing']))
+    if image_header['orientation'] != mask_header['orientation']:
+        metadata_issues.append('orientation {} != mask orientation {}'.format(
+            image_header['orientation'], mask_header['orientation']))
+    elif not np.allclose(image_header['affine'], mask_header['affine'], atol=AFFINE_TOLERANCE):
+        metadata_issues.append('affine differs from the mask affine')
+
+    (warnings if assume_same_metadata else errors).extend(metadata_issues)
+    return errors, warnings
+
+
+def preflight(images, segmentations, assume_same_metadata=False, n_threads=None):
+    """
+    Validate the pairing and the headers of all inputs.
+
+    :param images: List of image paths
+    :param segmentations: List of segmentation paths
+    :param assume_same_metadata: See check_pair
+    :param n_threads: Header reads run in a thread pool (I/O bound). Defaults to the CPUs available to the process
+    :return: dict with 'errors' and 'warnings', lists of messages
+    """
+    report = {'errors': [], 'warnings': []}
+
+    images_by_patient, masks_by_patient = {}, {}
+    for paths, by_patient, kind in ((images, images_by_patient, 'image'),
+                                    (segmentations, masks_by_patient, 'segmentation')):
+        for path in paths:
+            pid = patient_id(path)
+            if pid in by_patient:
+                report['errors'].append('{}: more than one {} ({}, {})'.format(
+                    pid, kind, by_patient[pid], path))
+            by_patient[pid] = path
+
+    for pid in sorted(set(images_by_patient) - set(masks_by_patient)):
+        report['errors'].append('{}: image {} has no segmentation'.format(pid, images_by_patient[pid]))
+    for pid in sorted(set(masks_by_patient) - set(images_by_patient)):
+        report['errors'].append('{}: segmentation {} has no image'.format(pid, masks_by_patient[pid]))
+
+    paths = list(images_by_patient.values()) + list(masks_by_patient.values())
+    with ThreadPoolExecutor(max_workers=n_threads or available_cpus()) as executor:
+        headers = dict(zip(paths, executor.map(_read_header_safe, paths)))
+
+    for path, (_, error) in headers.items():
+        if error is not None:
+            report['errors'].append('{}: unreadable header ({})'.format(path, error))
+
+    for pid in sorted(set(images_by_patient) & set(masks_by_patient)):
+        image_header, _ = headers[images_by_patient[pid]]
+        mask_header, _ = headers[masks_by_patient[pid]]
+        if image_header is None or mask_header is None:
+            continue
+        errors, warnings = check_pair(image_header, mask_header, assume_same_metadata)
+        report['errors'].extend('{}: {}'.format(pid, msg) for msg in errors)
+        report['warnings'].extend('{}: {}'.format(pid, msg) for msg in warnings)
+
+    return report
+
+
+def run_preflight(overrides, images, segmentations, n_threads=None):
+    """
+    Run preflight on the toolbox inputs, log the report and raise PreflightError on any error
+
+    :param n_threads: Header read threads, see preflight
+    """
+    assume_same = bool(overrides['General'].get('AssumeSameImageAndMaskMetadata'))
+    report = preflight(images, segmentations, assume_same_metadata=assume_same, n_threads=n_threads)
+    for msg in report['warnings']:
+        logger.warning("Preflight: {}", msg)
+    if report['errors']:
+        for msg in report['errors']:
+            logger.error("Preflight: {}", msg)
+        raise PreflightError('Input validation failed with {} error(s):\n{}'.format(
+            len(report['errors']), '\n'.join(report['errors'])))
+    logger.info("Preflight: {} image/segmentation pairs validated", len(images))
+    return report
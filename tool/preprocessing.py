@@ -0,0 +1,185 @@
+"""
+Preprocessing stages run by the toolbox before the WORC experiment.
+
+Each stage turns the lists of image and segmentation paths into new lists
+that are handed to WORC instead, so the work is done once per cohort rather
+than inside every WORC run.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from utils import logger
+from utils.image_utils import bounding_box, grow_bounding_box
+from utils.nii_cache import cached_path, load_nii_cached
+from utils.utils_gen import available_cpus
+
+# nibabel and scipy (through tool.mask_index, utils.resampling and utils.utils_nii) are
+# imported by the stages themselves: patient_id is used on the validation path
+
+# Toolbox settings changing the preprocessed images and masks
+TOOLBOX_PREPROCESSING = ('CropToROI', 'CropMargin')
+
+
+def patient_id(path):
+    """
+    Patient identifier of an input file: the file name up to the first '_',
+    as used to pair images and segmentations for WORC.
+    """
+    return Path(path).name.split("_")[0]
+
+
+def pair_by_patient(images, segmentations):
+    """
+    Pair images and segmentations by patient identifier.
+
+    :return: List of (image, segmentation) tuples; inputs without a partner are skipped
+    """
+    seg_by_patient = {patient_id(seg): seg for seg in segmentations}
+    pairs = []
+    for im in images:
+        seg = seg_by_patient.get(patient_id(im))
+        if seg is None:
+            logger.warning("No segmentation found for image {}", im)
+            continue
+        pairs.append((im, seg))
+    return pairs
+
+
+def _resample_task(in_path, out_path, spacing, is_mask):
+    from utils.resampling import resample_nii  # pylint: disable=import-outside-toplevel
+    # Slab reads seek into the volume: read the decompressed copy of the cache when there is one
+    resample_nii(cached_path(in_path), out_path, spacing, is_mask=is_mask)
+    return out_path
+
+
+def resample_cohort(images, segmentations, spacing, out_dir, n_workers=None):
+    """
+    Resample every image (linear) and segmentation (nearest neighbour) to the
+    target spacing across a process pool.
+
+    Output files keep their original file names, so the patient pairing done in
+    run_ml_toolbox is unchanged.
+
+    :param images: List of image paths
+    :param segmentations: List of segmentation paths
+    :param spacing: Target spacing, e.g. Preprocessing:Resampling_spacing ('1, 1, 1')
+    :param out_dir: Folder the resampled volumes are written to
+    :param n_workers: Worker processes. Defaults to the CPUs available to the process
+    :return: (resampled images, resampled segmentations)
+    """
+    from utils.resampling import parse_spacing  # pylint: disable=import-outside-toplevel
+    spacing = parse_spacing(spacing)
+    image_dir = Path(out_dir) / 'images'
+    seg_dir = Path(out_dir) / 'segmentations'
+    image_dir.mkdir(parents=True, exist_ok=True)
+    seg_dir.mkdir(parents=True, exist_ok=True)
+
+    jobs = [(im, str(image_dir / Path(im).name), False) for im in images] + \
+           [(seg, str(seg_dir / Path(seg).name), True) for seg in segmentations]
+    logger.info("Resampling {} volumes to spacing {}", len(jobs), spacing)
+
+    with ProcessPoolExecutor(max_workers=n_workers or available_cpus()) as executor:
+        futures = [executor.submit(_resample_task, in_path, out_path, spacing, is_mask)
+                   for in_path, out_path, is_mask in jobs]
+        outputs = [future.result() for future in futures]
+
+    return outputs[:len(images)], outputs[len(images):]
+
+
+def _crop_task(image_path, mask_path, out_image, out_mask, margin, stats=None):  # pylint: disable=too-many-arguments
+    from utils.utils_nii import crop_nii  # pylint: disable=import-outside-toplevel
+
+    if stats is None:
+        mask, _, _ = load_nii_cached(mask_path, lazy=False)
+        mask_shape = mask.shape
+        bbox = bounding_box(mask, margin)
+    else:
+        # Reuse the ingest index instead of reading the mask again
+        mask_shape = tuple(stats['shape'])
+        bbox = None if stats['bbox'] is None else grow_bounding_box(stats['bbox'], margin, mask_shape)
+
+    image_shape = load_nii_cached(image_path)[0].shape[:3]
+    if mask_shape[:3] != image_shape:
+        logger.warning("Not cropping {}: image shape {} and mask shape {} differ",
+                       image_path, image_shape, mask_shape)
+        return image_path, mask_path
+    if bbox is None:
+        logger.warning("Not cropping {}: mask {} is empty", image_path, mask_path)
+        return image_path, mask_path
+    crop_nii(cached_path(image_path), out_image, bbox)
+    crop_nii(cached_path(mask_path), out_mask, bbox)
+    return out_image, out_mask
+
+
+def crop_cohort(images, segmentations, margin, out_dir, n_workers=None, index=None):  # pylint: disable=too-many-arguments
+    """
+    Crop every image/segmentation pair to the bounding box of the segmentation
+    plus a margin, across a process pool.
+
+    Feature extraction filters then only run over the region around the ROI
+    instead of the whole field of view. The cropped files keep the original
+    file names and carry an affine corrected for the crop offset.
+
+    :param images: List of image paths
+    :param segmentations: List of segmentation paths
+    :param margin: Margin in voxels added around the bounding box
+    :param out_dir: Folder the cropped volumes are written to
+    :param n_workers: Worker processes. Defaults to the CPUs available to the process
+    :param index: Optional MaskIndex; its bounding boxes are used instead of reading the masks
+                  and the largest masks are scheduled first
+    :return: (cropped images, cropped segmentations)
+    """
+    image_dir = Path(out_dir) / 'images'
+    seg_dir = Path(out_dir) / 'segmentations'
+    image_dir.mkdir(parents=True, exist_ok=True)
+    seg_dir.mkdir(parents=True, exist_ok=True)
+
+    pairs = pair_by_patient(images, segmentations)
+    if index is not None:
+        pairs = index.order_by_cost(pairs, key=lambda pair: pair[1])
+    logger.info("Cropping {} image/segmentation pairs with a margin of {} voxels", len(pairs), margin)
+
+    with ProcessPoolExecutor(max_workers=n_workers or available_cpus()) as executor:
+        futures = [executor.submit(_crop_task, im, seg, str(image_dir / Path(im).name),
+                                   str(seg_dir / Path(seg).name), margin,
+                                   None if index is None else index.get(seg))
+                   for im, seg in pairs]
+        outputs = [future.result() for future in futures]
+
+    return [im for im, _ in outputs], [seg for _, seg in outputs]
+
+
+def run_preprocessing(overrides, images, segmentations, out_dir, n_workers=None):
+    """
+    Run the enabled preprocessing stages and disable their WORC counterparts
+    in the overrides. The toolbox-only Toolbox section is removed from the
+    overrides, as WORC does not know it.
+
+    :param n_workers: Worker processes of the stages, e.g. the cores of the execution
+                      backend. Defaults to the CPUs available to the process
+
+    :return: (images, segmentations) to hand to WORC
+    """
+    toolbox = overrides.pop('Toolbox', {})
+
+    from tool.mask_index import MaskIndex  # pylint: disable=import-outside-toplevel
+
+    # Scan every mask once up front, so empty masks are reported before the long run
+    index = MaskIndex.for_execution(out_dir)
+    index.update(segmentations, n_workers=n_workers)
+
+    if toolbox.get('CropToROI'):
+        images, segmentations = crop_cohort(
+            images, segmentations, toolbox['CropMargin'], os.path.join(out_dir, 'preprocessed', 'cropped'),
+            n_workers=n_workers, index=index)
+
+    preprocessing = overrides['Preprocessing']
+    if preprocessing.get('Resampling'):
+        images, segmentations = resample_cohort(
+            images, segmentations, preprocessing['Resampling_spacing'],
+            os.path.join(out_dir, 'preprocessed', 'resampled'), n_workers=n_workers)
+        # Already done here, WORC must not resample again
+        preprocessing['Resampling'] = False
+    return images, segmentations
@@ -0,0 +1,319 @@
+"""
+Resumable experiments (Toolbox:Resume).
+
+The state of a run is kept in <execution folder>/resume/state.json:
+
+* the features of every patient extracted so far, copied out of the WORC
+  sinks into resume/features/<patient>/features_<calculator>.hdf5 (one file
+  per feature calculator) with their sha256;
+* the patients whose extraction failed and how many times;
+* the modelling stage, with the sha256 of every file it wrote.
+
+A rerun in the same execution folder checks every recorded file against its
+checksum and only redoes what is missing or does not match: the patients
+without verified features are extracted again (those that failed
+MAX_ATTEMPTS times are left out of the cohort) and the modelling stage runs
+again unless its fingerprint and outputs are unchanged. Sinks written by an
+extraction that was killed are recovered too, once the HDF5 superblock shows
+the file is complete.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from tool.feature_store import FEATURE_FILE_TEMPLATE, feature_key, find_feature_files, link_feature_files
+from tool.preprocessing import TOOLBOX_PREPROCESSING, patient_id
+from utils import logger
+from utils.nii_cache import ContentHasher, sha256_file, write_atomic
+
+RESUME_DIR = 'resume'
+STATE_FILE = 'state.json'
+STATE_VERSION = 2
+
+# Extraction attempts after which a patient is left out of the cohort
+MAX_ATTEMPTS = 2
+
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+
+def hdf5_complete(path):
+    """
+    True if path is an HDF5 file at least as long as the end of file address of its
+    superblock, so a sink cut short by a crash is not taken for a complete one
+    """
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            offset = 0
+            while True:  # The superblock is at 0, 512, 1024, 2048, ... (after a user block)
+                f.seek(offset)
+                head = f.read(64)
+                if head[:8] == HDF5_SIGNATURE:
+                    break
+                if offset + 8 > size:
+                    return False
+                offset = 512 if offset == 0 else offset * 2
+    except OSError:
+        return False
+
+    version = head[8]
+    if version in (0, 1):
+        size_of_offsets, base_position = head[13], 24 if version == 0 else 28
+    elif version in (2, 3):
+        size_of_offsets, base_position = head[9], 12
+    else:
+        return False
+    if size_of_offsets not in (2, 4, 8):
+        return False
+
+    def _address(position):
+        return int.from_bytes(head[position:position + size_of_offsets], 'little')
+
+    base = _address(base_position)
+    end_of_file = _address(base_position + 2 * size_of_offsets)
+    if end_of_file == (1 << 8 * size_of_offsets) - 1:  # Undefined address: never closed
+        return False
+    return size >= base + end_of_file
+
+
+def _copy(path, out):
+    with open(path, 'rb') as src:
+        shutil.copyfileobj(src, out)
+
+
+class RunState(object):
+    """
+    Progress of a resumable run, saved after every change
+    """
+
+    def __init__(self, out_dir):
+        self.resume_dir = os.path.join(os.path.abspath(out_dir), RESUME_DIR)
+        self.features_dir = os.path.join(self.resume_dir, 'features')
+        self.state_path = os.path.join(self.resume_dir, STATE_FILE)
+        os.makedirs(self.features_dir, exist_ok=True)
+        self.hasher = ContentHasher(os.path.join(self.resume_dir, 'stat'))
+        self.resumed = False
+        self.features = {}  # patient -> {'key', 'files': {calculator: sha256}}
+        self.failed = {}  # patient -> {'key', 'attempts', 'error'}
+        self.attempts = []  # Extraction runs, oldest first: {'name', 'keys': {patient: key}}
+        self.model = None  # {'fingerprint', 'files': {path: sha256}}
+
+    @classmethod
+    def load(cls, out_dir):
+        """
+        State of the previous run in out_dir, or a new state if there is none
+        """
+        state = cls(out_dir)
+        try:
+            with open(state.state_path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return state
+        except ValueError:
+            logger.warning("Resume: unreadable {}, starting from scratch", state.state_path)
+            return state
+        if saved.get('version') != STATE_VERSION:
+            logger.warning("Resume: state version {} is not supported, starting from scratch", saved.get('version'))
+            return state
+        state.features = saved['features']
+        state.failed = saved['failed']
+        state.attempts = saved['attempts']
+        state.model = saved['model']
+        state.resumed = True
+        logger.info("Resume: previous run found, {} patients extracted, {} failed, {} extraction runs",
+                    len(state.features), len(state.failed), len(state.attempts))
+        return state
+
+    def save(self):
+        state = {'version': STATE_VERSION, 'updated': time.time(), 'features': self.features,
+                 'failed': self.failed, 'attempts': self.attempts, 'model': self.model}
+        write_atomic(self.state_path, lambda f: f.write(json.dumps(state, indent=1, sort_keys=True).encode()))
+
+    def feature_files(self, pid):
+        """
+        Verified copies of the features of a patient
+
+        :return: dict calculator -> feature file
+        """
+        return {calculator: os.path.join(self.features_dir, pid, FEATURE_FILE_TEMPLATE.format(calculator))
+                for calculator in self.features[pid]['files']}
+
+    def _matches(self, pid):
+        return all(os.path.isfile(path) and sha256_file(path) == self.features[pid]['files'][calculator]
+                   for calculator, path in self.feature_files(pid).items())
+
+    def feature_keys(self, config, images, segmentations):
+        """
+        Key of the features of every patient: feature_store.feature_key of the input image
+        and mask, combined with the toolbox preprocessing settings (cropping) applied to them
+
+        :param images: Input images, before preprocessing
+        :param segmentations: Input segmentations, before preprocessing
+        :return: dict patient -> key
+        """
+        toolbox = json.dumps({name: config['Toolbox'].get(name) for name in TOOLBOX_PREPROCESSING}, sort_keys=True)
+        masks = {patient_id(path): path for path in segmentations}
+        keys = {}
+        for image in images:
+            key = feature_key(self.hasher, image, masks[patient_id(image)], config)
+            keys[patient_id(image)] = hashlib.sha256((key + toolbox).encode()).hexdigest()
+        return keys
+
+    def verify(self, keys):
+        """
+        Check the recorded features of the patients against their checksums; entries
+        of another image, mask or feature settings (other key) or that do not match
+        their checksum are dropped
+
+        :param keys: dict patient -> key of the current inputs
+        :return: dict patient -> {calculator: verified feature file}
+        """
+        verified = {}
+        for pid, entry in list(self.features.items()):
+            if keys.get(pid) != entry['key']:
+                del self.features[pid]
+            elif not self._matches(pid):
+                logger.warning("Resume: features of patient {} do not match their checksum, extracting again", pid)
+                del self.features[pid]
+            else:
+                verified[pid] = self.feature_files(pid)
+        self.failed = {pid: entry for pid, entry in self.failed.items() if keys.get(pid) == entry['key']}
+        self.save()
+        return verified
+
+    def pending(self, keys):
+        """
+        Patients still to extract: no verified features and fewer than MAX_ATTEMPTS failures
+        """
+        return sorted(pid for pid in keys if pid not in self.features and
+                      self.failed.get(pid, {}).get('attempts', 0) < MAX_ATTEMPTS)
+
+    def excluded(self):
+        """
+        Patients left out of the cohort after MAX_ATTEMPTS failed extractions
+        """
+        return sorted(pid for pid, entry in self.failed.items()
+                      if entry['attempts'] >= MAX_ATTEMPTS and pid not in self.features)
+
+    def start_attempt(self, experiment_name, keys, patients):
+        """
+        Record an extraction run before it starts, so its sinks are recovered if it is killed
+
+        :return: The name of the WORC experiment of the run
+        """
+        name = '{}_features{}'.format(experiment_name, len(self.attempts))
+        self.attempts.append({'name': name, 'keys': {pid: keys[pid] for pid in patients}})
+        self.save()
+        return name
+
+    def add(self, keys, feature_files):
+        """
+        Take the feature files of the patients whose files are all complete: each is copied
+        next to the state and its sha256 recorded
+
+        :param keys: dict patient -> key of the current inputs
+        :param feature_files: dict patient -> {calculator: feature file}
+        :return: dict patient -> {calculator: verified copy}, for the patients taken
+        """
+        added = {}
+        for pid, files in feature_files.items():
+            incomplete = [path for path in files.values() if not hdf5_complete(path)]
+            if incomplete:
+                logger.warning("Resume: incomplete feature files of patient {} ignored: {}", pid,
+                               ', '.join(incomplete))
+                continue
+            checksums = {}
+            for calculator, path in files.items():
+                dest = os.path.join(self.features_dir, pid, FEATURE_FILE_TEMPLATE.format(calculator))
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                write_atomic(dest, lambda out, src=path: _copy(src, out))
+                checksums[calculator] = sha256_file(dest)
+            self.features[pid] = {'key': keys[pid], 'files': checksums,
+                                  'sources': {calculator: os.path.abspath(path) for calculator, path in files.items()}}
+            self.failed.pop(pid, None)
+            added[pid] = self.feature_files(pid)
+        self.save()
+        return added
+
+    def collect(self, outputs_dir, keys, patients):
+        """
+        Take the complete feature sinks of the extraction runs, newest first, for the given patients
+
+        :param outputs_dir: Folder holding the output folder of every extraction run
+        :return: dict patient -> {calculator: verified copy}, for the patients collected
+        """
+        collected = {}
+        for attempt in reversed(self.attempts):
+            # Only sinks extracted from the same image, mask and feature settings
+            remaining = [pid for pid in patients if pid not in collected and attempt['keys'].get(pid) == keys[pid]]
+            if remaining:
+                found = find_feature_files(os.path.join(outputs_dir, attempt['name']), remaining)
+                collected.update(self.add(keys, found))
+        return collected
+
+    def mark_failed(self, keys, patients, error):
+        """
+        Record a failed extraction attempt of the given patients
+        """
+        for pid in patients:
+            entry = self.failed.get(pid)
+            if entry is None or entry['key'] != keys[pid]:
+                entry = {'key': keys[pid], 'attempts': 0}
+            entry['attempts'] += 1
+            entry['error'] = error
+            self.failed[pid] = entry
+            logger.error("Resume: extraction of patient {} failed ({} of {} attempts): {}",
+                         pid, entry['attempts'], MAX_ATTEMPTS, error)
+        self.save()
+
+    def features_directory(self, patients):
+        """
+        Lay the verified features of a cohort out as WORC's features_from_this_directory
+        expects: <resume>/cohort/<patient>/features_<calculator>.hdf5
+
+        :return: The folder to give to features_from_this_directory
+        """
+        directory = os.path.join(self.resume_dir, 'cohort')
+        shutil.rmtree(directory, ignore_errors=True)
+        for pid in patients:
+            link_feature_files(self.feature_files(pid), os.path.join(directory, pid))
+        return directory
+
+    def model_fingerprint(self, config, label_file, patients):
+        """
+        Fingerprint of the modelling stage: every setting but the toolbox-only ones,
+        the labels and the verified features of the cohort
+        """
+        content = json.dumps({
+            'config': config.section(*(name for name in config if name != 'Toolbox')).digest(),
+            'labels': sha256_file(label_file),
+            'features': {pid: self.features[pid]['files'] for pid in patients},
+        }, sort_keys=True)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def model_complete(self, fingerprint):
+        """
+        True if the modelling stage ran with this fingerprint and all its outputs match their checksums
+        """
+        if not self.model or self.model['fingerprint'] != fingerprint:
+            return False
+        for path, sha256 in self.model['files'].items():
+            if not os.path.isfile(path) or sha256_file(path) != sha256:
+                logger.warning("Resume: output {} does not match its checksum, modelling again", path)
+                return False
+        return True
+
+    def complete_model(self, fingerprint, output_dir):
+        """
+        Record the modelling stage and the checksums of the files it wrote in output_dir
+        """
+        files = {}
+        for dirpath, _, filenames in os.walk(output_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                files[path] = sha256_file(path)
+        self.model = {'fingerprint': fingerprint, 'files': files}
+        self.save()
@@ -0,0 +1,240 @@
+import fnmatch
+import os
+import struct
+import time
+import zlib
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import logger
+from utils.utils_gen import available_cpus
+
+# Extensions of already compressed files, stored in the archive without recompressing
+STORED_EXTENSIONS = ('.gz', '.zip', '.hdf5', '.h5', '.png', '.jpg', '.jpeg', '.npz', '.bz2', '.xz')
+
+# Archive profiles: name -> (include, exclude) glob patterns on the path relative to the archived folder
+ARCHIVE_PROFILES = {
+    'full': (('*',), ()),
+    # Everything but the images (e.g. the masks and images written by Segmentix / preprocessing)
+    'results': (('*',), ('*.nii', '*.nii.gz')),
+    # Performance, evaluation and configuration files only
+    'metrics': (('*.json', '*.csv', '*.tex', '*.txt', '*.ini', '*.png'), ()),
+}
+
+# Uncompressed bytes deflated per task; every block ends on a byte boundary (sync flush)
+ARCHIVE_BLOCK_SIZE = 4 * 1024 ** 2
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# Members larger than this get zip64 sizes (deflate can expand incompressible data slightly)
+_ZIP64_MEMBER_LIMIT = 2 ** 31
+_ZIP32_MAX = 0xFFFFFFFF
+
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+_DATA_DESCRIPTOR = struct.Struct('<4s3L')
+_DATA_DESCRIPTOR64 = struct.Struct('<4sL2Q')
+_CENTRAL_HEADER = struct.Struct('<4s4B4H3L5H2L')
+_END_RECORD = struct.Struct('<4s4H2LH')
+_END_RECORD64 = struct.Struct('<4sQ2H2L4Q')
+_END_LOCATOR64 = struct.Struct('<4sLQL')
+
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+
+
+def select_files(root_dir, profile='full', prefix=''):
+    '''
+    Files of a folder matching an archive profile, in a stable order
+    :param profile: Name of one of ARCHIVE_PROFILES
+    :param prefix: Folder prepended to the member names, e.g. the name of root_dir
+    :return: List of (path, arcname), arcname being the '/' separated path relative to root_dir
+    '''
+    if profile not in ARCHIVE_PROFILES:
+        raise ValueError('Unknown archive profile {!r}, expected one of {}'.format(
+            profile, ', '.join(sorted(ARCHIVE_PROFILES))))
+    include, exclude = ARCHIVE_PROFILES[profile]
+    selected = []
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            arcname = os.path.relpath(path, root_dir).replace(os.sep, '/')
+            if any(fnmatch.fnmatch(arcname, pattern) for pattern in include) and \
+                    not any(fnmatch.fnmatch(arcname, pattern) for pattern in exclude):
+                selected.append((path, prefix + '/' + arcname if prefix else arcname))
+    return selected
+
+
+def _dos_datetime(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1  # 1980-01-01 00:00
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def _deflate(block, compresslevel, last):
+    '''
+    Raw deflate of one block. Blocks are compressed independently and all but the
+    last end with a sync flush, so their concatenation is a single valid deflate stream
+    '''
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ZipStreamWriter(object):
+    '''
+    Zip archive written sequentially to a file object, without seeking.
+
+    Every member has a data descriptor (its CRC and sizes follow the data), so
+    the output can be a pipe or a file on a parallel file system written in one
+    pass. Already compressed files are stored, the others are deflated in
+    blocks of block_size across threads, at most 2 * n_threads blocks in flight.
+    Members and archives over 4 GiB use zip64 records.
+    '''
+
+    def __init__(self, fileobj, compresslevel=6, n_threads=None, block_size=ARCHIVE_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.n_threads = n_threads or available_cpus()
+        self._executor = ThreadPoolExecutor(max_workers=self.n_threads)
+        self._entries = []
+        self._offset = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(wait=True)
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self._offset += len(data)
+
+    def write(self, path, arcname, compress=None):
+        '''
+        Add a file to the archive
+        :param compress: Deflate the file. Defaults to False for STORED_EXTENSIONS, True otherwise
+        '''
+        if compress is None:
+            compress = not path.lower().endswith(STORED_EXTENSIONS)
+        stat = os.stat(path)
+        name = arcname.encode('utf-8')
+        flags = _FLAG_DATA_DESCRIPTOR | (0 if arcname.isascii() else _FLAG_UTF8)
+        method = ZIP_DEFLATED if compress else ZIP_STORED
+        zip64 = stat.st_size >= _ZIP64_MEMBER_LIMIT
+        dostime, dosdate = _dos_datetime(stat.st_mtime)
+        entry = {'name': name, 'flags': flags, 'method': method, 'zip64': zip64, 'offset': self._offset,
+                 'dostime': dostime, 'dosdate': dosdate, 'mode': stat.st_mode}
+
+        # Sizes and CRC are not known yet: zero here, given by the data descriptor
+        extra = struct.pack('<2H2Q', 1, 16, 0, 0) if zip64 else b''
+        unknown = _ZIP32_MAX if zip64 else 0
+        self._write(_LOCAL_HEADER.pack(b'PK\x03\x04', 45 if zip64 else 20, flags, method, dostime, dosdate,
+                                       0, unknown, unknown, len(name), len(extra)) + name + extra)
+
+        crc, size, compressed_size = 0, 0, 0
+        pending = deque()
+        with open(path, 'rb') as f:
+            block = f.read(self.block_size)
+            while True:
+                following = f.read(self.block_size) if len(block) == self.block_size else b''
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                if not compress:
+                    self._write(block)
+                    compressed_size += len(block)
+                else:
+                    pending.append(self._executor.submit(_deflate, block, self.compresslevel, not following))
+                    while len(pending) > 2 * self.n_threads or (pending and not following):
+                        data = pending.popleft().result()
+                        self._write(data)
+                        compressed_size += len(data)
+                if not following:
+                    break
+                block = following
+
+        if zip64:
+            self._write(_DATA_DESCRIPTOR64.pack(b'PK\x07\x08', crc, compressed_size, size))
+        else:
+            self._write(_DATA_DESCRIPTOR.pack(b'PK\x07\x08', crc, compressed_size, size))
+        entry.update(crc=crc, size=size, compressed_size=compressed_size)
+        self._entries.append(entry)
+        return entry
+
+    def close(self):
+        '''
+        Write the central directory. The file object is not closed
+        '''
+        if self.closed:
+            return
+        self._executor.shutdown(wait=True)
+        directory_offset = self._offset
+        for entry in self._entries:
+            zip64_fields = []
+            size, compressed_size, offset = entry['size'], entry['compressed_size'], entry['offset']
+            if entry['zip64'] or size >= _ZIP32_MAX:
+                zip64_fields += [size, compressed_size]
+                size = compressed_size = _ZIP32_MAX
+            if offset >= _ZIP32_MAX:
+                zip64_fields.append(offset)
+                offset = _ZIP32_MAX
+            extra = struct.pack('<2H{}Q'.format(len(zip64_fields)), 1, 8 * len(zip64_fields),
+                                *zip64_fields) if zip64_fields else b''
+            version = 45 if zip64_fields else 20
+            self._write(_CENTRAL_HEADER.pack(
+                b'PK\x01\x02', version, 3, version, 0, entry['flags'], entry['method'], entry['dostime'],
+                entry['dosdate'], entry['crc'], compressed_size, size, len(entry['name']), len(extra), 0, 0, 0,
+                (entry['mode'] & 0xFFFF) << 16, offset) + entry['name'] + extra)
+        directory_size = self._offset - directory_offset
+
+        count = len(self._entries)
+        if count >= 0xFFFF or directory_offset >= _ZIP32_MAX or directory_size >= _ZIP32_MAX:
+            end64_offset = self._offset
+            self._write(_END_RECORD64.pack(b'PK\x06\x06', _END_RECORD64.size - 12, 45, 45, 0, 0,
+                                           count, count, directory_size, directory_offset))
+            self._write(_END_LOCATOR64.pack(b'PK\x06\x07', 0, end64_offset, 1))
+            self._write(_END_RECORD.pack(b'PK\x05\x06', 0, 0, 0xFFFF, 0xFFFF, _ZIP32_MAX, _ZIP32_MAX, 0))
+        else:
+            self._write(_END_RECORD.pack(b'PK\x05\x06', 0, 0, count, count, directory_size, directory_offset, 0))
+        self.closed = True
+
+
+def archive_folder(zip_path, root_dir, profile='full', compresslevel=6, n_threads=None, prefix=''):
+    '''
+    Zip the files of a folder selected by an archive profile, replacing shutil.make_archive.
+
+    Already compressed files (STORED_EXTENSIONS) are stored as they are and the
+    others deflated across threads (see ZipStreamWriter). The archive is written
+    next to zip_path and published with an atomic rename.
+    :param zip_path: Path of the archive, including the .zip extension
+    :param root_dir: Folder to archive; the member names are relative to it
+    :param profile: Name of one of ARCHIVE_PROFILES
+    :param compresslevel: Deflate level 1-9
+    :param n_threads: Compression threads. Defaults to the CPUs available to the process
+    :param prefix: Folder prepended to the member names (see select_files)
+    :return: zip_path
+    '''
+    files = select_files(root_dir, profile, prefix)
+    tmp_path = '{}.{}.tmp'.format(zip_path, os.getpid())
+    stored = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            with ZipStreamWriter(f, compresslevel=compresslevel, n_threads=n_threads) as archive:
+                for path, arcname in files:
+                    stored += archive.write(path, arcname)['method'] == ZIP_STORED
+        os.replace(tmp_path, zip_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    logger.info("Archived {} files of {} ({} profile, {} stored as-is) into {}",
+                len(files), root_dir, profile, stored, zip_path)
+    return zip_path
@@ -0,0 +1,160 @@
+import glob
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+MANIFEST_VERSION = 1
+
+
+def _parse_iteration(file_name, name):
+    '''
+    Iteration number of a '<name>-<iteration>.<suffix>' checkpoint file, or None
+    '''
+    match = re.match(r'{}-(\d+)(\..*)?$'.format(re.escape(name)), file_name)
+    return (int(match.group(1)), match.group(2) or '') if match else None
+
+
+class CheckpointManager(object):
+    '''
+    Checkpoints of a model in a folder, tracked by a manifest (<name>.manifest.json).
+
+    A checkpoint is a set of files sharing the prefix <name>-<iteration>, e.g. the
+    .index / .data / .meta files of a tensorflow saver. They are written in a
+    temporary folder and renamed into place, then the manifest is replaced
+    atomically: a crash mid-save never leaves a checkpoint that the manifest
+    references but that is incomplete. The latest and best checkpoints are read
+    from the manifest, the folder is never listed to find them.
+
+    Retention keeps the keep_last most recent checkpoints plus the keep_best
+    ones with the best metric; the files of every other checkpoint are removed.
+    A single process is expected to save into a folder/name at a time.
+    '''
+
+    def __init__(self, folder, name, keep_last=5, keep_best=1, mode='min'):
+        '''
+        :param folder: Folder where the checkpoints are saved
+        :param name: Name under which the model is saved
+        :param keep_last: Number of most recent checkpoints kept, None to keep all
+        :param keep_best: Number of best checkpoints (by metric) kept on top of those
+        :param mode: 'min' if a lower metric is better (e.g. a loss), 'max' otherwise
+        '''
+        if mode not in ('min', 'max'):
+            raise ValueError("mode must be 'min' or 'max', got {!r}".format(mode))
+        self.folder = folder
+        self.name = name
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.mode = mode
+        self.manifest_path = os.path.join(folder, '{}.manifest.json'.format(name))
+        self.checkpoints = self._load()
+
+    def _load(self):
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION:
+                return manifest['checkpoints']
+        except (OSError, ValueError, KeyError):
+            pass
+        return self._adopt_existing()
+
+    def _adopt_existing(self):
+        '''
+        Build the checkpoint list from files saved before the manifest existed (one directory listing)
+        '''
+        found = {}
+        for path in glob.glob(os.path.join(glob.escape(self.folder), '{}-*'.format(glob.escape(self.name)))):
+            parsed = _parse_iteration(os.path.basename(path), self.name)
+            if parsed is not None:
+                found.setdefault(parsed[0], []).append(parsed[1])
+        return [{'iteration': iteration, 'suffixes': sorted(suffixes), 'metric': None, 'time': None}
+                for iteration, suffixes in sorted(found.items())]
+
+    def _write_manifest(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix='.{}.manifest.'.format(self.name), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': MANIFEST_VERSION, 'name': self.name, 'mode': self.mode,
+                           'checkpoints': self.checkpoints}, f, indent=1)
+            os.replace(tmp_path, self.manifest_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def prefix(self, iteration):
+        '''
+        Path prefix of the checkpoint files of an iteration
+        '''
+        return os.path.join(self.folder, '{}-{}'.format(self.name, iteration))
+
+    def save(self, iteration, write, metric=None):
+        '''
+        Save a checkpoint and apply the retention policy
+        :param iteration: Training iteration of the checkpoint
+        :param write: Callable writing the checkpoint files given a path prefix, e.g.
+                      lambda prefix: saver.save(sess, prefix, write_state=False)
+        :param metric: Optional validation metric used to rank the best checkpoints
+        :return: The path prefix of the saved checkpoint
+        '''
+        os.makedirs(self.folder, exist_ok=True)
+        tmp_folder = tempfile.mkdtemp(dir=self.folder, prefix='.tmp-{}-'.format(self.name))
+        try:
+            tmp_prefix = os.path.join(tmp_folder, '{}-{}'.format(self.name, iteration))
+            write(tmp_prefix)
+            suffixes = sorted(entry[len(os.path.basename(tmp_prefix)):] for entry in os.listdir(tmp_folder))
+            if not suffixes:
+                raise ValueError('No checkpoint files were written for iteration {}'.format(iteration))
+            for suffix in suffixes:
+                os.replace(tmp_prefix + suffix, self.prefix(iteration) + suffix)
+        finally:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+
+        entry = {'iteration': int(iteration), 'suffixes': suffixes,
+                 'metric': None if metric is None else float(metric), 'time': time.time()}
+        self.checkpoints = [c for c in self.checkpoints if c['iteration'] != entry['iteration']] + [entry]
+        self.checkpoints.sort(key=lambda c: c['iteration'])
+        removed = self._apply_retention()
+        self._write_manifest()
+        # Files are deleted only once the manifest no longer references them
+        for checkpoint in removed:
+            for suffix in checkpoint['suffixes']:
+                try:
+                    os.unlink(self.prefix(checkpoint['iteration']) + suffix)
+                except FileNotFoundError:
+                    pass
+        return self.prefix(iteration)
+
+    def _ranked(self):
+        scored = [c for c in self.checkpoints if c['metric'] is not None]
+        return sorted(scored, key=lambda c: c['metric'], reverse=self.mode == 'max')
+
+    def _apply_retention(self):
+        keep = set()
+        if self.keep_last is None:
+            keep.update(c['iteration'] for c in self.checkpoints)
+        else:
+            keep.update(c['iteration'] for c in self.checkpoints[len(self.checkpoints) - self.keep_last:])
+        keep.update(c['iteration'] for c in self._ranked()[:self.keep_best])
+        removed = [c for c in self.checkpoints if c['iteration'] not in keep]
+        self.checkpoints = [c for c in self.checkpoints if c['iteration'] in keep]
+        return removed
+
+    def latest(self):
+        '''
+        :return: Path prefix of the checkpoint with the highest iteration, None if there is none
+        '''
+        if not self.checkpoints:
+            return None
+        return self.prefix(self.checkpoints[-1]['iteration'])
+
+    def best(self):
+        '''
+        :return: Path prefix of the checkpoint with the best metric, None if no checkpoint has one
+        '''
+        ranked = self._ranked()
+        if not ranked:
+            return None
+        return self.prefix(ranked[0]['iteration'])
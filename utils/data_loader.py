@@ -0,0 +1,156 @@
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from utils.nii_cache import load_nii_cached
+from utils.image_utils import normalise_image
+from utils.utils_gen import available_cpus
+
+# Ring buffer attached by each worker process (see _attach_buffer)
+_worker_shm = None
+_worker_buffer = None
+
+
+def load_sample(path, rng, augmentation=None):
+    '''
+    Default sample function: load a nifti file (through the decompressed-volume cache
+    when one is configured), normalise it and optionally augment it
+    :param path: Path to the image
+    :param rng: np.random.Generator for this sample
+    :param augmentation: Optional callable (image, rng) -> image, e.g. an AffineAugmentation
+    :return: The sample as a float32 array
+    '''
+    image, _, _ = load_nii_cached(path, lazy=False)
+    image = normalise_image(image)
+    if augmentation is not None:
+        image = augmentation(image, rng)
+    return image
+
+
+def _attach_buffer(name, shape, dtype):
+    '''
+    Worker initializer: map the shared ring buffer into this process
+    '''
+    global _worker_shm, _worker_buffer  # pylint: disable=global-statement
+    _worker_shm = shared_memory.SharedMemory(name=name)
+    _worker_buffer = np.ndarray(shape, dtype=dtype, buffer=_worker_shm.buf)
+
+
+def _fill_sample(slot, pos, sample_fn, sample, seed_seq):
+    '''
+    Worker task: compute one sample and write it straight into its ring buffer slot
+    '''
+    _worker_buffer[slot, pos] = sample_fn(sample, np.random.default_rng(seed_seq))
+
+
+class PrefetchBatchLoader(object):
+    '''
+    Multi-worker batch loader writing samples into a ring buffer in shared memory.
+
+    Samples are read and augmented in a process pool while the consumer works on
+    the current batch. Batches are handed out as zero-copy views into the ring
+    buffer: a batch is only valid until the next one is requested, copy it if it
+    has to outlive the iteration step.
+
+    Example
+    -------
+    >>> with PrefetchBatchLoader(paths, load_sample, (256, 256, 64), batch_size=4) as loader:
+    ...     for batch in loader:
+    ...         train_step(batch)
+    '''
+
+    def __init__(self, samples, sample_fn, sample_shape, dtype=np.float32, batch_size=1,  # pylint: disable=too-many-arguments
+                 prefetch=2, n_workers=None, shuffle=False, seed=None, mp_context=None):
+        '''
+        :param samples: Sequence of sample descriptors (e.g. file paths) passed to sample_fn
+        :param sample_fn: Picklable callable (sample, rng) -> array of sample_shape
+        :param sample_shape: Shape of a single sample
+        :param dtype: dtype of the batches
+        :param batch_size: Samples per batch; the last batch may be smaller
+        :param prefetch: Number of batches prepared ahead of the one being consumed
+        :param n_workers: Worker processes. Defaults to the CPUs available to the process
+        :param shuffle: Shuffle the sample order at every epoch
+        :param seed: Seed for the shuffling and the per-sample generators
+        :param mp_context: Optional multiprocessing context for the pool
+        '''
+        if prefetch < 1:
+            raise ValueError('prefetch must be at least 1')
+
+        self.samples = list(samples)
+        self.sample_fn = sample_fn
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.n_slots = prefetch + 1
+        self._seed_seq = np.random.SeedSequence(seed)
+        self._rng = np.random.default_rng(self._seed_seq.spawn(1)[0])
+
+        shape = (self.n_slots, batch_size) + tuple(sample_shape)
+        nbytes = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        self._shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self._buffer = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf)
+        self._pool = ProcessPoolExecutor(max_workers=n_workers or available_cpus(), mp_context=mp_context,
+                                         initializer=_attach_buffer,
+                                         initargs=(self._shm.name, shape, np.dtype(dtype)))
+
+    def __len__(self):
+        return -(-len(self.samples) // self.batch_size)
+
+    def _submit(self, order, seeds, batch_idx):
+        '''
+        Schedule every sample of a batch into its ring buffer slot
+        '''
+        slot = batch_idx % self.n_slots
+        start = batch_idx * self.batch_size
+        indices = order[start:start + self.batch_size]
+        return [self._pool.submit(_fill_sample, slot, pos, self.sample_fn, self.samples[ii], seeds[ii])
+                for pos, ii in enumerate(indices)]
+
+    def __iter__(self):
+        '''
+        One epoch over the samples
+        '''
+        n_batches = len(self)
+        order = self._rng.permutation(len(self.samples)) if self.shuffle else np.arange(len(self.samples))
+        seeds = self._seed_seq.spawn(len(self.samples))
+
+        pending = {}
+        for batch_idx in range(min(self.n_slots, n_batches)):
+            pending[batch_idx] = self._submit(order, seeds, batch_idx)
+
+        try:
+            for batch_idx in range(n_batches):
+                # The slot of the previous batch is free again once the consumer asks for the next one
+                ahead = batch_idx - 1 + self.n_slots
+                if batch_idx > 0 and ahead < n_batches:
+                    pending[ahead] = self._submit(order, seeds, ahead)
+
+                futures = pending.pop(batch_idx)
+                for future in futures:
+                    future.result()
+                yield self._buffer[batch_idx % self.n_slots, :len(futures)]
+        finally:
+            # Do not let an abandoned epoch keep writing into slots a new epoch may use
+            for futures in pending.values():
+                for future in futures:
+                    future.cancel()
+                    if not future.cancelled():
+                        future.exception()
+
+    def close(self):
+        '''
+        Stop the workers and release the shared memory
+        '''
+        if self._pool is None:
+            return
+        self._pool.shutdown(wait=True)
+        self._pool = None
+        self._buffer = None
+        self._shm.close()
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,104 +1,687 @@
 import numpy as np
 import logging
+import itertools
 
-from skimage import measure
+from concurrent.futures import ThreadPoolExecutor
+from numpy.lib.stride_tricks import sliding_window_view
+
+from utils.utils_gen import available_cpus
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 
-try:
-    import cv2
-except:
-    logging.warning('Could not import opencv. Augmentation functions will be unavailable.')
-else:
-    def rotate_image(img, angle, interp=cv2.INTER_LINEAR):
+# OpenCV interpolation flags (cv2.INTER_NEAREST, cv2.INTER_LINEAR), so defaults need no cv2 import
+INTER_NEAREST = 0
+INTER_LINEAR = 1
+
+
+def _import_cv2():
+    '''
+    OpenCV is imported on first use: it is slow to import and only the augmentation functions need it
+    '''
+    try:
+        import cv2  # pylint: disable=import-outside-toplevel
+    except ImportError as error:
+        raise ImportError('Could not import opencv. Augmentation functions are unavailable.') from error
+    return cv2
+
 
-        rows, cols = img.shape[:2]
-        rotation_matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), angle, 1)
-        return cv2.warpAffine(img, rotation_matrix, (cols, rows), flags=interp)
+def rotate_image(img, angle, interp=INTER_LINEAR):
 
+    cv2 = _import_cv2()
+    rows, cols = img.shape[:2]
+    rotation_matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), angle, 1)
+    return cv2.warpAffine(img, rotation_matrix, (cols, rows), flags=interp)
 
-    def resize_image(im, size, interp=cv2.INTER_LINEAR):
 
-        im_resized = cv2.resize(im, (size[1], size[0]), interpolation=interp)  # swap sizes to account for weird OCV API
-        return im_resized
+def resize_image(im, size, interp=INTER_LINEAR):
 
+    cv2 = _import_cv2()
+    im_resized = cv2.resize(im, (size[1], size[0]), interpolation=interp)  # swap sizes to account for weird OCV API
+    return im_resized
 
-    def shear_image(im, factor=0.2, interp=cv2.INTER_LINEAR):
 
-        shear_factor = np.random.uniform(0.0, factor)
+def shear_image(im, factor=0.2, interp=INTER_LINEAR, rng=None):
 
-        w,h = im.shape[1], im.shape[0]
+    cv2 = _import_cv2()
+    shear_factor = (np.random if rng is None else rng).uniform(0.0, factor)
 
-        M = np.array([[1, abs(shear_factor), 0],[0,1,0]])
+    w,h = im.shape[1], im.shape[0]
 
-        nW =  im.shape[1] + abs(shear_factor*im.shape[0])
+    M = np.array([[1, abs(shear_factor), 0],[0,1,0]])
 
-        im_sheared = cv2.warpAffine(im, M, (int(nW), im.shape[0]))
+    nW =  im.shape[1] + abs(shear_factor*im.shape[0])
 
-        im_sheared = cv2.resize(im_sheared, (w,h))
+    im_sheared = cv2.warpAffine(im, M, (int(nW), im.shape[0]))
 
-        return im_sheared
+    im_sheared = cv2.resize(im_sheared, (w,h))
 
+    return im_sheared
 
-def convert_to_uint8(image):
-    image = image - image.min()
-    image = 255.0*np.divide(image.astype(np.float32),image.max())
-    return image.astype(np.uint8)
 
-def normalise_image(image, mean=0, std=1):
+def rotation_matrix(shape, angle):
     '''
-    make image zero mean and unit standard deviation (default values)
+    3x3 homogeneous matrix rotating an image of the given shape about its centre,
+    as rotate_image does
     '''
-    img_o = np.float32(image.copy())
-    m = np.mean(img_o)
-    s = np.std(img_o)
-    return np.divide(std*(img_o - m + mean), s)
+    cv2 = _import_cv2()
+    rows, cols = shape[:2]
+    return np.vstack([cv2.getRotationMatrix2D((cols / 2, rows / 2), angle, 1), [0, 0, 1]])
+
 
-def normalise_images(X):
+def shear_matrix(shape, shear_factor):
     '''
-    Helper for making the images zero mean and unit standard deviation i.e. `white`
+    3x3 homogeneous matrix shearing along x and squeezing the result back into
+    the original width, as shear_image does
+    '''
+    rows, cols = shape[:2]
+    squeeze = cols / (cols + abs(shear_factor * rows))
+    return np.array([[squeeze, squeeze * abs(shear_factor), 0], [0, 1, 0], [0, 0, 1]])
+
+
+def resize_matrix(shape, size):
+    '''
+    3x3 homogeneous matrix mapping an image of the given shape onto `size` (rows, cols),
+    using the pixel-centre convention of cv2.resize
+    '''
+    sy, sx = size[0] / shape[0], size[1] / shape[1]
+    return np.array([[sx, 0, 0.5 * sx - 0.5], [0, sy, 0.5 * sy - 0.5], [0, 0, 1]])
+
+
+def warp_volume(volume, matrix, size=None, interp=INTER_LINEAR, out=None, executor=None):
+    '''
+    Applies a 2x3 (or 3x3) affine matrix to every slice of a volume with one
+    cv2.warpAffine per slice.
+    :param volume: 2D image (rows, cols) or volume (rows, cols, slices)
+    :param matrix: Affine matrix mapping input to output pixel coordinates
+    :param size: Output (rows, cols). Defaults to the input size
+    :param interp: OpenCV interpolation flag, use INTER_NEAREST for masks
+    :param out: Optional preallocated output of shape size + volume.shape[2:]
+    :param executor: Optional concurrent.futures executor to spread the slices over
+    :return: The warped volume
+    '''
+    cv2 = _import_cv2()
+    rows, cols = volume.shape[:2] if size is None else size
+    matrix = np.asarray(matrix, dtype=np.float64)[:2]
+    if out is None:
+        out = np.empty((rows, cols) + volume.shape[2:], dtype=volume.dtype)
+
+    if volume.ndim == 2:
+        out[...] = cv2.warpAffine(np.ascontiguousarray(volume), matrix, (cols, rows), flags=interp)
+        return out
+
+    def _warp_slice(k):
+        out[:, :, k] = cv2.warpAffine(np.ascontiguousarray(volume[:, :, k]), matrix,
+                                      (cols, rows), flags=interp)
+
+    slices = range(volume.shape[2])
+    if executor is None:
+        for k in slices:
+            _warp_slice(k)
+    else:
+        list(executor.map(_warp_slice, slices))
+    return out
+
+
+class AffineAugmentation(object):
+    '''
+    Random rotate + shear + resize augmentation folded into a single affine matrix,
+    so every slice is interpolated once instead of once per transform.
+
+    Randomness comes only from the np.random.Generator passed in, never from the
+    global np.random state. augment_batch spawns an independent generator per
+    sample from one seed, so results do not depend on thread scheduling.
+    '''
+
+    def __init__(self, max_angle=0.0, max_shear=0.0, size=None, interp=INTER_LINEAR, n_threads=None):
+        '''
+        :param max_angle: Rotation angles are drawn uniformly from [-max_angle, max_angle] degrees
+        :param max_shear: Shear factors are drawn uniformly from [0, max_shear], as in shear_image
+        :param size: Output (rows, cols). Defaults to the input size
+        :param interp: Interpolation used for images; masks always use nearest neighbour
+        :param n_threads: Worker threads. OpenCV releases the GIL, so threads scale
+        '''
+        self.max_angle = max_angle
+        self.max_shear = max_shear
+        self.size = size
+        self.interp = interp
+        self.n_threads = n_threads or available_cpus()
+
+    def sample_matrix(self, shape, rng):
+        '''
+        Draws one composed 3x3 affine matrix for an image of the given shape
+        '''
+        size = shape[:2] if self.size is None else self.size
+        matrix = resize_matrix(shape, size)
+        if self.max_shear:
+            matrix = matrix @ shear_matrix(shape, rng.uniform(0.0, self.max_shear))
+        if self.max_angle:
+            matrix = matrix @ rotation_matrix(shape, rng.uniform(-self.max_angle, self.max_angle))
+        return matrix
+
+    def __call__(self, image, rng, mask=None, executor=None):
+        '''
+        Augments one image (and optionally its mask with the same transform)
+        :return: The augmented image, or (image, mask) if a mask is given
+        '''
+        size = image.shape[:2] if self.size is None else self.size
+        matrix = self.sample_matrix(image.shape, rng)
+        image = warp_volume(image, matrix, size, self.interp, executor=executor)
+        if mask is None:
+            return image
+        return image, warp_volume(mask, matrix, size, INTER_NEAREST, executor=executor)
+
+    def augment_volume(self, image, rng, mask=None):
+        '''
+        Augments one volume, spreading its slices over the thread pool
+        '''
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            return self(image, rng, mask=mask, executor=executor)
+
+    def augment_batch(self, X, seed=None, masks=None, out=None, out_masks=None):
+        '''
+        Augments a batch (N, rows, cols[, slices]) with one sample per worker task.
+        :param X: Batch of images
+        :param seed: Seed for np.random.SeedSequence; one child generator is spawned per sample
+        :param masks: Optional batch of masks, warped with the same matrices as X
+        :param out: Optional preallocated output batch
+        :param out_masks: Optional preallocated output batch for the masks
+        :return: The augmented batch, or (batch, masks) if masks are given
+        '''
+        size = X.shape[1:3] if self.size is None else tuple(self.size)
+        if out is None:
+            out = np.empty((X.shape[0],) + size + X.shape[3:], dtype=X.dtype)
+        if masks is not None and out_masks is None:
+            out_masks = np.empty((masks.shape[0],) + size + masks.shape[3:], dtype=masks.dtype)
+
+        generators = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(X.shape[0])]
+
+        def _augment_sample(ii):
+            matrix = self.sample_matrix(X.shape[1:], generators[ii])
+            warp_volume(X[ii], matrix, size, self.interp, out=out[ii])
+            if masks is not None:
+                warp_volume(masks[ii], matrix, size, INTER_NEAREST, out=out_masks[ii])
+
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            list(executor.map(_augment_sample, range(X.shape[0])))
+
+        if masks is None:
+            return out
+        return out, out_masks
+
+
+def convert_to_uint8(image, out=None):
+    return preprocess_image(image, method=None, quantise=True, out=out)
+
+
+# Upper bound on the float32 scratch slab used by preprocess_image
+_PREPROCESS_SLAB_BYTES = 32 * 1024 ** 2
+
+
+def parse_clipping_range(clipping_range):
+    '''
+    Parses a Preprocessing:Clipping_Range value such as '-1000.0, 3000.0'
+    '''
+    if isinstance(clipping_range, str):
+        clipping_range = clipping_range.split(',')
+    lower, upper = (float(v) for v in clipping_range)
+    return lower, upper
+
+
+def robust_percentiles(values, q):
+    '''
+    Percentiles (linear interpolation, as np.percentile) using a single np.partition
+    instead of a full sort. `values` is partitioned in place, pass a copy if needed.
+    :param values: 1D array
+    :param q: Percentile or sequence of percentiles in [0, 100]
+    :return: float or array of floats
+    '''
+    q_arr = np.atleast_1d(np.asarray(q, dtype=np.float64))
+    if values.size == 0:
+        raise ValueError('Cannot compute percentiles of an empty array')
+    pos = q_arr / 100.0 * (values.size - 1)
+    lo = np.floor(pos).astype(np.intp)
+    hi = np.minimum(lo + 1, values.size - 1)
+    values.partition(np.unique(np.concatenate([lo, hi])))
+    v_lo = values[lo].astype(np.float64)
+    result = v_lo + (pos - lo) * (values[hi] - v_lo)
+    return result if np.ndim(q) else float(result[0])
+
+
+def _slabs(shape, itemsize):
+    '''
+    Slices along the first axis sized so that one slab stays under _PREPROCESS_SLAB_BYTES
+    '''
+    slab_bytes = max(1, int(np.prod(shape[1:])) * itemsize)
+    step = max(1, _PREPROCESS_SLAB_BYTES // slab_bytes)
+    return [slice(start, min(start + step, shape[0])) for start in range(0, shape[0], step)]
+
+
+def _clipped_slabs(image, mask, lower, upper):
+    '''
+    Clipped values of the image (inside the mask) as float64 copies, slab by slab
+    '''
+    for sl in _slabs(image.shape, 8):
+        values = np.array(image[sl], dtype=np.float64)
+        if mask is not None:
+            values = values[np.asarray(mask[sl], dtype=bool)]
+        if values.size:
+            yield np.clip(values, lower, upper, out=values)
+
+
+def _clipped_moments(image, mask, lower, upper):
+    '''
+    Mean and standard deviation of the clipped image (inside the mask), merged slab by slab
+    '''
+    count, mean, m2 = 0, 0.0, 0.0
+    for values in _clipped_slabs(image, mask, lower, upper):
+        n_b, mean_b = values.size, values.mean()
+        values -= mean_b
+        m2_b = np.dot(values.ravel(), values.ravel())
+        delta = mean_b - mean
+        total = count + n_b
+        mean += delta * n_b / total
+        m2 += m2_b + delta ** 2 * count * n_b / total
+        count = total
+    if count == 0:
+        raise ValueError('Empty ROI: cannot compute normalisation statistics')
+    return mean, np.sqrt(m2 / count)
+
+
+def preprocess_image(image, clip_range=None, method='z_score', mask=None,  # pylint: disable=too-many-arguments,too-many-locals
+                     quantise=False, out=None):
+    '''
+    Fused clipping, intensity normalisation and optional uint8 quantisation.
+
+    Statistics are gathered first, slab by slab (moments, extremes, and the clipped
+    ROI values in float32 for the median through np.partition); as clipping, normalisation and quantisation are all monotonic,
+    they then collapse into one clip followed by one affine map, applied slab by
+    slab through a single float32 scratch buffer into the preallocated output.
+    :param image: Image or volume, may be a np.memmap
+    :param clip_range: Optional (lower, upper) bounds, as Preprocessing:Clipping_Range
+    :param method: 'z_score' (zero mean, unit std), 'minmed' ((x - min) * 0.5 / (median - min),
+                   as WORC) or None for no normalisation
+    :param mask: Optional ROI the statistics are taken from (WORC's Normalize_ROI)
+    :param quantise: Rescale the result to the full 0-255 range and return uint8
+    :param out: Optional preallocated output (float32, or uint8 when quantising)
+    :return: The preprocessed image
+    '''
+    if mask is not None and mask.shape != image.shape:
+        raise ValueError('mask has shape {} but image has shape {}'.format(mask.shape, image.shape))
+    lower, upper = (-np.inf, np.inf) if clip_range is None else parse_clipping_range(clip_range)
+
+    # Extremes of the clipped image, needed for minmed and quantisation, and the
+    # clipped ROI values for the minmed median
+    if method == 'minmed' or quantise:
+        v_min, v_max, count = np.inf, -np.inf, 0
+        if method == 'minmed':
+            roi = np.empty(image.size if mask is None else int(np.count_nonzero(mask)), dtype=np.float32)
+        for values in _clipped_slabs(image, mask, lower, upper):
+            v_min, v_max = min(v_min, float(values.min())), max(v_max, float(values.max()))
+            if method == 'minmed':
+                roi[count:count + values.size] = values.ravel()
+            count += values.size
+        if count == 0:
+            raise ValueError('Empty ROI: cannot compute normalisation statistics')
+
+    if method == 'z_score':
+        center, s = _clipped_moments(image, mask, lower, upper)
+        scale = 1.0 / s if s > 0 else 1.0
+        shift = -center
+    elif method == 'minmed':
+        # Median of the shifted values, so the result does not flip sign with the data
+        median = robust_percentiles(roi, 50) - v_min
+        if median > 0:
+            scale = 0.5 / median
+        else:
+            logging.warning('minmed normalisation: the median equals the minimum (%s), not scaling', v_min)
+            scale = 1.0
+        shift = -v_min
+    elif method is None:
+        scale, shift = 1.0, 0.0
+    else:
+        raise ValueError('Unknown normalisation method {}'.format(method))
+
+    # Fold the normalisation and the quantisation into y = clip(x) * a + b
+    a, b = scale, shift * scale
+    if quantise:
+        n_min, n_max = (v_min + shift) * scale, (v_max + shift) * scale
+        q_scale = 255.0 / (n_max - n_min) if n_max > n_min else 0.0
+        a, b = a * q_scale, (b - n_min) * q_scale
+
+    out_dtype = np.uint8 if quantise else np.float32
+    if out is None:
+        out = np.empty(image.shape, dtype=out_dtype)
+    elif out.shape != image.shape:
+        raise ValueError('out has shape {} but image has shape {}'.format(out.shape, image.shape))
+
+    slabs = _slabs(image.shape, 4)
+    scratch = np.empty((slabs[0].stop - slabs[0].start,) + image.shape[1:], dtype=np.float32)
+    for sl in slabs:
+        tmp = scratch[:sl.stop - sl.start]
+        np.clip(image[sl], lower, upper, out=tmp, casting='unsafe')
+        tmp *= a
+        tmp += b
+        if quantise:
+            np.rint(tmp, out=tmp)
+            np.clip(tmp, 0, 255, out=tmp)
+        out[sl] = tmp
+    return out
+
+
+def preprocess_from_config(image, preprocessing, mask=None, quantise=False, out=None):
+    '''
+    Runs preprocess_image with the [Preprocessing] section of the toolbox config
+    (the Clipping, Clipping_Range, Normalize and Method keys sent to WORC)
     '''
+    clip_range = preprocessing.get('Clipping_Range') if preprocessing.get('Clipping') else None
+    method = preprocessing.get('Method', 'z_score') if preprocessing.get('Normalize') else None
+    return preprocess_image(image, clip_range=clip_range, method=method or None, mask=mask,
+                            quantise=quantise, out=out)
 
-    X_white = np.zeros(X.shape, dtype=np.float32)
+# Upper bound on the float64 scratch space used per block by normalise_batch
+_NORMALISE_BLOCK_BYTES = 64 * 1024 ** 2
 
-    for ii in range(X.shape[0]):
 
-        Xc = X[ii,:,:,:]
-        mc = Xc.mean()
-        sc = Xc.std()
+def _sample_stats(block, mask_block):
+    '''
+    Per-sample mean and standard deviation of a block, reduced over every axis
+    but the first. If a mask is given only the voxels inside it are used.
+    '''
+    axes = tuple(range(1, block.ndim))
+    if mask_block is None:
+        m = block.mean(axis=axes, dtype=np.float64, keepdims=True)
+        s = block.std(axis=axes, dtype=np.float64, keepdims=True)
+    else:
+        if not mask_block.any(axis=axes).all():
+            raise ValueError('Empty ROI: cannot compute normalisation statistics')
+        m = block.mean(axis=axes, dtype=np.float64, keepdims=True, where=mask_block)
+        s = block.std(axis=axes, dtype=np.float64, keepdims=True, where=mask_block)
+    s[s == 0] = 1.0
+    return m, s
+
+
+def normalise_batch(X, mask=None, out=None, mean=0, std=1, chunk_size=None):
+    '''
+    Vectorised per-sample normalisation to the given mean and standard deviation.
+
+    Statistics are reduced over all axes but the first (the batch axis) and are
+    accumulated in float64. The batch is processed in blocks of `chunk_size`
+    samples, so memory-mapped inputs are only read block by block.
+    :param X: Batch of images, shape (N, ...). May be a np.memmap
+    :param mask: Optional ROI, either of the same shape as X or of shape X.shape[1:]
+                 (shared by all samples). Statistics are computed inside the ROI only
+                 and applied to the whole image, as WORC's Normalize_ROI does
+    :param out: Optional preallocated floating point output. Pass out=X to normalise in place
+    :param mean: Target mean
+    :param std: Target standard deviation
+    :param chunk_size: Samples per block. By default blocks are sized to bound scratch memory
+    :return: The normalised batch (out if given, otherwise a new float32 array)
+    '''
 
-        Xc_white = np.divide((Xc - mc), sc)
+    if out is None:
+        out = np.empty(X.shape, dtype=np.float32)
+    elif out.shape != X.shape:
+        raise ValueError('out has shape {} but X has shape {}'.format(out.shape, X.shape))
+    elif not np.issubdtype(out.dtype, np.floating):
+        raise ValueError('out must be a floating point array, got {}'.format(out.dtype))
+
+    if mask is not None:
+        mask = np.asanyarray(mask)
+        if mask.shape == X.shape[1:]:
+            mask = np.broadcast_to(mask, X.shape)
+        elif mask.shape != X.shape:
+            raise ValueError('mask has shape {} but X has shape {}'.format(mask.shape, X.shape))
+
+    n_samples = X.shape[0]
+    if chunk_size is None:
+        sample_bytes = max(1, int(np.prod(X.shape[1:])) * 8)
+        chunk_size = max(1, _NORMALISE_BLOCK_BYTES // sample_bytes)
+
+    for start in range(0, n_samples, chunk_size):
+        stop = min(start + chunk_size, n_samples)
+        block = X[start:stop]
+        mask_block = None if mask is None else np.asarray(mask[start:stop], dtype=bool)
+        m, s = _sample_stats(block, mask_block)
+
+        out_block = out[start:stop]
+        np.subtract(block, m.astype(out.dtype), out=out_block)
+        np.divide(out_block, s.astype(out.dtype), out=out_block)
+        if std != 1:
+            out_block *= std
+        if mean != 0:
+            out_block += mean
+
+    return out
+
+
+def normalise_image(image, mean=0, std=1, mask=None):
+    '''
+    make image zero mean and unit standard deviation (default values)
+    '''
+    return normalise_batch(image[np.newaxis], mask=mask, mean=mean, std=std)[0]
 
-        X_white[ii,:,:,:] = Xc_white
 
-    return X_white.astype(np.float32)
+def normalise_images(X, mask=None, out=None):
+    '''
+    Helper for making the images zero mean and unit standard deviation i.e. `white`
+    '''
+    return normalise_batch(X, mask=mask, out=out)
 
 
 def reshape_2Dimage_to_tensor(image):
     return np.reshape(image, (1, image.shape[0], image.shape[1], 1))
 
 
-def keep_largest_connected_components(mask):
+def grow_bounding_box(bbox, margin, shape):
     '''
-    Keeps only the largest connected components of each label for a segmentation mask.
+    Grows a bounding box ((start, stop) per axis) by a margin, clipped to the volume shape
     '''
+    margin = _per_axis(margin, len(shape), 'margin')
+    return tuple((max(0, start - m), min(dim, stop + m)) for (start, stop), m, dim in zip(bbox, margin, shape))
 
-    out_img = np.zeros(mask.shape, dtype=np.uint8)
 
-    for struc_id in [1, 2, 3]:
+def bounding_box(mask, margin=0):
+    '''
+    Bounding box of the non-zero voxels of a mask, grown by a margin and clipped to the mask shape.
+    Uses one projection per axis instead of np.nonzero over the whole volume.
+    :param mask: Segmentation mask
+    :param margin: Voxels added on both sides, scalar or one value per axis
+    :return: Tuple of (start, stop) per axis, or None for an empty mask
+    '''
+    bbox = []
+    for axis in range(mask.ndim):
+        other = tuple(a for a in range(mask.ndim) if a != axis)
+        hits = np.flatnonzero(np.any(mask, axis=other))
+        if hits.size == 0:
+            return None
+        bbox.append((int(hits[0]), int(hits[-1]) + 1))
+    return grow_bounding_box(bbox, margin, mask.shape)
 
-        binary_img = mask == struc_id
-        blobs = measure.label(binary_img, connectivity=1)
 
-        props = measure.regionprops(blobs)
+def _per_axis(value, ndim, name):
+    '''
+    Expands a scalar to one value per axis and validates per-axis tuples
+    '''
+    if np.isscalar(value):
+        return (int(value),) * ndim
+    value = tuple(int(v) for v in value)
+    if len(value) != ndim:
+        raise ValueError('{} needs {} values, got {}'.format(name, ndim, value))
+    return value
 
-        if not props:
-            continue
 
-        area = [ele.area for ele in props]
-        largest_blob_ind = np.argmax(area)
-        largest_blob_label = props[largest_blob_ind].label
+def patch_origins(shape, patch_size, stride=None, padding=0):
+    '''
+    Lists the corner of every patch on a regular grid over a (padded) volume.
+
+    Origins may be negative when padding is used. The last patch along each axis
+    is shifted back so that the grid always covers the whole padded volume.
+    :param shape: Volume shape
+    :param patch_size: Patch size, scalar or one value per axis
+    :param stride: Step between patches, scalar or per axis. Defaults to patch_size (tiling)
+    :param padding: Padding added on both sides of every axis, scalar or per axis
+    :return: List of origin tuples
+    '''
+    ndim = len(shape)
+    patch_size = _per_axis(patch_size, ndim, 'patch_size')
+    stride = _per_axis(patch_size if stride is None else stride, ndim, 'stride')
+    padding = _per_axis(padding, ndim, 'padding')
+
+    starts = []
+    for dim, size, step, pad in zip(shape, patch_size, stride, padding):
+        last = dim + pad - size
+        if last < -pad:
+            raise ValueError('Patch size {} does not fit in padded volume {}'.format(patch_size, shape))
+        axis_starts = list(range(-pad, last + 1, step))
+        if axis_starts[-1] != last:
+            axis_starts.append(last)
+        starts.append(axis_starts)
+    return list(itertools.product(*starts))
+
+
+def _patch_slices(origin, patch_size, shape):
+    '''
+    Slices of the part of a patch that lies inside the volume, in volume and in patch coordinates
+    '''
+    vol = tuple(slice(max(o, 0), min(o + p, d)) for o, p, d in zip(origin, patch_size, shape))
+    patch = tuple(slice(v.start - o, v.stop - o) for v, o in zip(vol, origin))
+    return vol, patch
 
-        out_img[blobs == largest_blob_label] = struc_id
 
-    return out_img
+def extract_patches(volume, patch_size, stride=None, padding=0, mask=None, fill_value=0):
+    '''
+    Lazily yields patches of a volume as zero-copy strided views.
+
+    Patches are read-only views into a sliding_window_view of the volume, so a
+    memory-mapped volume (e.g. np.asanyarray(nib.load(path).dataobj) for an
+    uncompressed NIfTI) is only paged in for the patches that are consumed.
+    Patches that overlap the padding are the only ones copied, into a small
+    array filled with fill_value.
+    :param volume: Array to tile
+    :param patch_size: Patch size, scalar or one value per axis
+    :param stride: Step between patches. Defaults to patch_size
+    :param padding: Padding added on both sides of every axis
+    :param mask: Optional array of the volume's shape; only patches whose centre voxel is
+                 non-zero in the mask are yielded
+    :param fill_value: Value used for the padded region
+    :return: Generator of (origin, patch) tuples
+    '''
+    patch_size = _per_axis(patch_size, volume.ndim, 'patch_size')
+    origins = patch_origins(volume.shape, patch_size, stride, padding)
+    if mask is not None and mask.shape != volume.shape:
+        raise ValueError('mask has shape {} but volume has shape {}'.format(mask.shape, volume.shape))
+
+    fits = all(p <= d for p, d in zip(patch_size, volume.shape))
+    windows = sliding_window_view(volume, patch_size) if fits else None
+
+    for origin in origins:
+        if mask is not None:
+            centre = tuple(o + p // 2 for o, p in zip(origin, patch_size))
+            if any(c < 0 or c >= d for c, d in zip(centre, volume.shape)) or not mask[centre]:
+                continue
+        if fits and all(o >= 0 and o + p <= d for o, p, d in zip(origin, patch_size, volume.shape)):
+            yield origin, windows[origin]
+        else:
+            patch = np.full(patch_size, fill_value, dtype=volume.dtype)
+            vol_sl, patch_sl = _patch_slices(origin, patch_size, volume.shape)
+            patch[patch_sl] = volume[vol_sl]
+            yield origin, patch
+
+
+def batch_patches(patches, batch_size):
+    '''
+    Groups a patch generator into batches, materialising one batch at a time.
+    :return: Generator of (origins, batch) tuples, batch having shape (n,) + patch_size
+    '''
+    patches = iter(patches)
+    while True:
+        chunk = list(itertools.islice(patches, batch_size))
+        if not chunk:
+            return
+        origins, arrays = zip(*chunk)
+        yield list(origins), np.stack(arrays)
+
+
+def stitch_patches(patches, shape, out=None):
+    '''
+    Stitches patch predictions back into a volume, averaging where patches overlap.
+    Parts of a patch that fall in the padding are discarded.
+    :param patches: Iterable of (origin, patch) tuples, e.g. predictions for extract_patches origins
+    :param shape: Shape of the output volume
+    :param out: Optional preallocated floating point output
+    :return: Stitched volume (voxels not covered by any patch are 0)
+    '''
+    if out is None:
+        out = np.zeros(shape, dtype=np.float32)
+    else:
+        out[...] = 0
+    counts = np.zeros(shape, dtype=np.uint16)
+
+    for origin, patch in patches:
+        vol_sl, patch_sl = _patch_slices(origin, patch.shape, shape)
+        out[vol_sl] += patch[patch_sl]
+        counts[vol_sl] += 1
+
+    np.divide(out, counts, out=out, where=counts > 0)
+    return out
+
+
+def keep_largest_components(mask, labels=None, connectivity=1, out=None):
+    '''
+    Keeps only the largest connected component of each label in a single labelling pass.
+
+    Regions of different label values are never merged, so the whole multi-label
+    mask is labelled once and component sizes come from np.bincount on the result.
+    :param mask: Integer segmentation mask (2D or 3D)
+    :param labels: Label values to keep. Defaults to every non-zero value in the mask
+    :param connectivity: Maximum number of orthogonal hops to consider a voxel a neighbour,
+                         as in skimage.measure.label (3D: 1 -> 6, 2 -> 18, 3 -> 26 neighbours)
+    :param out: Optional preallocated uint8 output with the same shape as mask
+    :return: uint8 mask holding the largest component of each label
+    '''
+
+    if out is None:
+        out = np.zeros(mask.shape, dtype=np.uint8)
+    elif out.shape != mask.shape or out.dtype != np.uint8:
+        raise ValueError('out must be a uint8 array of shape {}'.format(mask.shape))
+    if not 1 <= connectivity <= mask.ndim:
+        raise ValueError('connectivity must be between 1 and {}'.format(mask.ndim))
+
+    mask = np.asarray(mask)
+    if labels is None:
+        work = mask
+        labels = np.unique(mask)
+        labels = labels[labels != 0]
+    else:
+        labels = np.asarray(labels)
+        work = np.where(np.isin(mask, labels), mask, 0)
+    if labels.size and (labels.min() < 0 or labels.max() > 255):
+        raise ValueError('Label values must fit in uint8, got {}'.format(labels))
+
+    # Imported on first use: skimage is slow to import
+    from skimage import measure  # pylint: disable=import-outside-toplevel
+    blobs, n_blobs = measure.label(work, background=0, connectivity=connectivity, return_num=True)
+    if n_blobs == 0:
+        out[...] = 0
+        return out
+
+    sizes = np.bincount(blobs.ravel(), minlength=n_blobs + 1)
+    owner = np.zeros(n_blobs + 1, dtype=work.dtype)
+    owner[blobs] = work
+
+    lut = np.zeros(n_blobs + 1, dtype=np.uint8)
+    for struc_id in labels:
+        candidates = np.flatnonzero(owner == struc_id)
+        candidates = candidates[candidates != 0]
+        if candidates.size:
+            lut[candidates[np.argmax(sizes[candidates])]] = struc_id
+
+    np.take(lut, blobs, out=out)
+    return out
+
+
+def keep_largest_connected_components(mask):
+    '''
+    Keeps only the largest connected components of each label for a segmentation mask.
+    '''
+    return keep_largest_components(mask, labels=(1, 2, 3), connectivity=1)
@@ -16,8 +16,19 @@
    limitations under the License.
 """
 
+import atexit
+import functools
+import json
+import os
+import queue
 import sys
-import datetime
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows: spans do not report the peak RSS
+    resource = None
 
 """
 This is the logging facility of the mg-tool-api. It is meant to provide
@@ -39,6 +50,20 @@ FATAL:   A serious error, indicating that the Tool may be unable to
 As well as the following non-standard levels:
 
 PROGRESS: Provide the VRE with information about Tool execution progress.
+
+Messages below the minimum level (set_level, or the MLTOOLBOX_LOG_LEVEL
+environment variable; INFO by default) are dropped before being formatted.
+The others are queued and written by a background thread, which flushes the
+output streams in batches every FLUSH_INTERVAL seconds, immediately after a
+FATAL message, on flush() and at exit. Child processes (forked, or started by
+multiprocessing) write and flush every message directly instead: pool workers
+leave with os._exit, which would drop whatever is still queued.
+
+Stages can be timed with span(), as a context manager or a decorator. Each
+span records its wall time, CPU time (own and of waited-for child processes)
+and the peak RSS, and is written as a JSON-lines event to the events file
+(set_events_file, or the MLTOOLBOX_EVENTS_FILE environment variable), next
+to the human log. Progress messages are written there as events as well.
 """  # pylint: disable=pointless-string-statement
 
 
@@ -66,21 +91,294 @@ _levelNames = {  # pylint: disable=invalid-name
 }
 
 
+# Seconds between two flushes of the output streams by the writer thread
+FLUSH_INTERVAL = 1.0
+
+LEVEL_ENV = 'MLTOOLBOX_LOG_LEVEL'
+EVENTS_ENV = 'MLTOOLBOX_EVENTS_FILE'
+
+# Output targets of the queued lines
+_STDOUT, _STDERR, _EVENTS = 0, 1, 2
+
+
+def _parse_level(level):
+    if isinstance(level, str):
+        if level.isdigit():
+            return int(level)
+        names = {name: value for value, name in _levelNames.items()}
+        names.update(WARN=WARNING, CRITICAL=CRITICAL)
+        return names[level.upper()]
+    return int(level)
+
+
+_min_level = _parse_level(os.environ.get(LEVEL_ENV, INFO))  # pylint: disable=invalid-name
+_timestamp = (None, '')  # pylint: disable=invalid-name
+_queue = queue.SimpleQueue()  # pylint: disable=invalid-name
+_writer = None  # pylint: disable=invalid-name
+_writer_lock = threading.Lock()
+_closed = False  # pylint: disable=invalid-name
+# Write synchronously, without the writer thread (child processes)
+_direct = getattr(sys.modules.get("multiprocessing"), "parent_process", lambda: None)() is not None  # pylint: disable=invalid-name
+_events_file = None  # pylint: disable=invalid-name
+_spans = threading.local()
+
+
+def set_level(level):
+    """
+    Sets the minimum level of the messages that are logged (a level constant or its name)
+    """
+    global _min_level  # pylint: disable=global-statement,invalid-name
+    _min_level = _parse_level(level)
+
+
+def get_level():
+    """
+    Returns the minimum level of the messages that are logged
+    """
+    return _min_level
+
+
+def _now():
+    """
+    Timestamp of the current second, formatted once per second
+    """
+    global _timestamp  # pylint: disable=global-statement,invalid-name
+    second = int(time.time())
+    cached_second, log_ts = _timestamp
+    if second != cached_second:
+        log_ts = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+        _timestamp = (second, log_ts)
+    return log_ts
+
+
+def _write_lines(lines):
+    """
+    Writes (target, line) pairs, joining consecutive lines for the same target.
+    The streams are looked up on every write as VRE_RUNNER may redirect them.
+    """
+    start = 0
+    for end in range(1, len(lines) + 1):
+        if end == len(lines) or lines[end][0] != lines[start][0]:
+            outstream = (sys.stdout, sys.stderr, _events_file)[lines[start][0]]
+            if outstream is not None:
+                outstream.write("".join(line for _, line in lines[start:end]))
+            start = end
+
+
+def _flush_streams():
+    for outstream in (sys.stdout, sys.stderr, _events_file):
+        try:
+            outstream.flush()
+        except (AttributeError, ValueError):  # Closed or not a file
+            pass
+
+
+def _writer_loop():
+    """
+    Background thread draining the queue. Items are (target, line) pairs, or
+    threading.Event flush requests that are set once everything before them is written.
+    """
+    last_flush = time.monotonic()
+    dirty = False
+    while True:
+        try:
+            items = [_queue.get(timeout=FLUSH_INTERVAL)]
+        except queue.Empty:
+            items = []
+        while True:
+            try:
+                items.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        lines = []
+        for item in items:
+            if isinstance(item, threading.Event):
+                _write_lines(lines)
+                lines = []
+                _flush_streams()
+                last_flush = time.monotonic()
+                dirty = False
+                item.set()
+            else:
+                lines.append(item)
+        if lines:
+            _write_lines(lines)
+            dirty = True
+        if dirty and time.monotonic() - last_flush >= FLUSH_INTERVAL:
+            _flush_streams()
+            last_flush = time.monotonic()
+            dirty = False
+
+
+def _ensure_writer():
+    global _writer  # pylint: disable=global-statement,invalid-name
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_writer_loop, name="logger-writer", daemon=True)
+            _writer.start()
+
+
+def flush(timeout=10.0):
+    """
+    Blocks until every queued message is written and the output streams are flushed
+    """
+    if _writer is None or _closed or _direct:
+        _flush_streams()
+        return
+    done = threading.Event()
+    _queue.put(done)
+    done.wait(timeout)
+
+
+def _shutdown():
+    global _closed  # pylint: disable=global-statement,invalid-name
+    flush()
+    # Messages logged later in the interpreter shutdown are written directly
+    _closed = True
+
+
+def _after_fork():
+    # The writer thread does not exist in a forked child, and the child may leave with
+    # os._exit (multiprocessing workers) without running atexit: write directly
+    global _queue, _writer, _writer_lock, _direct  # pylint: disable=global-statement,invalid-name
+    _queue = queue.SimpleQueue()
+    _writer = None
+    _writer_lock = threading.Lock()
+    _direct = True
+
+
+atexit.register(_shutdown)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _emit(target, line, flush_now=False):
+    if _closed or _direct:
+        _write_lines([(target, line)])
+        _flush_streams()
+        return
+    if _writer is None:
+        _ensure_writer()
+    _queue.put((target, line))
+    if flush_now:
+        flush()
+
+
+def set_events_file(path):
+    """
+    Sets the JSON-lines file receiving the span and progress events (None to disable).
+    The file is appended to.
+    """
+    global _events_file  # pylint: disable=global-statement,invalid-name
+    flush()
+    previous, _events_file = _events_file, None
+    if previous is not None:
+        previous.close()
+    if path:
+        _events_file = open(path, "a")
+
+
+if os.environ.get(EVENTS_ENV):
+    set_events_file(os.environ[EVENTS_ENV])
+
+
+def event(kind, **fields):
+    """
+    Writes a structured event to the events file, if one is set
+    """
+    if _events_file is None:
+        return
+    record = {"event": kind, "time": round(time.time(), 3), "pid": os.getpid()}
+    record.update(fields)
+    _emit(_EVENTS, json.dumps(record, default=str) + "\n")
+
+
+def _resource_usage():
+    """
+    (cpu seconds, cpu seconds of waited-for children, peak RSS in bytes) of this process
+    """
+    if resource is None:
+        return time.process_time(), 0.0, None
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return (own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime,
+            max(own.ru_maxrss, children.ru_maxrss) * scale)
+
+
+class span(object):  # pylint: disable=invalid-name
+    """
+    Times a stage of the execution; usable as a context manager or a decorator.
+
+    Spans nest per thread: the events carry the path of the enclosing spans
+    (e.g. "launch/run/worc_execute"). On exit the wall time, CPU time, CPU time
+    of the child processes waited for during the span and the peak RSS so far
+    (a process high-water mark) are written as a "span" event and logged.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+       with logger.span("worc_execute", patients=len(images)):
+           experiment.execute()
+
+       @logger.span("run")
+       def run(self, input_files, input_metadata, output_files):
+           ...
+    """
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self._started = []
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def _wrapped(*args, **kwargs):
+            with span(self.name, **self.fields):
+                return func(*args, **kwargs)
+        return _wrapped
+
+    def __enter__(self):
+        stack = getattr(_spans, "stack", None)
+        if stack is None:
+            stack = _spans.stack = []
+        stack.append(self.name)
+        path = "/".join(stack)
+        cpu, children_cpu, _ = _resource_usage()
+        self._started.append((path, time.perf_counter(), cpu, children_cpu))
+        event("span_start", name=self.name, path=path, **self.fields)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        path, wall_start, cpu_start, children_start = self._started.pop()
+        cpu, children_cpu, peak_rss = _resource_usage()
+        wall = time.perf_counter() - wall_start
+        _spans.stack.pop()
+        status = "ok" if exc_type is None else "error"
+        event("span", name=self.name, path=path, status=status,
+              error=None if exc_type is None else exc_type.__name__,
+              wall_s=round(wall, 4), cpu_s=round(cpu - cpu_start, 4),
+              children_cpu_s=round(children_cpu - children_start, 4),
+              peak_rss_bytes=peak_rss, **self.fields)
+        info("Span {} {} in {:.1f} s (cpu {:.1f} s, children cpu {:.1f} s)", path, status,
+             wall, cpu - cpu_start, children_cpu - children_start)
+        return False
+
+
 def __log(level, message, *args, **kwargs):
     """
     Function to print out the logging input
     """
-    log_time = datetime.datetime.now()
-    log_ts = "{}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format(
-        log_time.year, log_time.month, log_time.day,
-        log_time.hour, log_time.minute, log_time.second)
     if level not in _levelNames:
         level = INFO
-    outstream = sys.stdout
-    if level in STDERR_LEVELS:
-        outstream = sys.stderr
-    outstream.write("{} | {}: {}\n".format(
-        log_ts, _levelNames[level], message.format(*args, **kwargs)))
+    if level < _min_level:
+        return True
+    _emit(_STDERR if level in STDERR_LEVELS else _STDOUT, "{} | {}: {}\n".format(
+        _now(), _levelNames[level], message.format(*args, **kwargs)), flush_now=level >= FATAL)
     return True
 
 
@@ -188,9 +486,14 @@ def progress(message, *args, **kwargs):
     """
 
     if "status" in kwargs:
+        event("progress", message=message, status=kwargs["status"])
         return __log(PROGRESS, "{} - {}", message, kwargs["status"])
 
     if "task_id" in kwargs:
+        event("progress", message=message, task_id=kwargs["task_id"], total=kwargs["total"])
         return __log(PROGRESS, "{} ({}/{})", message, kwargs["task_id"], kwargs["total"])
 
+    if _events_file is not None:
+        event("progress", message=message.format(*args, **kwargs))
+
     return __log(PROGRESS, message, *args, **kwargs)
@@ -0,0 +1,226 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from contextlib import contextmanager
+
+# utils.utils_nii (nibabel) is imported on first use: ContentHasher and write_atomic
+# are used by modules that must stay cheap to import
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows: concurrent fills just duplicate work
+    fcntl = None
+
+# Environment variables configuring the default cache
+CACHE_DIR_ENV = 'MLTOOLBOX_NII_CACHE'
+CACHE_BYTES_ENV = 'MLTOOLBOX_NII_CACHE_BYTES'
+DEFAULT_CACHE_BYTES = 20 * 1024 ** 3
+
+_COPY_BUFFER = 4 * 1024 ** 2
+
+_default_cache = None
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def write_atomic(path, write):
+    '''
+    Write a file through a temporary file in the same folder and an atomic rename
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def sha256_file(path):
+    '''
+    sha256 of the content of a file, read in blocks
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_COPY_BUFFER), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ContentHasher(object):
+    '''
+    sha256 of files, remembered in stat_dir: hashing is skipped when the size,
+    mtime and inode of a file match the last time it was hashed
+    '''
+
+    def __init__(self, stat_dir):
+        self.stat_dir = stat_dir
+        os.makedirs(self.stat_dir, exist_ok=True)
+
+    def __call__(self, path):
+        path = os.path.abspath(path)
+        stat_file = os.path.join(self.stat_dir, hashlib.sha1(path.encode()).hexdigest() + '.json')
+        signature = _file_signature(path)
+        try:
+            with open(stat_file) as f:
+                entry = json.load(f)
+            if entry['signature'] == signature:
+                return entry['sha256']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        sha256 = sha256_file(path)
+        write_atomic(stat_file, lambda f: f.write(json.dumps(
+            {'path': path, 'signature': signature, 'sha256': sha256}).encode()))
+        return sha256
+
+
+class DecompressedVolumeCache(object):
+    '''
+    Content-addressed cache of decompressed nifti files with a disk budget.
+
+    The first read of a .nii.gz decompresses it into <cache_dir>/volumes/<sha256>.nii,
+    later reads memory-map that file instead of paying the gzip cost again.
+    Hashing the compressed file is skipped when its size, mtime and inode match
+    the last time it was seen. Least recently used volumes are evicted once the
+    cache grows over max_bytes.
+
+    Several processes (e.g. VRE runs on the same node) may share a cache
+    directory: every file is published with an atomic rename, fills of the same
+    volume are serialised with a file lock, and evicting a volume that another
+    process has memory-mapped is safe as the mapping outlives the unlink. The
+    (empty) lock files are never removed, so two processes cannot end up
+    holding locks on different files for the same volume.
+    '''
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_BYTES):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.volume_dir = os.path.join(self.cache_dir, 'volumes')
+        os.makedirs(self.volume_dir, exist_ok=True)
+        self.hasher = ContentHasher(os.path.join(self.cache_dir, 'stat'))
+
+    def content_hash(self, img_path):
+        '''
+        sha256 of the compressed file, reusing the previous hash when the file did not change
+        '''
+        return self.hasher(img_path)
+
+    @contextmanager
+    def _lock(self, key):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.volume_dir, '.' + key + '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def path_for(self, img_path):
+        '''
+        Path of an uncompressed copy of img_path, decompressing it on the first request.
+        Uncompressed inputs are returned as they are.
+        '''
+        from utils.utils_nii import is_compressed  # pylint: disable=import-outside-toplevel
+        if not is_compressed(img_path):
+            return img_path
+
+        key = self.content_hash(img_path)
+        cached = os.path.join(self.volume_dir, key + '.nii')
+        try:
+            os.utime(cached)  # Mark as recently used
+            return cached
+        except FileNotFoundError:  # Not cached yet, or evicted by another process
+            pass
+
+        with self._lock(key):
+            if not os.path.exists(cached):
+                def _decompress(out):
+                    with gzip.open(img_path, 'rb') as src:
+                        shutil.copyfileobj(src, out, _COPY_BUFFER)
+                write_atomic(cached, _decompress)
+        self.evict(keep=cached)
+        return cached
+
+    def size(self):
+        '''
+        Bytes used by the cached volumes
+        '''
+        return sum(entry.stat().st_size for entry in os.scandir(self.volume_dir)
+                   if entry.name.endswith('.nii'))
+
+    def evict(self, keep=None):
+        '''
+        Remove least recently used volumes until the cache fits in max_bytes
+        :param keep: Path that must not be evicted (the volume just requested)
+        '''
+        entries = []
+        for entry in os.scandir(self.volume_dir):
+            if entry.name.endswith('.nii'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:  # Evicted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def get_default_cache():
+    '''
+    Cache configured through the MLTOOLBOX_NII_CACHE and MLTOOLBOX_NII_CACHE_BYTES
+    environment variables, or None if no cache directory is set
+    '''
+    global _default_cache  # pylint: disable=global-statement
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        return None
+    if _default_cache is None or _default_cache.cache_dir != os.path.abspath(cache_dir):
+        max_bytes = int(os.environ.get(CACHE_BYTES_ENV, DEFAULT_CACHE_BYTES))
+        _default_cache = DecompressedVolumeCache(cache_dir, max_bytes)
+    return _default_cache
+
+
+def cached_path(img_path, cache=None):
+    '''
+    Path to read img_path from: its decompressed copy in the cache (the default cache
+    if none is given), or img_path itself when no cache is configured. For readers
+    that need more than load_nii (e.g. the nibabel image or a path to stream from)
+    '''
+    cache = cache or get_default_cache()
+    return img_path if cache is None else cache.path_for(img_path)
+
+
+def load_nii_cached(img_path, cache=None, lazy=True, apply_scaling=True):
+    '''
+    load_nii through the decompressed-volume cache (the default cache if none is given).
+    Falls back to reading img_path directly when no cache is configured.
+    '''
+    from utils.utils_nii import load_nii  # pylint: disable=import-outside-toplevel
+    cache = cache or get_default_cache()
+    if cache is None:
+        return load_nii(img_path, lazy=lazy, apply_scaling=apply_scaling)
+    try:
+        return load_nii(cache.path_for(img_path), lazy=lazy, apply_scaling=apply_scaling)
+    except FileNotFoundError:  # Evicted by another process before it was opened: fill it again
+        return load_nii(cache.path_for(img_path), lazy=lazy, apply_scaling=apply_scaling)
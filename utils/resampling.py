@@ -0,0 +1,103 @@
+import numpy as np
+import nibabel as nib
+
+from scipy import ndimage
+
+from utils.utils_nii import save_nii
+
+# Upper bound on the input slab (float64) read per resampling step
+_RESAMPLE_SLAB_BYTES = 128 * 1024 ** 2
+
+
+def parse_spacing(spacing):
+    '''
+    Parses a Preprocessing:Resampling_spacing value such as '1, 1, 1'
+    '''
+    if isinstance(spacing, str):
+        spacing = spacing.split(',')
+    return tuple(float(v) for v in spacing)
+
+
+def resampled_shape(shape, spacing, new_spacing):
+    '''
+    Shape of a volume resampled from `spacing` to `new_spacing` (same physical extent)
+    '''
+    return tuple(max(1, int(round(n * s / ns))) for n, s, ns in zip(shape, spacing, new_spacing))
+
+
+def resampled_affine(affine, spacing, new_spacing):
+    '''
+    Voxel-to-world affine of the resampled grid. Voxel 0 keeps its world position.
+    '''
+    ratio = np.asarray(new_spacing, dtype=np.float64) / np.asarray(spacing, dtype=np.float64)
+    new_affine = np.array(affine, dtype=np.float64)
+    new_affine[:3, :3] = new_affine[:3, :3] * ratio[np.newaxis, :]
+    return new_affine
+
+
+def resample_volume(read_slab, shape, spacing, new_spacing, order=1, dtype=np.float32, out=None):
+    '''
+    Resamples a 3D volume to a new spacing, slab by slab along the last axis.
+
+    Only the input planes needed for each output slab are read, so peak memory
+    is bounded by _RESAMPLE_SLAB_BYTES instead of the volume size.
+    :param read_slab: Callable (start, stop) -> input[..., start:stop], e.g. lambda a, b: img.dataobj[..., a:b],
+                      or an array
+    :param shape: Input shape
+    :param spacing: Input voxel spacing
+    :param new_spacing: Target voxel spacing
+    :param order: Spline order, 1 (linear) for images, 0 (nearest neighbour) for masks
+    :param dtype: Output dtype
+    :param out: Optional preallocated output of resampled_shape(shape, spacing, new_spacing)
+    :return: The resampled volume
+    '''
+    if isinstance(read_slab, np.ndarray):
+        volume = read_slab
+        read_slab = lambda start, stop: volume[..., start:stop]  # noqa: E731
+
+    ratio = np.asarray(new_spacing, dtype=np.float64) / np.asarray(spacing, dtype=np.float64)
+    new_shape = resampled_shape(shape, spacing, new_spacing)
+    if out is None:
+        out = np.empty(new_shape, dtype=dtype)
+
+    plane_bytes = max(1, int(np.prod(shape[:2])) * 8)
+    in_depth = max(1, _RESAMPLE_SLAB_BYTES // plane_bytes)
+    out_depth = max(1, int((in_depth - 2) / ratio[2]))
+
+    for z0 in range(0, new_shape[2], out_depth):
+        z1 = min(z0 + out_depth, new_shape[2])
+        # Input planes touched by output planes z0..z1-1 (plus one for interpolation)
+        in0 = min(max(0, int(np.floor(z0 * ratio[2]))), shape[2] - 1)
+        in1 = min(shape[2], int(np.floor((z1 - 1) * ratio[2])) + 2)
+        slab = np.asarray(read_slab(in0, in1))
+        ndimage.affine_transform(slab, ratio, offset=(0.0, 0.0, z0 * ratio[2] - in0),
+                                 output_shape=new_shape[:2] + (z1 - z0,),
+                                 output=out[..., z0:z1], order=order, mode='nearest')
+    return out
+
+
+def resample_nii(in_path, out_path, new_spacing, is_mask=False):
+    '''
+    Resamples a nifti file to a new spacing: linear interpolation for images,
+    nearest neighbour for masks. The header is updated with the new grid.
+    :return: out_path
+    '''
+    nimg = nib.load(in_path)
+    shape = nimg.shape[:3]
+    spacing = nimg.header.get_zooms()[:3]
+    new_spacing = parse_spacing(new_spacing)
+
+    if is_mask:
+        data = resample_volume(lambda a, b: np.asanyarray(nimg.dataobj[..., a:b]), shape, spacing,
+                               new_spacing, order=0, dtype=np.uint8)
+    else:
+        data = resample_volume(lambda a, b: nimg.dataobj[..., a:b], shape, spacing,
+                               new_spacing, order=1, dtype=np.float32)
+
+    affine = resampled_affine(nimg.affine, spacing, new_spacing)
+    header = nimg.header.copy()
+    header.set_data_dtype(data.dtype)
+    header.set_zooms(tuple(new_spacing) + tuple(header.get_zooms()[3:]))
+    header.set_slope_inter(1, 0)
+    save_nii(out_path, data, affine, header)
+    return out_path
@@ -1,7 +1,87 @@
-import numpy as np
-import glob
+import math
 import os
 
+from utils.checkpoints import CheckpointManager
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+
+def _read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_paths(proc_cgroup='/proc/self/cgroup'):
+    '''
+    cgroup of this process per controller (v2: key '')
+    '''
+    paths = {}
+    try:
+        with open(proc_cgroup) as f:
+            for line in f:
+                _, controllers, path = line.rstrip('\n').split(':', 2)
+                for controller in controllers.split(','):
+                    paths[controller] = path
+    except (OSError, ValueError):
+        pass
+    return paths
+
+
+def _cpu_quota(folder, quota_file, period_file):
+    quota = _read_first_line(os.path.join(folder, quota_file))
+    if not quota:
+        return None
+    if period_file is None:  # cgroup v2: '<quota> <period>' or 'max <period>'
+        fields = quota.split()
+        if len(fields) != 2 or fields[0] == 'max':
+            return None
+        return int(fields[0]) / int(fields[1])
+    period = _read_first_line(os.path.join(folder, period_file))  # cgroup v1: quota is -1 when unlimited
+    if not period or int(quota) <= 0:
+        return None
+    return int(quota) / int(period)
+
+
+def cgroup_cpu_limit(root=CGROUP_ROOT, proc_cgroup='/proc/self/cgroup'):
+    '''
+    CPU quota of the cgroup of this process (containers, batch scheduler jobs), in CPUs
+    :return: The lowest quota / period of the cgroup and its parents, None when unlimited
+    '''
+    paths = _cgroup_paths(proc_cgroup)
+    hierarchies = [(root, paths.get(''), 'cpu.max', None)]
+    for mount in ('cpu', 'cpu,cpuacct', 'cpuacct,cpu'):
+        hierarchies.append((os.path.join(root, mount), paths.get('cpu'), 'cpu.cfs_quota_us', 'cpu.cfs_period_us'))
+
+    limits = []
+    for base, path, quota_file, period_file in hierarchies:
+        if path is None or not os.path.isdir(base):
+            continue
+        parts = [part for part in path.split('/') if part]
+        for depth in range(len(parts), -1, -1):
+            limit = _cpu_quota(os.path.join(base, *parts[:depth]), quota_file, period_file)
+            if limit is not None:
+                limits.append(limit)
+    return min(limits) if limits else None
+
+
+def available_cpus():
+    '''
+    Number of CPUs this process can use: the CPU affinity mask (cpusets, taskset, SLURM
+    bindings) capped by the cgroup CPU quota. Unlike os.cpu_count(), which counts every
+    CPU of the node, this is what a worker pool should be sized with on a shared node
+    '''
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on macOS / Windows
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, max(1, math.ceil(limit)))
+    return max(1, cpus)
+
 
 def makefolder(folder):
     '''
@@ -20,18 +100,7 @@ def get_latest_model_checkpoint_path(folder, name):
     Returns the checkpoint with the highest iteration number with a given name
     :param folder: Folder where the checkpoints are saved
     :param name: Name under which you saved the model
-    :return: The path to the checkpoint with the latest iteration
+    :return: The path to the checkpoint with the latest iteration, None if there is none
     '''
 
-    iteration_nums = []
-    for f in glob.glob(os.path.join(folder, '{}*.meta'.format(name))):
-
-        f = f.split('/')[-1]
-        file_base, postfix_and_number, rest = f.split('.')[0:3]
-        it_num = int(postfix_and_number.split('-')[-1])
-
-        iteration_nums.append(it_num)
-
-    latest_iteration = np.max(iteration_nums)
-
-    return os.path.join(folder, name + '-' + str(latest_iteration))
+    return CheckpointManager(folder, name).latest()
@@ -1,16 +1,297 @@
+import gzip
+import io
+import os
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import nibabel as nib
 
+from nibabel.arrayproxy import ArrayProxy
+from nibabel.fileholders import FileHolder
+from nibabel.openers import ImageOpener, Opener
+
+from utils.nii_cache import cached_path
+from utils.utils_gen import available_cpus
+
+# Uncompressed bytes per independent gzip member written by ParallelGzipWriter
+GZIP_BLOCK_SIZE = 4 * 1024 ** 2
+
+# Voxel axis of each anatomical slice orientation (RAS-like voxel order)
+SLICE_AXES = {'sagittal': 0, 'coronal': 1, 'axial': 2}
+
+# Bytes read from the file stream per step by iter_slices
+_STREAM_READ_BYTES = 4 * 1024 ** 2
+
+# Upper bound on the decoded slices gathered per pass by iter_slices (coronal / sagittal)
+_SLICE_PASS_BYTES = 256 * 1024 ** 2
+
+
+def _unscaled_proxy(nimg):
+    '''
+    Array proxy over the raw on-disk values (scl_slope / scl_inter not applied)
+    '''
+    proxy = nimg.dataobj
+    return ArrayProxy(nimg.get_filename(), (proxy.shape, nimg.get_data_dtype(), proxy.offset, 1.0, 0.0))
+
+
+def is_compressed(img_path):
+    '''
+    True for gzip compressed nifti files
+    '''
+    return str(img_path).endswith('.gz')
 
-def load_nii(img_path):
+
+def load_nii(img_path, lazy=False, apply_scaling=True):
     '''
     Shortcut to load a nifti file
+    :param img_path: Path to the nifti file
+    :param lazy: Do not read the voxels. Returns a np.memmap for uncompressed files when no scaling
+                 has to be applied, otherwise the nibabel array proxy; both support slab slicing
+                 (e.g. data[..., 10:20]) that only reads the requested voxels
+    :param apply_scaling: Apply scl_slope / scl_inter. If False the on-disk dtype is preserved
+    :return: data, affine, header
+    '''
+    nimg = nib.load(img_path)
+    has_scaling = nimg.dataobj.slope != 1.0 or nimg.dataobj.inter != 0.0
+    if apply_scaling or not has_scaling:
+        proxy = nimg.dataobj
+    else:
+        proxy = _unscaled_proxy(nimg)
+
+    if not lazy:
+        data = np.asanyarray(proxy)
+    elif not is_compressed(img_path) and (not apply_scaling or not has_scaling):
+        data = np.memmap(img_path, dtype=nimg.get_data_dtype(), mode='r', offset=proxy.offset,
+                         shape=proxy.shape, order='F')
+    else:
+        data = proxy
+    return data, nimg.affine, nimg.header
+
+def load_region(img_path, bbox, apply_scaling=True):
+    '''
+    Loads only the voxels inside a bounding box ((start, stop) per axis) of a nifti file
+    :return: data, affine of the region, header
+    '''
+    nimg = nib.load(img_path)
+    slices = tuple(slice(start, stop) for start, stop in bbox)
+    region = nimg.slicer[slices]
+    if apply_scaling:
+        data = np.asanyarray(region.dataobj)
+    else:
+        data = _unscaled_proxy(nimg)[slices]
+    return data, region.affine, region.header
+
+def _read_planes(img_path, offset, shape, dtype, depth):
+    '''
+    Sequential pass over the voxels of a file stream, yielding (z0, planes[..., z0:z0 + depth])
+    '''
+    plane_bytes = shape[0] * shape[1] * dtype.itemsize
+    with ImageOpener(img_path) as f:
+        f.seek(offset)
+        for z0 in range(0, shape[2], depth):
+            n = min(depth, shape[2] - z0)
+            buffer = bytearray(n * plane_bytes)
+            view = memoryview(buffer)
+            read = 0
+            while read < len(buffer):
+                count = f.readinto(view[read:])
+                if not count:
+                    raise ValueError('{}: truncated voxel data'.format(img_path))
+                read += count
+            yield z0, np.frombuffer(buffer, dtype=dtype).reshape(shape[:2] + (n,), order='F')
+
+
+def iter_slices(img_path, axis='axial', slab=None, apply_scaling=True, max_bytes=_SLICE_PASS_BYTES):
+    '''
+    Lazily iterates over the slices of a nifti file along one axis.
+
+    The voxels are decoded sequentially from the file stream (gzip included) in
+    their on-disk order, axial plane after axial plane, so memory stays flat with
+    the volume size. Axial slices take a single pass over the file. Coronal and
+    sagittal slices cut across every axial plane: they are gathered in groups of
+    at most max_bytes, one pass per group. 4D files yield the first volume.
+    :param img_path: Path to the nifti file
+    :param axis: 'axial', 'coronal', 'sagittal' or the voxel axis 2, 1, 0
+    :param slab: None yields 2D slices, k yields slabs of up to k slices (the axis is kept)
+    :param apply_scaling: Apply scl_slope / scl_inter, the slices are then float32. Without
+                          scaling (or if False) the on-disk dtype is preserved
+    :param max_bytes: Decoded bytes gathered per pass for coronal / sagittal slices
+    :return: Generator of (index, slice), index being the position of the (first) slice along axis
     '''
+    axis = SLICE_AXES.get(axis, axis)
+    if axis not in (0, 1, 2):
+        raise ValueError('Unknown slice axis {!r}'.format(axis))
+    # The decompressed copy of the volume cache, when there is one, is streamed without gzip
+    img_path = cached_path(img_path)
     nimg = nib.load(img_path)
-    return nimg.get_data(), nimg.affine, nimg.header
+    shape = tuple(int(n) for n in (nimg.shape + (1, 1))[:3])
+    raw_dtype = nimg.get_data_dtype()
+    slope, inter = nimg.dataobj.slope, nimg.dataobj.inter
+    scale = apply_scaling and (slope != 1.0 or inter != 0.0)
+    dtype = np.dtype(np.float32) if scale else raw_dtype
+    offset = nimg.dataobj.offset
+    step = slab or 1
+    read_depth = max(1, _STREAM_READ_BYTES // (shape[0] * shape[1] * raw_dtype.itemsize))
+
+    def _finish(data):
+        if scale:
+            data = data.astype(np.float32)
+            data *= slope
+            data += inter
+        return data
+
+    if axis == 2:
+        depth = max(step, read_depth // step * step)
+        for z0, planes in _read_planes(img_path, offset, shape, raw_dtype, depth):
+            planes = _finish(planes)
+            for i in range(0, planes.shape[2], step):
+                if slab is None:
+                    yield z0 + i, planes[..., i]
+                else:
+                    yield z0 + i, planes[..., i:i + step]
+        return
+
+    slice_bytes = shape[0] * shape[1] * shape[2] // shape[axis] * dtype.itemsize
+    group = max(step, max_bytes // slice_bytes // step * step)
+    for a0 in range(0, shape[axis], group):
+        a1 = min(a0 + group, shape[axis])
+        region = [slice(None)] * 3
+        region[axis] = slice(a0, a1)
+        region = tuple(region)
+        gathered = np.empty(tuple(a1 - a0 if d == axis else n for d, n in enumerate(shape)),
+                            dtype=raw_dtype, order='F')
+        for z0, planes in _read_planes(img_path, offset, shape, raw_dtype, read_depth):
+            gathered[..., z0:z0 + planes.shape[2]] = planes[region]
+        gathered = _finish(gathered)
+        for i in range(0, a1 - a0, step):
+            index = [slice(None)] * 3
+            index[axis] = i if slab is None else slice(i, i + step)
+            # Copy, so a slice kept by the caller does not hold on to the whole group
+            yield a0 + i, gathered[tuple(index)].copy()
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    '''
+    Write-only file object compressing its byte stream in independent blocks across threads.
+
+    Every block becomes a complete gzip member and the members are written in
+    order, which is a standard multi-member gzip file (RFC 1952) readable by
+    gzip, nibabel and ITK. zlib releases the GIL, so the blocks compress in
+    parallel. At most 2 * n_threads blocks are held in memory.
+    '''
+
+    def __init__(self, fileobj, compresslevel=Opener.default_compresslevel, n_threads=None,
+                 block_size=GZIP_BLOCK_SIZE):
+        super(ParallelGzipWriter, self).__init__()
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.n_threads = n_threads or available_cpus()
+        self._executor = ThreadPoolExecutor(max_workers=self.n_threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._position = 0
 
-def save_nii(img_path, data, affine, header):
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # Only the no-op seek to the current position is possible on a stream
+        target = {io.SEEK_SET: offset, io.SEEK_CUR: self._position + offset}.get(whence)
+        if target != self._position:
+            raise io.UnsupportedOperation('ParallelGzipWriter can only seek to its current position')
+        return self._position
+
+    def write(self, b):
+        data = memoryview(b).cast('B')
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        # mtime=0 keeps the output byte-identical for the same data, as nibabel's writer does
+        self._pending.append(self._executor.submit(gzip.compress, block, self.compresslevel, mtime=0))
+        while len(self._pending) > 2 * self.n_threads:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer or self._position == 0:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().result())
+        finally:
+            self._executor.shutdown(wait=True)
+            super(ParallelGzipWriter, self).close()
+
+    def abort(self):
+        '''
+        Close without writing the remaining blocks, e.g. after a failed write: the blocks
+        not compressed yet are cancelled and the threads are not waited for
+        '''
+        if self.closed:
+            return
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._buffer = bytearray()
+        self._executor.shutdown(wait=False)
+        super(ParallelGzipWriter, self).close()
+
+
+def save_nii(img_path, data, affine, header, compresslevel=None, n_threads=None, slope_inter=None):
     '''
     Shortcut to save a nifty file
+
+    .nii.gz files are compressed in parallel blocks (see ParallelGzipWriter) and
+    published with an atomic rename. The same data always gives the same bytes.
+    :param compresslevel: gzip level 0-9, 0 stores the blocks uncompressed (fast
+                          intermediates). Defaults to nibabel's level
+    :param n_threads: Compression threads. Defaults to the CPUs available to the process
+    :param slope_inter: (scl_slope, scl_inter) when data holds raw on-disk values, e.g. from
+                        load_nii(..., apply_scaling=False). None lets nibabel pick the scaling
     '''
     nimg = nib.Nifti1Image(data, affine=affine, header=header)
-    nimg.to_filename(img_path)
+    if slope_inter is not None:
+        nimg.header.set_slope_inter(*slope_inter)
+    if not is_compressed(img_path):
+        nimg.to_filename(img_path)
+        return
+
+    if compresslevel is None:
+        compresslevel = Opener.default_compresslevel
+    tmp_path = '{}.{}.tmp'.format(img_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            writer = ParallelGzipWriter(f, compresslevel=compresslevel, n_threads=n_threads)
+            try:
+                nimg.to_file_map({'image': FileHolder(fileobj=writer)})
+            except BaseException:
+                writer.abort()
+                raise
+            writer.close()
+        os.replace(tmp_path, img_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def crop_nii(img_path, out_path, bbox):
+    '''
+    Crops a nifty file to a bounding box ((start, stop) per axis), correcting the affine.
+    Only the voxels inside the box are read; the raw values and their scaling are kept as they are.
+    '''
+    proxy = nib.load(img_path).dataobj
+    data, affine, header = load_region(img_path, bbox, apply_scaling=False)
+    save_nii(out_path, data, affine, header, slope_inter=(proxy.slope, proxy.inter))